@@ -5,3 +5,4 @@ from   .bootstrap           import *
 from   .simulate            import *
 from   .plottools           import *
 from   .cubefilters         import *
+from   .benchmark           import *
@@ -0,0 +1,1328 @@
+from __future__ import absolute_import, print_function
+from .tools import *
+from .stack import *
+from .bootstrap import *
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+import warnings
+import numpy as np
+import h5py
+
+# heavy optional dependencies: only imported when they're actually used
+plt = lazy_import('matplotlib.pyplot')
+
+""" SYNTHETIC DATA """
+# centres of the three COMAP fields (ra, dec in deg)
+comap_field_centres = [(25.435, 0.0), (170.0, 52.5), (226.0, 55.0)]
+
+def synthetic_map(mapfile, centre=(170.0, 52.5), npix=120, nchan=64, pixsize=2., seed=0,
+                  rmsbase=30e-6, edgeradius=0.45, badchanfrac=0.02, srccoords=None,
+                  srcfreqs=None, linetemp=0., beamfwhm=4.5):
+    """
+    write a deterministic COMAP-shaped map file (pipeline format: 4 sidebands x nchan
+    channels x npix x npix, freq/x/y axes, map/rms/nhit coadds) to mapfile
+    the rms rises quadratically away from the field centre, varies by sideband and
+    towards the sideband edges, and is infinite (ie masked) outside edgeradius*npix. a
+    fraction badchanfrac of the channels are flagged (rms inf) like pipeline-cut channels.
+    if srccoords ((ra, dec) arrays in deg) and srcfreqs (GHz) are passed, a gaussian
+    line of peak linetemp K is injected at each one
+    pixsize and beamfwhm are in arcmin
+    """
+    rng = np.random.default_rng(seed)
+
+    # 26-34 GHz in four sidebands
+    freqedges = np.linspace(26., 34., 4*nchan + 1)
+    freq = ((freqedges[:-1] + freqedges[1:]) / 2).reshape(4, nchan)
+    step = pixsize / 60
+    ra = centre[0] + (np.arange(npix) - npix / 2 + 0.5) * step
+    dec = centre[1] + (np.arange(npix) - npix / 2 + 0.5) * step
+
+    # radial noise profile and the masked edges
+    yy, xx = np.meshgrid(np.arange(npix), np.arange(npix), indexing='ij')
+    rad = np.hypot(xx - npix / 2 + 0.5, yy - npix / 2 + 0.5)
+    spatial = 1 + (rad / (npix / 3))**2
+    # per-sideband level and noisier channels at the edges of each sideband
+    chanpos = np.linspace(-1, 1, nchan)
+    spectral = rng.uniform(0.9, 1.2, (4, 1)) * (1 + 0.5 * chanpos[None, :]**8)
+
+    rms = rmsbase * spectral[:, :, None, None] * spatial[None, None, :, :]
+    rms = rms * rng.uniform(0.95, 1.05, rms.shape)
+    rms[..., rad > edgeradius * npix] = np.inf
+    badchans = rng.random((4, nchan)) < badchanfrac
+    rms[badchans] = np.inf
+
+    good = np.isfinite(rms)
+    hit = np.where(good, 1e8 * (rmsbase / np.where(good, rms, 1.))**2, 0.)
+    skymap = np.where(good, rng.standard_normal(rms.shape) * np.where(good, rms, 0.), 0.)
+
+    if srccoords is not None and linetemp:
+        # gaussian beam in space, a couple of channels wide in frequency
+        sigpix = beamfwhm / pixsize / (2 * np.sqrt(2 * np.log(2)))
+        flatmap = skymap.reshape(4 * nchan, npix, npix)
+        flatfreq = freq.flatten()
+        dfreq = flatfreq[1] - flatfreq[0]
+        hw = int(np.ceil(4 * sigpix))
+        for (sra, sdec, sfreq) in zip(srccoords[0], srccoords[1], srcfreqs):
+            xc, yc = (sra - ra[0]) / step, (sdec - dec[0]) / step
+            fc = (sfreq - flatfreq[0]) / dfreq
+            if not (0 <= xc < npix and 0 <= yc < npix and 0 <= fc < 4 * nchan):
+                continue
+            x0, y0, f0 = max(int(xc) - hw, 0), max(int(yc) - hw, 0), max(int(fc) - 3, 0)
+            x1, y1, f1 = min(int(xc) + hw + 1, npix), min(int(yc) + hw + 1, npix), min(int(fc) + 4, 4 * nchan)
+            gx = np.exp(-0.5 * ((np.arange(x0, x1) - xc) / sigpix)**2)
+            gy = np.exp(-0.5 * ((np.arange(y0, y1) - yc) / sigpix)**2)
+            gf = np.exp(-0.5 * ((np.arange(f0, f1) - fc) / 1.)**2)
+            flatmap[f0:f1, y0:y1, x0:x1] += linetemp * gf[:, None, None] * gy[None, :, None] * gx[None, None, :]
+        skymap = flatmap.reshape(skymap.shape)
+
+    with h5py.File(mapfile, 'w') as f:
+        f['map_coadd'] = skymap
+        f['rms_coadd'] = rms
+        f['nhit_coadd'] = hit
+        f['freq'] = freq
+        f['x'] = ra
+        f['y'] = dec
+        f['patch_center'] = np.array(centre)
+
+    return mapfile
+
+def synthetic_catalogue_coords(nobj, centre=(170.0, 52.5), radius=2., zlims=(1.9, 3.5), seed=0):
+    """
+    HETDEX-like object positions around one field: uniform over a disc of radius deg
+    (so some fall off the map) and uniform in redshift over zlims (HETDEX LAEs go from
+    z~1.9 to 3.5, so some fall outside the COMAP band too). returns (ra, dec, z)
+    """
+    rng = np.random.default_rng(seed)
+    rad = radius * np.sqrt(rng.random(nobj))
+    theta = rng.uniform(0, 2 * np.pi, nobj)
+    dec = centre[1] + rad * np.sin(theta)
+    ra = centre[0] + rad * np.cos(theta) / np.cos(np.radians(dec))
+    z = rng.uniform(zlims[0], zlims[1], nobj)
+    return ra, dec, z
+
+def synthetic_fields(savepath, nobj=1000, nfields=3, npix=120, nchan=64, seed=0, linetemp=1e-4,
+                     centfreq=115.27, **mapkwargs):
+    """
+    write nfields synthetic COMAP-shaped maps (one per COMAP field) and a single
+    HETDEX-like catalogue with nobj objects per field around them into savepath, with
+    the catalogue objects injected into the maps as lines of peak linetemp K. the same
+    arguments always give the same files. returns (mapfiles, catfile)
+    """
+    os.makedirs(savepath, exist_ok=True)
+
+    mapfiles = []
+    ras, decs, zs = [], [], []
+    for i in range(nfields):
+        centre = comap_field_centres[i % len(comap_field_centres)]
+        # objects spread out to the edges of the map (and a bit past them in the corners)
+        radius = 0.5 * npix * mapkwargs.get('pixsize', 2.) / 60
+        ra, dec, z = synthetic_catalogue_coords(nobj, centre=centre, radius=radius,
+                                                seed=seed * 100 + 2 * i)
+        mapfile = os.path.join(savepath, 'synthetic_field{}.h5'.format(i + 1))
+        synthetic_map(mapfile, centre=centre, npix=npix, nchan=nchan, seed=seed * 100 + 2 * i + 1,
+                      srccoords=(ra, dec), srcfreqs=centfreq / (1 + z), linetemp=linetemp, **mapkwargs)
+        mapfiles.append(mapfile)
+        ras.append(ra)
+        decs.append(dec)
+        zs.append(z)
+
+    catfile = os.path.join(savepath, 'synthetic_catalogue.npz')
+    np.savez(catfile, ra=np.concatenate(ras), dec=np.concatenate(decs), z=np.concatenate(zs))
+
+    return mapfiles, catfile
+
+
+""" BENCHMARKS """
+# everything run_benchmarks knows how to time, in the order they're run
+benchmark_names = ['setup', 'field_stack', 'field_stack_single', 'parallel_field_stack', 'stacker',
+                   'physical_spacing', 'physical_spacing_fast', 'prf_fitting', 'adaptive_photometry', 'offset_bootstrap',
+                   'n_random_stacks']
+
+def benchmark_params(savepath, paramfile=None):
+    """
+    parameters for a benchmark run: the defaults (or paramfile), quiet, no plot files,
+    and everything written under savepath
+    """
+    params = parameters(paramfile)
+    params.verbose = False
+    params.saveplots = False
+    params.plotcubelet = False
+    params.savepath = savepath
+    params.make_output_pathnames(append=False)
+    return params
+
+def _stack_info(cube):
+    """ the numbers worth keeping from a stacked cubelet (to check a benchmark did the same work) """
+    if cube is None:
+        return {'ncutouts': 0}
+    return {'ncutouts': int(cube.ncutouts), 'linelum': float(cube.linelum),
+            'dlinelum': float(cube.dlinelum)}
+
+def _bench_setup(data, params, config):
+    maplist, catlist = setup(data['mapfiles'], data['catfile'], params)
+    return {'nobj': int(np.sum([cat.nobj for cat in catlist]))}
+
+def _bench_field_stack(data, params, config):
+    return _stack_info(field_stack(data['maplist'][0], data['catlist'][0], params, field=1))
+
+def _bench_field_stack_single(data, params, config):
+    params.precision = 'single'
+    return _stack_info(field_stack(data['singlemap'], data['catlist'][0], params, field=1))
+
+def _bench_parallel_field_stack(data, params, config):
+    params.nthreads = config['nthreads']
+    outdict = _stack_info(parallel_field_stack(data['maplist'][0], data['catlist'][0], params, field=1))
+    outdict['nthreads'] = config['nthreads']
+    return outdict
+
+def _bench_stacker(data, params, config):
+    return _stack_info(stacker(data['maplist'], data['catlist'], params))
+
+def _bench_physical_spacing(data, params, config):
+    params.physicalspace = True
+    params.goalres = config['goalres'] * u.Mpc
+    params.pspacefac = config['pspacefac']
+    physical_spacing_setup(data['maplist'][0], params)
+    return _stack_info(field_stack(data['maplist'][0], data['fitcat'], params, field=1))
+
+def _bench_physical_spacing_fast(data, params, config):
+    params.psfast = True
+    return _bench_physical_spacing(data, params, config)
+
+def _bench_prf_fitting(data, params, config):
+    params.prf_fitting = True
+    params.add_to_lcolist = True
+    return _stack_info(field_stack(data['maplist'][0], data['fitcat'], params, field=1))
+
+def _bench_adaptive_photometry(data, params, config):
+    params.adaptivephotometry = True
+    return _stack_info(field_stack(data['maplist'][0], data['fitcat'], params, field=1))
+
+def _bench_offset_bootstrap(data, params, config):
+    params.itersave = False
+    params.itersavestep = max(config['niter'], 1)
+    params.bootstrapseed = config['seed']
+    params.nitersavefile = params.datasavepath + '/offset_bootstrap.npz'
+    outarrs = offset_bootstrap(config['niter'], data['maplist'], data['catlist'], params)
+    return {'niter': config['niter'], 'meanT': float(np.nanmean(outarrs[:, 0]))}
+
+def _bench_n_random_stacks(data, params, config):
+    params.itersave = False
+    params.nzbins = 3
+    actcube = stacker(data['maplist'], data['catlist'], params)
+    Tvals, rmsvals = n_random_stacks(config['niter'], actcube.fieldcatidx, data['maplist'],
+                                     data['catlist'], params, verbose=False)
+    return {'niter': config['niter'], 'meanT': float(np.nanmean(Tvals))}
+
+def single_precision_map(mapinst):
+    """ float32 copy of a (double-precision) map object, as precision='single' would load it """
+    singleparams = empty_table()
+    singleparams.precision = 'single'
+    singlemap = mapinst.copy()
+    singlemap.set_precision(singleparams)
+    return singlemap
+
+def precision_check(nobj=300, npix=120, nchan=64, nrep=3, seed=0, tol=1e-4, workdir=None, verbose=True):
+    """
+    stack the same synthetic field with the map stored in double and in single precision
+    and compare them. the differences in linelum and dlinelum are given as fractions of
+    dlinelum (ie of the stack's own noise) and should be well below tol -- a warning is
+    given if not. also gives the memory of the map arrays and the throughput (cutouts/s,
+    best of nrep) of each, and returns all of this as a dict
+    """
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='lim_stacker_precision_')
+
+    try:
+        mapfiles, catfile = synthetic_fields(os.path.join(workdir, 'data'), nobj=nobj, nfields=1,
+                                             npix=npix, nchan=nchan, seed=seed)
+        params = benchmark_params(os.path.join(workdir, 'output'))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            maplist, catlist = setup(mapfiles, catfile, params)
+        maps = {'double': maplist[0], 'single': single_precision_map(maplist[0])}
+
+        outdict = {}
+        for (precision, mapinst) in maps.items():
+            times = []
+            for i in range(nrep):
+                runparams = params.copy()
+                runparams.precision = precision
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    start = time.perf_counter()
+                    cube = field_stack(mapinst, catlist[0], runparams, field=1)
+                    times.append(time.perf_counter() - start)
+            outdict[precision] = {'linelum': float(cube.linelum), 'dlinelum': float(cube.dlinelum),
+                                  'ncutouts': int(cube.ncutouts), 'seconds': float(np.min(times)),
+                                  'throughput': cube.ncutouts / np.min(times),
+                                  'mapmemory': (mapinst.map.nbytes + mapinst.rms.nbytes + mapinst.hit.nbytes) / 1024**2,
+                                  'cubedtype': str(cube.cube.dtype)}
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    double, single = outdict['double'], outdict['single']
+    outdict['linelumerror'] = abs(single['linelum'] - double['linelum']) / double['dlinelum']
+    outdict['dlinelumerror'] = abs(single['dlinelum'] - double['dlinelum']) / double['dlinelum']
+    outdict['speedup'] = single['throughput'] / double['throughput']
+    outdict['memoryratio'] = single['mapmemory'] / double['mapmemory']
+    outdict['passed'] = bool(outdict['linelumerror'] < tol and outdict['dlinelumerror'] < tol
+                             and single['ncutouts'] == double['ncutouts'])
+
+    if verbose:
+        print('linelum change {:.2e} and dlinelum change {:.2e} (fractions of dlinelum)'.format(
+              outdict['linelumerror'], outdict['dlinelumerror']))
+        print('map memory {:.0f} -> {:.0f} MB, throughput {:.1f} -> {:.1f} cutouts/s ({:.2f}x)'.format(
+              double['mapmemory'], single['mapmemory'], double['throughput'], single['throughput'],
+              outdict['speedup']))
+    if not outdict['passed']:
+        warnings.warn('single-precision stack differs from the double-precision one by more '
+                      'than {} of dlinelum'.format(tol), RuntimeWarning)
+
+    return outdict
+
+def voxel_centred_catalogue(catfile, mapfile, outfile, centfreq=115.27):
+    """
+    copy of a synthetic catalogue with every object moved to the centre of the map voxel
+    it falls in (objects off the map stay off it), for checks that need voxel-centred
+    stacks. returns outfile
+    """
+    with np.load(catfile) as f:
+        ra, dec, z = f['ra'], f['dec'], f['z']
+    with h5py.File(mapfile, 'r') as f:
+        freq, x, y = f['freq'][()].flatten(), f['x'][()], f['y'][()]
+
+    def snap(vals, axis):
+        step = axis[1] - axis[0]
+        return axis[0] + np.round((vals - axis[0]) / step) * step
+
+    nuobs = snap(centfreq / (1 + z), freq)
+    np.savez(outfile, ra=snap(ra, x), dec=snap(dec, y), z=centfreq / nuobs - 1)
+    return outfile
+
+def fft_stack_check(nobj=300, npix=120, nchan=64, nrep=3, seed=0, tol=1e-6, workdir=None, verbose=True):
+    """
+    stack the same synthetic field (objects moved to voxel centres, no rotation) with
+    field_stack and with fft_field_stack and compare them. the largest cubelet difference
+    is given as a fraction of the cubelet rms and the linelum difference as a fraction of
+    dlinelum; both should be below tol (a warning is given if not). also gives the best
+    of nrep wall times of each, and returns all of this as a dict
+    """
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='lim_stacker_fftstack_')
+
+    try:
+        datapath = os.path.join(workdir, 'data')
+        mapfiles, catfile = synthetic_fields(datapath, nobj=nobj, nfields=1, npix=npix,
+                                             nchan=nchan, seed=seed)
+        catfile = voxel_centred_catalogue(catfile, mapfiles[0], os.path.join(datapath, 'voxel_catalogue.npz'))
+        params = benchmark_params(os.path.join(workdir, 'output'))
+        params.rotate = False
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            maplist, catlist = setup(mapfiles, catfile, params)
+
+        cubes, outdict = {}, {}
+        for (name, func) in [('cutout', field_stack), ('fft', fft_field_stack)]:
+            times = []
+            for i in range(nrep):
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    start = time.perf_counter()
+                    cubes[name] = func(maplist[0], catlist[0], params.copy(), field=1)
+                    times.append(time.perf_counter() - start)
+            outdict[name] = {'linelum': float(cubes[name].linelum), 'dlinelum': float(cubes[name].dlinelum),
+                             'ncutouts': int(cubes[name].ncutouts), 'seconds': float(np.min(times))}
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    cutcube, fftcube = cubes['cutout'], cubes['fft']
+    good = np.isfinite(cutcube.cube)
+    outdict['samevoxels'] = bool(np.array_equal(good, np.isfinite(fftcube.cube)))
+    outdict['sameobjects'] = bool(np.array_equal(np.sort(cutcube.catidx), np.sort(fftcube.catidx)))
+    outdict['cubeerror'] = float(np.max(np.abs(fftcube.cube - cutcube.cube)[good] / cutcube.cuberms[good]))
+    outdict['rmserror'] = float(np.max(np.abs(fftcube.cuberms / cutcube.cuberms - 1)[good]))
+    outdict['linelumerror'] = abs(outdict['fft']['linelum'] - outdict['cutout']['linelum']) / outdict['cutout']['dlinelum']
+    aperture = [cube.get_aperture() for cube in (cutcube, fftcube)]
+    outdict['apertureerror'] = float(abs(aperture[1][0] - aperture[0][0]) / aperture[0][1])
+    outdict['speedup'] = outdict['cutout']['seconds'] / outdict['fft']['seconds']
+    outdict['passed'] = bool(outdict['samevoxels'] and outdict['sameobjects']
+                             and max(outdict['cubeerror'], outdict['rmserror'], outdict['linelumerror'],
+                                     outdict['apertureerror']) < tol)
+
+    if verbose:
+        print('{} cutouts: largest cubelet difference {:.2e} of the rms, aperture {:.2e}, linelum {:.2e}'.format(
+              outdict['cutout']['ncutouts'], outdict['cubeerror'], outdict['apertureerror'],
+              outdict['linelumerror']))
+        print('cutout stack {:.2f} s, FFT stack {:.2f} s ({:.1f}x)'.format(
+              outdict['cutout']['seconds'], outdict['fft']['seconds'], outdict['speedup']))
+    if not outdict['passed']:
+        warnings.warn('FFT stack differs from the cutout-by-cutout one by more than {}'.format(tol),
+                      RuntimeWarning)
+
+    return outdict
+
+def offset_lookup_check(niter=5, nobj=300, npix=120, nchan=64, seed=0, tol=1e-2, method='offset',
+                        maxoffset=3, workdir=None, verbose=True):
+    """
+    compare offset nulls done as lookups (offset_lookup) with the same randomized
+    catalogues (same random streams) actually stacked with field_stack, on one synthetic
+    field. the largest differences in T and rms are given as fractions of the stack rms
+    and should be below tol (they differ by the line luminosity conversion being taken at
+    channel centres). also checks every lag of offset_lag_cube (out to maxoffset) against
+    direct sums over the shifted objects, and times both kinds of null. returns a dict
+    """
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='lim_stacker_offsetlookup_')
+
+    try:
+        mapfiles, catfile = synthetic_fields(os.path.join(workdir, 'data'), nobj=nobj, nfields=1,
+                                             npix=npix, nchan=nchan, seed=seed)
+        params = benchmark_params(os.path.join(workdir, 'output'))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            maplist, catlist = setup(mapfiles, catfile, params)
+
+            start = time.perf_counter()
+            boxsums = [aperture_box_sums(maplist[0], params)]
+            boxseconds = time.perf_counter() - start
+
+            lookups, stacks, looktimes, stacktimes = [], [], [], []
+            for i in range(niter):
+                start = time.perf_counter()
+                lookups.append(offset_lookup(maplist, catlist, params, bootstrap_stream(seed, i),
+                                             boxsums, method=method))
+                looktimes.append(time.perf_counter() - start)
+
+                start = time.perf_counter()
+                offcat = lookup_randomizers[method](maplist[0], catlist[0], params, bootstrap_stream(seed, i))
+                cube = field_stack(maplist[0], offcat, params.copy())
+                stacks.append(cube.get_aperture())
+                stacktimes.append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            lagT, lagrms = offset_lag_cube(maplist, catlist, params, maxoffset=maxoffset, boxsums=boxsums)
+            lagseconds = time.perf_counter() - start
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    lookups, stacks = np.array(lookups), np.array(stacks)
+    outdict = {'T': lookups[:, 0].tolist(), 'stackT': stacks[:, 0].tolist(),
+               'Terror': float(np.max(np.abs(lookups[:, 0] - stacks[:, 0]) / stacks[:, 1])),
+               'rmserror': float(np.max(np.abs(lookups[:, 1] - stacks[:, 1]) / stacks[:, 1])),
+               'boxseconds': boxseconds, 'lookupseconds': float(np.mean(looktimes)),
+               'stackseconds': float(np.mean(stacktimes)), 'lagcubeseconds': lagseconds}
+
+    # the lag cube against straight sums over the (unshifted) stack objects, shifted
+    keep, idxs, _ = cutout_prefilter(catlist[0], maplist[0], params, voxels=True)
+    fidx, yidx, xidx = [idx[keep] for idx in idxs]
+    shape = boxsums[0][0].shape
+    lagerror = 0.
+    for lag in np.ndindex(*lagT.shape):
+        df, dy, dx = np.array(lag) - maxoffset
+        valsum, weightsum = np.zeros(params.freqwidth), np.zeros(params.freqwidth)
+        for c in range(params.freqwidth):
+            f, y, x = fidx + df + c - params.freqwidth // 2, yidx + dy, xidx + dx
+            inmap = (f >= 0) & (f < shape[0]) & (y >= 0) & (y < shape[1]) & (x >= 0) & (x < shape[2])
+            valsum[c] = np.sum(boxsums[0][0][f[inmap], y[inmap], x[inmap]])
+            weightsum[c] = np.sum(boxsums[0][1][f[inmap], y[inmap], x[inmap]])
+        T, rms = aperture_from_sums(valsum, weightsum, params)
+        lagerror = max(lagerror, abs(lagT[lag] - T) / rms, abs(lagrms[lag] / rms - 1))
+    outdict['lagcubeerror'] = float(lagerror)
+
+    outdict['speedup'] = outdict['stackseconds'] / outdict['lookupseconds']
+    outdict['passed'] = bool(max(outdict['Terror'], outdict['rmserror']) < tol and lagerror < 1e-8)
+
+    if verbose:
+        print('lookup nulls differ from stacked ones by up to {:.2e} (T) and {:.2e} (rms) of the rms'.format(
+              outdict['Terror'], outdict['rmserror']))
+        print('{:.3f} s per lookup vs {:.2f} s per stack ({:.0f}x), after {:.2f} s of setup'.format(
+              outdict['lookupseconds'], outdict['stackseconds'], outdict['speedup'], boxseconds))
+        print('lag cube ({} lags) in {:.2f} s, largest difference from direct sums {:.2e}'.format(
+              lagT.size, lagseconds, lagerror))
+    if not outdict['passed']:
+        warnings.warn('lookup offset nulls differ from stacked ones by more than {}'.format(tol),
+                      RuntimeWarning)
+
+    return outdict
+
+def rotation_stream_check(niter=3, nobj=100, npix=120, nchan=64, seed=0, workdir=None, verbose=True):
+    """
+    stack one synthetic field (with rotated cutouts) as niter checkpointed realizations,
+    twice, keeping the stacked images. each realization's rotations come from its own
+    stream, so the images should all differ from each other but be the same both times
+    round. also checks two field_stack calls with no rotation rng set both start from
+    rotseed (and leave no rng behind). returns a dict
+    """
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='lim_stacker_rotstream_')
+
+    try:
+        mapfiles, catfile = synthetic_fields(os.path.join(workdir, 'data'), nobj=nobj, nfields=1,
+                                             npix=npix, nchan=nchan, seed=seed)
+        params = benchmark_params(os.path.join(workdir, 'output'))
+        params.rotate = True
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            maplist, catlist = setup(mapfiles, catfile, params)
+            comap, galcat = maplist[0], catlist[0]
+
+            image = lambda: field_stack(comap, galcat, params, field=1).get_image()[0].flatten()
+            direct = [image(), image()]
+            leftrng = params.rng_set
+            colnames = ['pix{}'.format(j) for j in range(len(direct[0]))]
+
+            realize = lambda i, rng: image()
+            images = [checkpointed_realizations(niter, realize, params, colnames, seed=seed)
+                      for _ in range(2)]
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    first, second = images
+    outdict = {'repeatable': bool(np.array_equal(first, second, equal_nan=True)),
+               'distinct': bool(all(not np.array_equal(first[i], first[j], equal_nan=True)
+                                    for i in range(niter) for j in range(i))),
+               'fieldreseeded': bool(np.array_equal(*direct, equal_nan=True) and not leftrng)}
+    outdict['passed'] = bool(outdict['repeatable'] and outdict['distinct'] and outdict['fieldreseeded'])
+
+    if verbose:
+        print('realizations repeatable: {}, rotated differently: {}, field_stack starts from rotseed: {}'.format(
+              outdict['repeatable'], outdict['distinct'], outdict['fieldreseeded']))
+    if not outdict['passed']:
+        warnings.warn('the rotations of checkpointed realizations are not on their own streams',
+                      RuntimeWarning)
+
+    return outdict
+
+def matched_filter_check(nfit=30, nobj=300, npix=120, nchan=64, nbins=4, seed=0, tol=0.05,
+                         workdir=None, verbose=True):
+    """
+    PRF amplitudes from the matched-filtered maps (prf_matched_filter_amplitudes, with and
+    without interpolating between the nbins sub-channel offset bins) against fit_amplitude
+    run on the first nfit unrotated cutouts of one synthetic field, with curve_fit and with
+    its closed-form 'matchedfilter' method. differences are fractions of the fit error;
+    the interpolated map amplitudes should be within tol (a warning is given if not). also
+    gives the time per object of each. returns a dict
+    """
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='lim_stacker_matchedfilter_')
+
+    try:
+        mapfiles, catfile = synthetic_fields(os.path.join(workdir, 'data'), nobj=nobj, nfields=1,
+                                             npix=npix, nchan=nchan, seed=seed)
+        params = benchmark_params(os.path.join(workdir, 'output'))
+        params.rotate = False
+        params.prf_fitting = True
+        params.add_to_lcolist = True
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            maplist, catlist = setup(mapfiles, catfile, params)
+        comap, galcat = maplist[0], catlist[0]
+
+        outdict = {}
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            # map-level amplitudes for every object
+            start = time.perf_counter()
+            prf_matched_filter_maps(comap, params, nbins=nbins)
+            outdict['mapseconds'] = time.perf_counter() - start
+            start = time.perf_counter()
+            keep, amps, damps = prf_matched_filter_amplitudes(galcat, comap, params, nbins=nbins)
+            outdict['lookupseconds'] = (time.perf_counter() - start) / len(amps)
+            nearest = prf_matched_filter_amplitudes(galcat, comap, params, nbins=nbins, interpolate=False)
+
+            # one cutout at a time
+            fits = {}
+            for method in ['curve_fit', 'matchedfilter']:
+                params.prf_fitmethod = method
+                start = time.perf_counter()
+                fitvals = []
+                for i in np.where(keep)[0][:nfit]:
+                    cube = cubelet(single_cutout(i, galcat, comap, params), params)
+                    cube.to_linelum(params)
+                    cube.get_spectrum(method='prf_fitting', params=params)
+                    fitvals.append((cube.prf_stacklco[-1], cube.prf_stacklcorms[-1]))
+                outdict[method + 'seconds'] = (time.perf_counter() - start) / len(fitvals)
+                fits[method] = np.array(fitvals)
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    fit = fits['curve_fit']
+    nfit = len(fit)
+    for (name, (vals, dvals)) in [('closedform', fits['matchedfilter'].T), ('map', (amps[:nfit], damps[:nfit])),
+                                  ('mapnearest', (nearest[1][:nfit], nearest[2][:nfit]))]:
+        outdict[name + 'error'] = float(np.max(np.abs(vals - fit[:, 0]) / fit[:, 1]))
+        outdict[name + 'rmserror'] = float(np.max(np.abs(dvals / fit[:, 1] - 1)))
+    outdict['nobj'] = int(len(amps))
+    outdict['speedup'] = outdict['curve_fitseconds'] / outdict['lookupseconds']
+    outdict['passed'] = bool(max(outdict['maperror'], outdict['maprmserror']) < tol
+                             and outdict['closedformerror'] < 1e-3)
+
+    if verbose:
+        print('amplitude differences from curve_fit (fractions of its error) -- closed form {:.1e}, '
+              'map {:.1e} (nearest bin {:.1e}), map errors {:.1e}'.format(
+              outdict['closedformerror'], outdict['maperror'], outdict['mapnearesterror'],
+              outdict['maprmserror']))
+        print('curve_fit {:.3f} s per object; maps {:.2f} s once, then {:.1e} s per object ({} objects)'.format(
+              outdict['curve_fitseconds'], outdict['mapseconds'], outdict['lookupseconds'], outdict['nobj']))
+    if not outdict['passed']:
+        warnings.warn('matched-filter amplitudes differ from the fits by more than {}'.format(tol),
+                      RuntimeWarning)
+
+    return outdict
+
+def contribution_store_check(nobj=300, npix=120, nchan=64, goalnobj=50, seed=0, tol=1e-6,
+                             workdir=None, verbose=True):
+    """
+    stack one synthetic field with field_stack keeping the per-object contribution store,
+    then redo the whole stack, the low- and high-redshift halves of it and the first
+    goalnobj objects both from the store and with field_stack on the map. the aperture
+    value and spectrum differences are fractions of their rms and should be below tol (a
+    warning is given if not). also checks per-field goals are looked up by field number,
+    and gives the time of each kind of stack. returns a dict
+    """
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='lim_stacker_contribstore_')
+
+    try:
+        mapfiles, catfile = synthetic_fields(os.path.join(workdir, 'data'), nobj=nobj, nfields=1,
+                                             npix=npix, nchan=nchan, seed=seed)
+        params = benchmark_params(os.path.join(workdir, 'output'))
+        params.contribstore = True
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            maplist, catlist = setup(mapfiles, catfile, params)
+            comap, galcat = maplist[0], catlist[0]
+            fullcube = field_stack(comap, galcat, params.copy(), field=1)
+        store = fullcube.contributions
+        zsplit = np.median(store['z'])
+
+        # (subset name, rows of the store, catalogue to stack, goalnobj)
+        subsets = [('all', None, galcat, None)]
+        for (name, rows) in [('lowz', store['z'] < zsplit), ('highz', store['z'] >= zsplit)]:
+            catidx = np.where(np.isin(galcat.catfileidx, store['catidx'][rows]))[0]
+            subsets.append((name, rows, galcat.subset(catidx, in_place=False), None))
+        subsets.append(('goal', None, galcat, goalnobj))
+
+        outdict = {'nobj': len(store), 'mapseconds': 0., 'storeseconds': 0.}
+        for (name, rows, cat, goal) in subsets:
+            stackparams = params.copy()
+            stackparams.contribstore = False
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                start = time.perf_counter()
+                cube = field_stack(comap, cat, stackparams, field=1, goalnobj=goal)
+                outdict['mapseconds'] += time.perf_counter() - start
+            start = time.perf_counter()
+            restack = store.stack(params, idx=rows, goalnobj=goal)
+            outdict['storeseconds'] += time.perf_counter() - start
+
+            val, dval = cube.get_aperture()
+            spec, dspec = cube.get_spectrum()
+            good = np.isfinite(spec)
+            outdict[name] = {'nobj': int(cube.ncutouts), 'restacknobj': int(restack['nobj']),
+                             'apertureerror': float(abs(restack['linelum'] - val) / dval),
+                             'spectrumerror': float(np.max(np.abs(restack['spectrum'] - spec)[good] / dspec[good]))}
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    # per-field goals go by field number, even when a subset leaves a field out (the
+    # store's rows spread over three fields for this)
+    fieldstore = contribution_store(dict(store.columns, field=np.arange(len(store)) % 3 + 1))
+    fieldrows = fieldstore.select(idx=fieldstore['field'] != 1, goalnobj=[goalnobj, goalnobj // 2, 0])
+    outdict['fieldgoals'] = bool(np.array_equal(fieldrows, np.where(fieldstore['field'] == 2)[0][:goalnobj // 2]))
+
+    names = [subset[0] for subset in subsets]
+    outdict['speedup'] = outdict['mapseconds'] / outdict['storeseconds']
+    outdict['passed'] = bool(all(outdict[name]['nobj'] == outdict[name]['restacknobj'] for name in names)
+                             and max(max(outdict[name]['apertureerror'], outdict[name]['spectrumerror'])
+                                     for name in names) < tol and outdict['fieldgoals'])
+
+    if verbose:
+        for name in names:
+            print('{}: {} objects, aperture difference {:.1e} of the rms, spectrum {:.1e}'.format(
+                  name, outdict[name]['nobj'], outdict[name]['apertureerror'], outdict[name]['spectrumerror']))
+        print('{} stacks from the map {:.2f} s, from the store {:.1e} s ({:.0f}x)'.format(
+              len(names), outdict['mapseconds'], outdict['storeseconds'], outdict['speedup']))
+        print('per-field goals by field number: {}'.format('ok' if outdict['fieldgoals'] else 'WRONG'))
+    if not outdict['passed']:
+        warnings.warn('stacks from the contribution store differ from field_stack by more than {}'.format(tol),
+                      RuntimeWarning)
+
+    return outdict
+
+def resampled_errors_check(nobj=300, npix=120, nchan=64, nregions=4, nboot=200, ndirect=3, seed=0,
+                           tol=1e-6, workdir=None, verbose=True):
+    """
+    jackknife (nregions redshift slices) and catalogue bootstrap (nboot realizations)
+    errors from the contribution store of one synthetic field, with every jackknife
+    realization and the first ndirect bootstrap ones redone by field_stack on the
+    resampled catalogue. realization differences are fractions of the stack's dlinelum
+    and should be below tol (a warning is given if not). also gives the time per
+    realization each way and the jackknife/bootstrap errors against dlinelum. returns a dict
+    """
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='lim_stacker_resampled_')
+
+    try:
+        mapfiles, catfile = synthetic_fields(os.path.join(workdir, 'data'), nobj=nobj, nfields=1,
+                                             npix=npix, nchan=nchan, seed=seed)
+        params = benchmark_params(os.path.join(workdir, 'output'))
+        params.contribstore = True
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            maplist, catlist = setup(mapfiles, catfile, params)
+            comap, galcat = maplist[0], catlist[0]
+            fullcube = field_stack(comap, galcat, params.copy(), field=1)
+        store = fullcube.contributions
+        catrows = np.array([np.where(galcat.catfileidx == idx)[0][0] for idx in store['catidx']])
+
+        outdict = {'nobj': len(store), 'dlinelum': float(fullcube.dlinelum)}
+        regions = jackknife_regions(store, nregions, method='redshift')
+        start = time.perf_counter()
+        jack = jackknife_errors(store, params, regions)
+        outdict['jackknifeseconds'] = (time.perf_counter() - start) / nregions
+        start = time.perf_counter()
+        boot = catalogue_bootstrap_errors(store, params, nboot, seed=seed)
+        outdict['bootstrapseconds'] = (time.perf_counter() - start) / nboot
+
+        # the same realizations stacked from the map
+        counts = catalogue_bootstrap_multiplicities(store, np.arange(ndirect), seed=seed)
+        resampled = [('jackknife', j, catrows[regions != j], jack['linelums'][j]) for j in range(nregions)]
+        resampled += [('bootstrap', j, np.repeat(catrows, counts[j].astype(int)), boot['linelums'][j])
+                      for j in range(ndirect)]
+        errors, seconds = [], []
+        for (name, j, rows, storeval) in resampled:
+            stackparams = params.copy()
+            stackparams.contribstore = False
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                start = time.perf_counter()
+                cube = field_stack(comap, galcat.subset(rows, in_place=False), stackparams, field=1)
+                seconds.append(time.perf_counter() - start)
+            errors.append(abs(cube.get_aperture()[0] - storeval) / fullcube.dlinelum)
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    outdict['realizationerror'] = float(np.max(errors))
+    outdict['mapseconds'] = float(np.mean(seconds))
+    outdict['jackknifedlinelum'] = float(jack['dlinelum'])
+    outdict['bootstrapdlinelum'] = float(boot['dlinelum'])
+    outdict['speedup'] = outdict['mapseconds'] / outdict['bootstrapseconds']
+    outdict['passed'] = bool(outdict['realizationerror'] < tol)
+
+    if verbose:
+        print('{} objects: store realizations differ from field_stack by {:.1e} of dlinelum'.format(
+              outdict['nobj'], outdict['realizationerror']))
+        print('errors / dlinelum -- jackknife ({} regions) {:.2f}, bootstrap ({} draws) {:.2f}'.format(
+              nregions, outdict['jackknifedlinelum'] / outdict['dlinelum'], nboot,
+              outdict['bootstrapdlinelum'] / outdict['dlinelum']))
+        print('per realization: field_stack {:.2f} s, jackknife {:.1e} s, bootstrap {:.1e} s ({:.0f}x)'.format(
+              outdict['mapseconds'], outdict['jackknifeseconds'], outdict['bootstrapseconds'],
+              outdict['speedup']))
+    if not outdict['passed']:
+        warnings.warn('resampled stacks from the contribution store differ from field_stack by more than {}'.format(tol),
+                      RuntimeWarning)
+
+    return outdict
+
+def aperture_sweep_check(nobj=300, npix=120, nchan=64, spacewidths=(1, 3, 5), freqwidths=(1, 3, 5, 7),
+                         filterfreqwidths=(1, 3, 5), seed=0, tol=1e-6, workdir=None, verbose=True):
+    """
+    sweep the aperture of one synthetic field stack over square spacewidths x freqwidths
+    and check every row of the table against get_aperture/get_spectrum on the same cubelet
+    set to that aperture, and against field_stack run again from the map with that
+    aperture on the swept stack's objects (differences as fractions of the rms, should be
+    below tol -- a warning is given if not). also checks that the run's own stack is the
+    same as it is with no sweep set. this is done without and then with the cutout
+    filters on (sweeping over filterfreqwidths, since the spectral-mean filter's region
+    for the largest has to fit in the cutout) -- filtered sweeps are of cutouts filtered
+    for the largest aperture, so there only the largest aperture is restacked. gives the time of the sweep against the
+    restacks and returns all of this as a dict (one entry per case)
+    """
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='lim_stacker_aperturesweep_')
+
+    outdict = {}
+    try:
+        mapfiles, catfile = synthetic_fields(os.path.join(workdir, 'data'), nobj=nobj, nfields=1,
+                                             npix=npix, nchan=nchan, seed=seed)
+        baseparams = benchmark_params(os.path.join(workdir, 'output'))
+        baseparams.sweepxwidths = baseparams.sweepywidths = list(spacewidths)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            maplist, catlist = setup(mapfiles, catfile, baseparams)
+        comap, galcat = maplist[0], catlist[0]
+
+        for case in ['unfiltered', 'filtered']:
+            params = baseparams.copy()
+            params.specmeanfilter = params.chanmeanfilter = params.lowmodefilter = (case == 'filtered')
+            casefreqwidths = filterfreqwidths if case == 'filtered' else freqwidths
+            params.sweepfreqwidths = list(casefreqwidths)
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                start = time.perf_counter()
+                cube = field_stack(comap, galcat, params.copy(), field=1)
+                caseout = {'sweepseconds': time.perf_counter() - start, 'nobj': int(cube.ncutouts)}
+
+                # the sweep shouldn't change the stack itself
+                ownparams = params.copy()
+                ownparams.sweepxwidths = ownparams.sweepywidths = ownparams.sweepfreqwidths = False
+                owncube = field_stack(comap, galcat, ownparams, field=1)
+                caseout['ownerror'] = float(abs(cube.linelum - owncube.linelum) / owncube.dlinelum)
+                caseout['ownnobj'] = int(owncube.ncutouts)
+
+            # the table is measured on the objects that fit its largest aperture
+            cube = getattr(cube, 'sweepcube', cube)
+            caseout['sweepnobj'] = int(cube.ncutouts)
+            table = cube.aperture_sweep(*aperture_sweep_widths(params))
+            sweptcat = galcat.subset(np.where(np.isin(galcat.catfileidx, cube.catidx))[0], in_place=False)
+
+            rows, caseout['restackseconds'] = [], 0.
+            for i in np.where(table['xwidth'] == table['ywidth'])[0]:
+                width, freqwidth = int(table['xwidth'][i]), int(table['freqwidth'][i])
+
+                # the same cubelet with its aperture set to this one
+                apcube = cube.copy()
+                apcube.xwidth = apcube.ywidth = width
+                apcube.freqwidth = freqwidth
+                apcube.apminpix = tuple(c - w // 2 for (c, w) in zip(apcube.centpix, (freqwidth, width, width)))
+                apcube.apmaxpix = tuple(c + w // 2 + 1 for (c, w) in zip(apcube.centpix, (freqwidth, width, width)))
+                val, dval = apcube.get_aperture()
+                spec, dspec = apcube.get_spectrum()
+                good = np.isfinite(spec)
+                row = {'xwidth': width, 'freqwidth': freqwidth,
+                       'apertureerror': float(abs(table['linelum'][i] - val) / dval),
+                       'spectrumerror': float(np.max(np.abs(table['spectrum'][i] - spec)[good] / dspec[good]))}
+
+                # (filtered restacks at smaller apertures would have smaller filter regions)
+                if case == 'unfiltered' or (width == max(spacewidths) and freqwidth == max(casefreqwidths)):
+                    stackparams = params.copy()
+                    stackparams.xwidth = stackparams.ywidth = width
+                    stackparams.freqwidth = freqwidth
+                    stackparams.sweepxwidths = stackparams.sweepywidths = stackparams.sweepfreqwidths = False
+                    with warnings.catch_warnings():
+                        warnings.simplefilter('ignore')
+                        start = time.perf_counter()
+                        restack = field_stack(comap, sweptcat, stackparams, field=1)
+                        caseout['restackseconds'] += time.perf_counter() - start
+                    row['restacknobj'] = int(restack.ncutouts)
+                    row['restackerror'] = float(abs(table['linelum'][i] - restack.linelum) / restack.dlinelum)
+                rows.append(row)
+
+            caseout['apertures'] = rows
+            caseout['passed'] = bool(max(max(row['apertureerror'], row['spectrumerror'], row.get('restackerror', 0.))
+                                         for row in rows) < tol and caseout['ownerror'] < tol
+                                     and caseout['ownnobj'] == caseout['nobj']
+                                     and all(row.get('restacknobj', caseout['sweepnobj']) == caseout['sweepnobj']
+                                             for row in rows))
+            outdict[case] = caseout
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    outdict['passed'] = all(outdict[case]['passed'] for case in ['unfiltered', 'filtered'])
+
+    if verbose:
+        for case in ['unfiltered', 'filtered']:
+            caseout = outdict[case]
+            print(case + ':')
+            for row in caseout['apertures']:
+                restackstr = ''
+                if 'restackerror' in row:
+                    restackstr = ', vs restack of {} objects {:.1e}'.format(row['restacknobj'], row['restackerror'])
+                print('{0}x{0}x{1}: table vs cubelet {2:.1e} (spectrum {3:.1e}){4}'.format(
+                      row['xwidth'], row['freqwidth'], row['apertureerror'], row['spectrumerror'], restackstr))
+            print('stack of {} objects (vs {} with no sweep, difference {:.1e}), swept on {}'.format(
+                  caseout['nobj'], caseout['ownnobj'], caseout['ownerror'], caseout['sweepnobj']))
+            print('one swept stack {:.2f} s, restacks {:.2f} s'.format(caseout['sweepseconds'],
+                                                                       caseout['restackseconds']))
+    if not outdict['passed']:
+        warnings.warn('aperture sweep differs from get_aperture (or changes the stack) by more than {}'.format(tol),
+                      RuntimeWarning)
+
+    return outdict
+
+def physical_spacing_check(ncheck=3, nobj=300, npix=120, nchan=64, goalres=1., seed=0, maxshift=0.25,
+                           mincorr=0.95, maxnoiseerror=0.1, workdir=None, verbose=True):
+    """
+    put the first ncheck usable cutouts of a synthetic field through both versions of
+    physical_spacing (the spectral-cube one and the precomputed operators, psfast) with
+    their contents replaced by test fields. ramps along each axis give the input position
+    each version puts at the centre of the output (should agree to maxshift pixels). white
+    noise summed over the stacking aperture around every output voxel should correlate
+    between the versions above mincorr, with the same scatter to maxnoiseerror (fractional),
+    and the propagated rms of the fast version should match the actual scatter of the noise
+    put through it to maxnoiseerror. the voxel-by-voxel correlation is given too, but not
+    tested -- the spectral-cube version samples its resampling kernel, so its response
+    changes with sub-pixel position. a warning is given if anything's out of tolerance;
+    returns a dict
+    """
+    from scipy.ndimage import uniform_filter, binary_erosion
+
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='lim_stacker_physicalspacing_')
+
+    rng = np.random.default_rng(seed)
+    rows = []
+    try:
+        mapfiles, catfile = synthetic_fields(os.path.join(workdir, 'data'), nobj=nobj, nfields=1,
+                                             npix=npix, nchan=nchan, seed=seed)
+        params = benchmark_params(os.path.join(workdir, 'output'))
+        params.goalres = goalres * u.Mpc
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            maplist, catlist = setup(mapfiles, catfile, params)
+        comap, galcat = maplist[0], catlist[0]
+        physical_spacing_setup(comap, params)
+        aperture = (params.freqwidth, params.ywidth, params.xwidth)
+
+        for i in range(galcat.nobj):
+            if len(rows) == ncheck:
+                break
+            cutout = single_cutout(i, galcat, comap, params)
+            if cutout is None:
+                continue
+            nf, ny, nx = cutout.cubestack.shape
+            fgrid, ygrid, xgrid = np.meshgrid(np.arange(nf), np.arange(ny), np.arange(nx), indexing='ij')
+            fields = {'x': xgrid.astype(float), 'y': ygrid.astype(float), 'f': fgrid.astype(float),
+                      'noise': rng.normal(size=(nf, ny, nx))}
+
+            outcubes = {}
+            seconds = {}
+            for psfast in [False, True]:
+                runparams = params.copy()
+                runparams.psfast = psfast
+                start = time.perf_counter()
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    for (name, field) in fields.items():
+                        testcutout = cutout.copy()
+                        testcutout.cubestack = field
+                        testcutout.cubestackrms = np.ones(field.shape)
+                        outcubes[(name, psfast)] = physical_spacing(testcutout, comap, runparams)
+                seconds[psfast] = time.perf_counter() - start
+
+            centre = (params.goalfsize // 2, params.goalxsize // 2, params.goalxsize // 2)
+            row = {'idx': int(i), 'oldseconds': seconds[False], 'fastseconds': seconds[True]}
+            for axis in ['x', 'y', 'f']:
+                row[axis + 'shift'] = float(outcubes[(axis, True)].cubestack[centre]
+                                            - outcubes[(axis, False)].cubestack[centre])
+
+            old, new = outcubes[('noise', False)].cubestack, outcubes[('noise', True)].cubestack
+            good = np.isfinite(old) & np.isfinite(new)
+            row['voxelcorr'] = float(np.corrcoef(old[good], new[good])[0, 1])
+            oldap = uniform_filter(np.where(good, old, 0.), aperture)
+            newap = uniform_filter(np.where(good, new, 0.), aperture)
+            good = binary_erosion(good, np.ones(aperture))
+            row['aperturecorr'] = float(np.corrcoef(oldap[good], newap[good])[0, 1])
+            row['aperturenoiseerror'] = float(np.std(newap[good]) / np.std(oldap[good]) - 1)
+            row['rmserror'] = float(np.nanmedian(outcubes[('noise', True)].cubestackrms) / np.nanstd(new) - 1)
+            rows.append(row)
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    outdict = {'cutouts': rows}
+    outdict['passed'] = bool(len(rows) > 0 and all(
+        max(abs(row['xshift']), abs(row['yshift']), abs(row['fshift'])) < maxshift
+        and row['aperturecorr'] > mincorr
+        and max(abs(row['aperturenoiseerror']), abs(row['rmserror'])) < maxnoiseerror for row in rows))
+
+    if verbose:
+        for row in rows:
+            print('object {}: centre shift x {:+.2f} y {:+.2f} f {:+.2f} px; aperture correlation {:.3f}, '
+                  'noise {:+.3f} (voxels {:.3f}); rms error {:+.3f}; {:.2f} s vs {:.3f} s'.format(
+                  row['idx'], row['xshift'], row['yshift'], row['fshift'], row['aperturecorr'],
+                  row['aperturenoiseerror'], row['voxelcorr'], row['rmserror'], row['oldseconds'],
+                  row['fastseconds']))
+    if not outdict['passed']:
+        warnings.warn('the two versions of physical_spacing differ by more than the tolerances', RuntimeWarning)
+
+    return outdict
+
+def batch_filter_check(ncheck=100, nobj=300, npix=120, nchan=64, seed=0, fitmasknbeams=(1, 2), tol=1e-8,
+                       workdir=None, verbose=True):
+    """
+    put the first ncheck usable (unfiltered) cutouts of a synthetic field through each of
+    the batched cutout filters and through the per-cutout versions one by one (the
+    low-mode filter for each of the fitmasknbeams). the same cutouts should pass, and the
+    filtered cubes should agree to tol (as a fraction of the rms). a warning is given if
+    not; returns a dict
+    """
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='lim_stacker_batchfilter_')
+
+    try:
+        mapfiles, catfile = synthetic_fields(os.path.join(workdir, 'data'), nobj=nobj, nfields=1,
+                                             npix=npix, nchan=nchan, seed=seed)
+        params = benchmark_params(os.path.join(workdir, 'output'))
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            maplist, catlist = setup(mapfiles, catfile, params)
+        comap, galcat = maplist[0], catlist[0]
+
+        cutouts = []
+        for i in range(galcat.nobj):
+            if len(cutouts) == ncheck:
+                break
+            cutout = single_cutout(i, galcat, comap, params)
+            if cutout is not None:
+                # (copies, so each cutout doesn't keep its padded map around)
+                cutout.cubestack, cutout.cubestackrms = cutout.cubestack.copy(), cutout.cubestackrms.copy()
+                cutouts.append(cutout)
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    cubes = np.stack([cutout.cubestack for cutout in cutouts])
+    rmss = np.stack([cutout.cubestackrms for cutout in cutouts])
+    beamidx = {axis: np.array([np.array(getattr(cutout, axis + 'idx')) - getattr(cutout, 'space' + axis + 'idx')[0]
+                               for cutout in cutouts]) for axis in ['x', 'y']}
+
+    def compare(name, nmask, singles, batchcubes, good, seconds):
+        singlegood = np.array([single is not None for single in singles])
+        errors = [np.nanmax(np.abs(single.cubestack - batchcube) / rms)
+                  for (single, batchcube, rms, ok) in zip(singles, batchcubes, rmss, good) if single is not None and ok]
+        return {'filter': name, 'fitmasknbeams': nmask, 'ncutouts': len(cutouts),
+                'npassed': int(np.sum(singlegood)), 'samepassed': bool(np.all(singlegood == good)),
+                'error': float(max(errors, default=0.)), 'singleseconds': seconds[0], 'batchseconds': seconds[1]}
+
+    rows = []
+    for nmask in fitmasknbeams:
+        runparams = params.copy()
+        runparams.fitmasknbeams = nmask
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            start = time.perf_counter()
+            singles = [remove_cutout_lowmodes(cutout.copy(), runparams) for cutout in cutouts]
+            mid = time.perf_counter()
+            batchcubes, _, _, good = remove_lowmodes_batch(cubes, rmss, runparams, beamidx['x'], beamidx['y'])
+            seconds = (mid - start, time.perf_counter() - mid)
+        rows.append(compare('lowmode', nmask, singles, batchcubes, good, seconds))
+
+    # the mean filters (the cutouts all have the aperture in the centre)
+    for name in ['chanmean', 'spectralmean']:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            start = time.perf_counter()
+            if name == 'chanmean':
+                singles = [remove_cutout_chanmean(cutout.copy(), params) for cutout in cutouts]
+                mid = time.perf_counter()
+                batchcubes, _, good = remove_chanmean_batch(cubes, rmss, params)
+            else:
+                singles = [remove_cutout_spectral_mean(cutout.copy(), params) for cutout in cutouts]
+                mid = time.perf_counter()
+                batchcubes, _ = remove_spectral_mean_batch(cubes, rmss, params)
+                good = np.ones(len(cutouts), dtype=bool)
+            seconds = (mid - start, time.perf_counter() - mid)
+        rows.append(compare(name, params.fitmasknbeams, singles, batchcubes, good, seconds))
+
+    outdict = {'filters': rows}
+    outdict['passed'] = bool(all(row['samepassed'] and row['error'] < tol for row in rows))
+
+    if verbose:
+        for row in rows:
+            print('{} (fitmasknbeams {}): {} of {} cutouts pass{}, max difference {:.1e} of the rms; '
+                  '{:.3f} s one by one vs {:.3f} s batched'.format(
+                  row['filter'], row['fitmasknbeams'], row['npassed'], row['ncutouts'],
+                  '' if row['samepassed'] else ' (not the same ones batched)', row['error'],
+                  row['singleseconds'], row['batchseconds']))
+    if not outdict['passed']:
+        warnings.warn('batched cutout filters differ from the per-cutout ones by more than {}'.format(tol),
+                      RuntimeWarning)
+
+    return outdict
+
+def time_benchmark(func, data, params, config, nrep=3):
+    """
+    run func(data, params.copy(), config) nrep times. returns a dict with the wall time of
+    every repeat (and their min/median), plus whatever func returned from the last one;
+    if it fails the error is recorded instead
+    """
+    times = []
+    outdict = {}
+    try:
+        for i in range(nrep):
+            runparams = params.copy()
+            start = time.perf_counter()
+            outdict = func(data, runparams, config)
+            times.append(time.perf_counter() - start)
+    except Exception as err:
+        return {'error': '{}: {}'.format(type(err).__name__, err), 'times': times}
+
+    outdict = dict(outdict)
+    outdict['times'] = times
+    outdict['min'] = float(np.min(times))
+    outdict['median'] = float(np.median(times))
+    return outdict
+
+def _git_commit(path):
+    """ (commit hash, dirty flag) of the git checkout at path, or (None, None) """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=path, capture_output=True,
+                                text=True, timeout=30).stdout.strip() or None
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=path,
+                               capture_output=True, text=True, timeout=30).stdout.strip() != ''
+    except Exception:
+        return None, None
+    return commit, dirty
+
+def benchmark_metadata(config):
+    """ where and on what a benchmark run happened, so results can be compared later """
+    import astropy
+    import scipy
+    commit, dirty = _git_commit(os.path.dirname(os.path.abspath(__file__)))
+    return {'commit': commit, 'dirty': dirty,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'scipy': scipy.__version__, 'astropy': astropy.__version__,
+            'platform': platform.platform(), 'ncpu': os.cpu_count(),
+            'config': config}
+
+def run_benchmarks(outfile=None, names=None, nobj=300, npix=120, nchan=64, nfit=30, nrep=3,
+                   niter=3, nthreads=2, goalres=1., pspacefac=5, seed=0, workdir=None,
+                   paramfile=None, verbose=True):
+    """
+    time the stacking hot paths on deterministic synthetic data (three COMAP-shaped
+    fields with nobj HETDEX-like objects each -- see synthetic_fields). names picks
+    which of benchmark_names to run (all of them by default). the PRF fitting, adaptive
+    photometry and physical spacing stacks only use the first nfit objects of field 1,
+    and the bootstraps do niter realizations. every benchmark is repeated nrep times
+    results go into a dict (and outfile as JSON if passed) with the run metadata under
+    'meta' and the times under 'results'. the synthetic data and outputs go into
+    workdir (a temporary directory, deleted afterwards, if not passed)
+    """
+    if names is None:
+        names = benchmark_names
+    config = {'nobj': nobj, 'npix': npix, 'nchan': nchan, 'nfit': nfit, 'nrep': nrep,
+              'niter': niter, 'nthreads': nthreads, 'goalres': goalres, 'pspacefac': pspacefac,
+              'seed': seed, 'paramfile': paramfile}
+
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='lim_stacker_benchmark_')
+
+    try:
+        start = time.perf_counter()
+        mapfiles, catfile = synthetic_fields(os.path.join(workdir, 'data'), nobj=nobj, npix=npix,
+                                             nchan=nchan, seed=seed)
+        data = {'mapfiles': mapfiles, 'catfile': catfile}
+        if verbose:
+            print('made synthetic data in {:.1f} s'.format(time.perf_counter() - start))
+
+        params = benchmark_params(os.path.join(workdir, 'output'), paramfile=paramfile)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            data['maplist'], data['catlist'] = setup(mapfiles, catfile, params)
+        data['fitcat'] = data['catlist'][0].subset(np.arange(min(nfit, data['catlist'][0].nobj)),
+                                                   in_place=False)
+        data['singlemap'] = single_precision_map(data['maplist'][0])
+
+        results = {}
+        for name in names:
+            func = globals()['_bench_' + name]
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                results[name] = time_benchmark(func, data, params, config, nrep=nrep)
+            if verbose:
+                if 'error' in results[name]:
+                    print('{:<22s} failed -- {}'.format(name, results[name]['error']))
+                else:
+                    print('{:<22s} {:9.3f} s (min of {})'.format(name, results[name]['min'], nrep))
+
+        outdict = {'meta': benchmark_metadata(config), 'results': results}
+        outdict['meta']['peakmemory'] = peak_memory()
+        outdict['meta']['childpeakmemory'] = peak_memory(children=True)
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if outfile:
+        with open(outfile, 'w') as f:
+            json.dump(outdict, f, indent=1)
+
+    return outdict
+
+def load_benchmarks(benchfile):
+    """ read a JSON file written by run_benchmarks """
+    with open(benchfile) as f:
+        return json.load(f)
+
+def compare_benchmarks(oldfile, newfile, stat='min'):
+    """
+    print the benchmark times in newfile against those in oldfile (ratios above 1 are
+    slowdowns). either can be a filename or a run_benchmarks output dict. returns a dict
+    of name: new/old ratio
+    """
+    old = load_benchmarks(oldfile) if isinstance(oldfile, str) else oldfile
+    new = load_benchmarks(newfile) if isinstance(newfile, str) else newfile
+
+    print('{:<22s} {:>10s} {:>10s} {:>8s}'.format('', str(old['meta']['commit'])[:10],
+                                                  str(new['meta']['commit'])[:10], 'ratio'))
+    ratios = {}
+    for name in new['results']:
+        newres = new['results'][name]
+        oldres = old['results'].get(name, {})
+        if stat not in newres or stat not in oldres:
+            print('{:<22s} {:>10s} {:>10s}'.format(name, 'failed' if 'error' in oldres else '-',
+                                                  'failed' if 'error' in newres else '-'))
+            continue
+        ratios[name] = newres[stat] / oldres[stat]
+        print('{:<22s} {:10.3f} {:10.3f} {:8.2f}'.format(name, oldres[stat], newres[stat], ratios[name]))
+
+    return ratios
+
+
+""" SCALING """
+def scaling_study(outfile=None, nthreads=(1, 2, 4), nobjs=(300, 1000), npixs=(60, 120), nchan=64,
+                  nrep=1, seed=0, workdir=None, plotdir=None, paramfile=None, verbose=True):
+    """
+    run the same synthetic single-field stack through field_stack and then through
+    parallel_field_stack with each of nthreads, for every combination of catalogue size
+    (nobjs objects around the field) and map size (npixs pixels on a side). for each run
+    records the wall time (min of nrep), throughput in cutouts/s, speed-up and
+    efficiency against the serial stack, the peak RSS of each worker process and of the
+    parent, and the bytes each worker sent back through the queue
+    returns a list of row dicts (one per run) and saves them to outfile (.json or .csv)
+    if passed. scaling plots go into plotdir if passed
+    """
+    config = {'nthreads': list(nthreads), 'nobjs': list(nobjs), 'npixs': list(npixs),
+              'nchan': nchan, 'nrep': nrep, 'seed': seed, 'paramfile': paramfile}
+
+    cleanup = workdir is None
+    if cleanup:
+        workdir = tempfile.mkdtemp(prefix='lim_stacker_scaling_')
+
+    rows = []
+    try:
+        for npix in npixs:
+            for nobj in nobjs:
+                datapath = os.path.join(workdir, 'data_{}_{}'.format(npix, nobj))
+                mapfiles, catfile = synthetic_fields(datapath, nobj=nobj, nfields=1, npix=npix,
+                                                     nchan=nchan, seed=seed)
+                params = benchmark_params(os.path.join(workdir, 'output'), paramfile=paramfile)
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    maplist, catlist = setup(mapfiles, catfile, params)
+                comap, galcat = maplist[0], catlist[0]
+
+                # warm-up run (builds the cached nan tables etc. on the map)
+                with warnings.catch_warnings():
+                    warnings.simplefilter('ignore')
+                    field_stack(comap, galcat, params.copy(), field=1)
+
+                serialtime = None
+                for nthread in [0] + list(nthreads):
+                    times = []
+                    for i in range(nrep):
+                        runparams = params.copy()
+                        runparams.nthreads = nthread
+                        with warnings.catch_warnings():
+                            warnings.simplefilter('ignore')
+                            start = time.perf_counter()
+                            if nthread == 0:
+                                cube = field_stack(comap, galcat, runparams, field=1)
+                            else:
+                                cube = parallel_field_stack(comap, galcat, runparams, field=1)
+                            times.append(time.perf_counter() - start)
+
+                    row = {'npix': npix, 'nobj': galcat.nobj, 'nthreads': nthread,
+                           'mode': 'serial' if nthread == 0 else 'parallel',
+                           'seconds': float(np.min(times)),
+                           'ncutouts': int(cube.ncutouts) if cube else 0,
+                           'parentpeakmemory': peak_memory()}
+                    row['throughput'] = row['ncutouts'] / row['seconds']
+                    if nthread == 0:
+                        serialtime = row['seconds']
+                    row['speedup'] = serialtime / row['seconds']
+                    row['efficiency'] = row['speedup'] / max(nthread, 1)
+
+                    workerinfo = getattr(cube, 'workerinfo', []) if cube else []
+                    if workerinfo:
+                        row['workerpeakmemory'] = float(np.max([info['peakmemory'] for info in workerinfo]))
+                        row['workerseconds'] = float(np.max([info['seconds'] for info in workerinfo]))
+                        row['transferbytes'] = int(np.sum([info['transferbytes'] for info in workerinfo]))
+                        row['transferbytesperworker'] = float(np.mean([info['transferbytes'] for info in workerinfo]))
+                    else:
+                        row['workerpeakmemory'] = np.nan
+                        row['workerseconds'] = np.nan
+                        row['transferbytes'] = 0
+                        row['transferbytesperworker'] = np.nan
+                    rows.append(row)
+
+                    if verbose:
+                        print('npix {:4d} nobj {:6d} {:>8s} {:2d}: {:8.2f} s {:8.1f} cutouts/s '
+                              'speed-up {:5.2f} efficiency {:5.2f} worker RSS {:7.0f} MB sent {:9.0f} kB'.format(
+                              npix, row['nobj'], row['mode'], nthread, row['seconds'], row['throughput'],
+                              row['speedup'], row['efficiency'], row['workerpeakmemory'],
+                              row['transferbytes'] / 1024))
+    finally:
+        if cleanup:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if outfile:
+        if outfile[-4:] == '.csv':
+            dict_saver(rows, outfile)
+        else:
+            with open(outfile, 'w') as f:
+                json.dump({'meta': benchmark_metadata(config), 'rows': rows}, f, indent=1)
+
+    if plotdir:
+        plot_scaling(rows, plotdir)
+
+    return rows
+
+def plot_scaling(rows, plotdir):
+    """
+    speed-up, throughput, worker peak memory and queue transfer volume against number of
+    processes, one line per (map size, catalogue size), saved as scaling.png in plotdir
+    """
+    os.makedirs(plotdir, exist_ok=True)
+
+    fig, axs = plt.subplots(2, 2, figsize=(10, 8))
+    cases = sorted(set([(row['npix'], row['nobj']) for row in rows]))
+    for (npix, nobj) in cases:
+        caserows = [row for row in rows if row['npix'] == npix and row['nobj'] == nobj
+                    and row['mode'] == 'parallel']
+        nthreads = [row['nthreads'] for row in caserows]
+        label = '{0}x{0} pix, {1} obj'.format(npix, nobj)
+        axs[0,0].plot(nthreads, [row['speedup'] for row in caserows], 'o-', label=label)
+        axs[0,1].plot(nthreads, [row['throughput'] for row in caserows], 'o-', label=label)
+        axs[1,0].plot(nthreads, [row['workerpeakmemory'] for row in caserows], 'o-', label=label)
+        axs[1,1].plot(nthreads, [row['transferbytes'] / 1024**2 for row in caserows], 'o-', label=label)
+
+    allthreads = sorted(set([row['nthreads'] for row in rows if row['mode'] == 'parallel']))
+    axs[0,0].plot(allthreads, allthreads, 'k:', label='ideal')
+    for ax, ylabel in zip(axs.flatten(), ['Speed-up vs serial', 'Throughput (cutouts/s)',
+                                          'Peak worker RSS (MB)', 'Sent through queue (MB)']):
+        ax.set_xlabel('Number of processes')
+        ax.set_ylabel(ylabel)
+    axs[0,0].legend(fontsize='small')
+
+    fig.tight_layout()
+    fig.savefig(os.path.join(plotdir, 'scaling.png'))
+    plt.close(fig)
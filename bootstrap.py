@@ -3,10 +3,13 @@ from .tools import *
 from .stack import *
 
 import os
+import sys
+import json
+import warnings
 import numpy as np
 
-from matplotlib.patches import Rectangle
-from mpl_toolkits.axes_grid1 import make_axes_locatable
+Rectangle = lazy_import('matplotlib.patches', 'Rectangle')
+make_axes_locatable = lazy_import('mpl_toolkits.axes_grid1', 'make_axes_locatable')
 
 from astropy.coordinates import SkyCoord
 from astropy.cosmology import FlatLambdaCDM
@@ -15,8 +18,9 @@ import astropy.constants as const
 from astropy.convolution import convolve, Gaussian2DKernel, Tophat2DKernel
 from astropy.coordinates import SkyCoord
 
-from scipy.optimize import curve_fit
-from scipy.stats import norm
+curve_fit = lazy_import('scipy.optimize', 'curve_fit')
+norm = lazy_import('scipy.stats', 'norm')
+sparse = lazy_import('scipy.sparse')
 
 # ignore divide by zero warnings
 np.seterr(divide='ignore', invalid='ignore')
@@ -324,24 +328,149 @@ def cat_rand_offset_random(mapinst, catinst, params, offrng=None):
 
 
 
-def offset_bootstrap(niter, maplist, catlist, params):
+def bootstrap_stream(seed, streamid):
+    """
+    independent random generator for realization streamid of a bootstrap seeded with seed
+    (the same as np.random.SeedSequence(seed).spawn(n)[streamid], so any realization can
+    be regenerated on its own)
+    """
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=(streamid,)))
+
+# parameters that don't change what a realization gives (output, printing and parallelism)
+checkpoint_ignore_params = ['verbose', 'savedata', 'saveplots', 'savefields', 'plotspace', 'plotfreq',
+                            'plotcubelet', 'deferplots', 'returncutlist', 'parallelize', 'nthreads',
+                            'profile', 'resultsformat', 'savepath']
+
+def checkpoint_settings(params, seed, colnames):
+    """
+    what the realizations in a checkpoint log depend on: the bootstrap and rotation seeds,
+    the columns, and every stack parameter in param_schema apart from
+    checkpoint_ignore_params (as strings, so they compare exactly)
+    """
+    settings = {'seed': str(seed), 'columns': list(colnames)}
+    for key in sorted(param_schema):
+        if key not in checkpoint_ignore_params:
+            settings[key] = str(getattr(params, key, None))
+    return settings
+
+def checkpoint_read(logfile, ncols):
+    """
+    read a checkpoint log back as a dict of stream id: array of values, and the settings
+    it was written with (None if it has no header). a last line that was only partly
+    written when the run died is cut off the file (so appends can continue cleanly) and
+    ignored
+    """
+    done = {}
+    if not os.path.exists(logfile):
+        return done, None
+
+    with open(logfile, 'rb+') as f:
+        text = f.read()
+        if text and not text.endswith(b'\n'):
+            f.truncate(text.rfind(b'\n') + 1)
+            text = text[:text.rfind(b'\n') + 1]
+
+    settings = None
+    lines = text.decode().splitlines()
+    if lines and lines[0].startswith('#'):
+        settings = json.loads(lines.pop(0)[1:])
+
+    for line in lines[1:]:
+        row = line.split(',')
+        if len(row) != ncols + 1:
+            continue
+        done[int(row[0])] = np.array([float(val) for val in row[1:]])
+
+    return done, settings
+
+def checkpoint_append(logfile, streamid, vals):
+    """ append one finished realization to a checkpoint log, flushed to disk right away """
+    with open(logfile, 'a') as f:
+        f.write(','.join([str(int(streamid))] + [repr(float(val)) for val in vals]) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def checkpointed_realizations(niter, realize, params, colnames, logfile=None, resume=False,
+                              seed=None, verbose=False, printstep=10):
+    """
+    run realize(streamid, rng) for every streamid in range(niter), each on its own random
+    stream (bootstrap_stream(seed, streamid); the rotation rng in params is also set to its
+    own stream for each one, which field_stack carries on through every field, and put back
+    afterwards). realize should return one value per
+    entry in colnames. every finished realization is appended to the checkpoint log logfile
+    as it's done, under a header with the settings of the run (checkpoint_settings). with
+    resume, realizations already in the log are skipped, so a crashed run can be picked up
+    and gives exactly what an uninterrupted one would -- a log written with different
+    settings raises a ValueError instead. returns an (niter, ncols) array in stream order
+    """
+    ncols = len(colnames)
+    rotate = getattr(params, 'rotate', False)
+
+    if logfile:
+        settings = checkpoint_settings(params, seed, colnames)
+        done, logsettings = checkpoint_read(logfile, ncols) if resume else ({}, None)
+        if resume and os.path.exists(logfile) and logsettings != settings:
+            if logsettings is None:
+                raise ValueError("can't resume from {}: it has no record of the settings it was "
+                                 "run with".format(logfile))
+            changed = sorted(key for key in set(settings) | set(logsettings)
+                             if settings.get(key) != logsettings.get(key))
+            raise ValueError("can't resume from {}: it was run with different {}".format(
+                             logfile, ', '.join(changed)))
+        if not resume or not os.path.exists(logfile):
+            with open(logfile, 'w') as f:
+                f.write('#' + json.dumps(settings, sort_keys=True) + '\n')
+                f.write(','.join(['stream'] + list(colnames)) + '\n')
+        if verbose and done:
+            print('resuming: {} of {} realizations already done'.format(len(done), niter))
+    else:
+        done = {}
+
+    # the caller's rotation rng, to put back at the end
+    if rotate:
+        userrng = params.rng if params.rng_set else None
+
+    try:
+        for i in range(niter):
+            if i in done:
+                continue
+
+            if rotate:
+                params.rng = bootstrap_stream(params.rotseed, i)
+
+            vals = np.array(realize(i, bootstrap_stream(seed, i)), dtype=float).flatten()
+            done[i] = vals
+
+            if logfile:
+                checkpoint_append(logfile, i, vals)
+
+            if verbose and i % printstep == 0:
+                print('    done run '+str(i)+' of '+str(niter))
+
+            # just in case (without importing matplotlib if nothing's been plotted)
+            if 'matplotlib.pyplot' in sys.modules:
+                plt.close('all')
+    finally:
+        if rotate:
+            params.rng = userrng
+
+    return np.stack([done[i] for i in range(niter)])
+
+def offset_bootstrap(niter, maplist, catlist, params, resume=False):
+    """
+    stack on niter randomly offset versions of the catalogue. each realization has its own
+    random stream (from params.bootstrapseed) and, if params.itersave, is checkpointed to
+    params.itersavefile as it finishes -- pass resume=True to pick up a run that died
+    """
 
     if params.verbose:
         print('starting actual stack for reference')
 
-    # initialize the output file
-    with open(params.itersavefile, 'w') as csvfile:
-        w = csv.writer(csvfile)
-        w.writerow(['T', 'rms'])
-
     # run the actual stack purely to see how many cutouts you're going to need for each bootstrap
-    actcutlist, actim, actspec, actcatidx, actcube, actcuberms = stacker(maplist, catlist, params)
+    actcube = stacker(maplist, catlist, params)
 
     # set the goal numbers of cutouts
-    params.goalnumcutouts = ([len(catidx) for catidx in actcatidx])
-
-    # set up an rng for the offsets
-    offrng = np.random.default_rng(params.bootstrapseed)
+    params.goalnumcutouts = ([len(catidx) for catidx in actcube.fieldcatidx])
 
     # play with the output that's printed so you don't get every cutout for every stack
     if params.verbose:
@@ -351,32 +480,349 @@ def offset_bootstrap(niter, maplist, catlist, params):
     else:
         params.bootverbose = False
 
-    outarrs = []
-    for i in range(niter):
+    logfile = params.itersavefile if params.itersave else None
+    realize = lambda i, offrng: offset_and_stack(maplist, catlist, params, offrng)
+    outarrs = checkpointed_realizations(niter, realize, params, ['T', 'rms'], logfile=logfile,
+                                        resume=resume, seed=params.bootstrapseed,
+                                        verbose=params.bootverbose, printstep=params.itersavestep)
 
-        # randomly offset each field's catalogue and stack it
-        outarr = offset_and_stack(maplist, catlist, params, offrng)
-        outarrs.append(outarr)
+    # save the final output
+    if getattr(params, 'resultsformat', 'csv') == 'hdf5':
+        store_write_rows(params.resultsfile, 'realizations/offset_bootstrap',
+                         {'stream': np.arange(niter), 'T': outarrs[:,0], 'rms': outarrs[:,1]})
+    else:
+        np.savez(params.nitersavefile, T=outarrs[:,0], rms=outarrs[:,1])
 
-        if params.itersave:
-            if i % params.itersavestep == 0:
-                with open(params.itersavefile, 'a') as csvfile:
-                    w = csv.writer(csvfile)
-                    w.writerow(outarr)
+    return outarrs
 
-        if params.bootverbose:
-            if i % params.itersavestep == 0:
-                print('    done run '+str(i)+' of '+str(niter))
+""" LOOKUP NULLS """
+# random catalogue generators the lookup bootstrap can use, and the offset ones a single
+# whole-catalogue lag can stand in for (with the largest offset each draws, in voxels)
+lookup_randomizers = {'offset': cat_rand_offset, 'offset_freq': cat_rand_offset_freq,
+                      'offset_space': cat_rand_offset_space, 'shuffle': cat_rand_offset_shuffle,
+                      'uniform': cat_rand_offset_random}
+shared_offset_sizes = {'offset': 10, 'offset_freq': 5, 'offset_space': 5}
+
+def aperture_box_sums(comap, params):
+    """
+    the weighted map and weights (linelum_weight_maps) summed over the spatial aperture
+    centred on each voxel, one channel at a time. the stacked aperture value of any set
+    of objects only needs these at the objects' voxels
+    """
+    swv = np.lib.stride_tricks.sliding_window_view
+    dy, dx = params.ywidth // 2, params.xwidth // 2
 
-        # just in case
-        plt.close('all')
+    boxsums = []
+    for vals in linelum_weight_maps(comap, params):
+        vals = np.pad(vals, ((0, 0), (dy, dy), (dx, dx)))
+        boxsums.append(swv(vals, (params.ywidth, params.xwidth), axis=(1, 2)).sum(axis=(-2, -1)))
+    return boxsums
+
+def lookup_aperture_sums(boxsums, fidx, yidx, xidx, freqwidth):
+    """
+    per-channel sums of the aperture box sums over objects centred on voxels
+    (fidx, yidx, xidx) -- the numerator and denominator of every channel of their stack
+    """
+    chans = fidx[:, None] + np.arange(freqwidth)[None, :] - freqwidth // 2
+    return [np.sum(box[chans, yidx[:, None], xidx[:, None]], axis=0) for box in boxsums]
+
+def aperture_from_sums(valsum, weightsum, params):
+    """
+    the stacked aperture value and rms (as cubelet.get_aperture gives them) from the
+    per-channel (last axis) sums of weighted values and weights
+    """
+    area = params.xwidth * params.ywidth
+    spec = area * valsum / weightsum
+    dspec = area * np.sqrt(1 / weightsum)
+    return np.nansum(spec, axis=-1), np.sqrt(np.nansum(dspec ** 2, axis=-1))
+
+def offset_lookup_incompatible(comap, params):
+    """
+    why (if at all) stacks on this map can't be replaced by aperture lookups. like
+    fft_stack_incompatible, except that random rotations are fine for square apertures
+    (they leave the aperture value alone) and the nulls can't be PRF amplitudes
+    """
+    reasons = fft_stack_incompatible(comap, params)
+    if params.xwidth == params.ywidth and 'rotate' in reasons:
+        reasons.remove('rotate')
+    if getattr(params, 'prf_fitting', False) and 'prf_fitting' not in reasons:
+        reasons.append('prf_fitting')
+    return reasons
+
+def offset_lookup(maplist, catlist, params, offrng, boxsums, goalnobjs=None, method='offset'):
+    """
+    one offset_and_stack realization done as lookups: each field's catalogue is randomized
+    the same way (drawing the same random numbers), the objects that would make it into
+    the stack are found with cutout_prefilter (the first goalnobjs[j] of them in field j,
+    if given), and their aperture sums are read out of boxsums. returns [T, rms]
+    """
+    randomize = lookup_randomizers[method]
+
+    valsum, weightsum = 0., 0.
+    for j in range(len(maplist)):
+        goalnobj = goalnobjs[j] if goalnobjs is not None else None
+        if goalnobj == 0:
+            continue
+        offcat = randomize(maplist[j], catlist[j], params, offrng)
+        keep, idxs, _ = cutout_prefilter(offcat, maplist[j], params, voxels=True)
+        stackidx = np.where(keep)[0][:goalnobj]
+        sums = lookup_aperture_sums(boxsums[j], *[idx[stackidx] for idx in idxs], params.freqwidth)
+        valsum, weightsum = valsum + sums[0], weightsum + sums[1]
+
+    return np.array(aperture_from_sums(valsum, weightsum, params))
+
+def offset_lag_cube(maplist, catlist, params, maxoffset=10, boxsums=None):
+    """
+    the stacked aperture value (and rms) of the catalogue with every object shifted by
+    the same whole-voxel offset (dfreq, ddec, dra), for every offset up to maxoffset voxels
+    along each axis at once: element [dfreq+maxoffset, ddec+maxoffset, dra+maxoffset]. the
+    objects are the ones that pass cutout_prefilter unshifted, and any part of an aperture
+    shifted off the map just has no weight. one FFT cross-correlation per field
+    """
+    if boxsums is None:
+        boxsums = [aperture_box_sums(mapinst, params) for mapinst in maplist]
+
+    lags = (maxoffset + params.freqwidth // 2, maxoffset, maxoffset)
+    valsum, weightsum, nsum = 0., 0., 0.
+    for (mapinst, catinst, sums) in zip(maplist, catlist, boxsums):
+        counts = catalogue_voxel_counts(catinst, mapinst, params)[0]
+        corrs = fft_correlate(counts, [sums[0], sums[1], (sums[1] > 0) * 1.], lags)
+        valsum, weightsum, nsum = valsum + corrs[0], weightsum + corrs[1], nsum + corrs[2]
+
+    # no object has data at these lags (anything here is FFT rounding)
+    empty = nsum < 0.5
+    valsum, weightsum = np.where(empty, 0., valsum), np.where(empty, 0., weightsum)
+
+    # channel c of the aperture at frequency offset d sits at lag d + c - freqwidth//2
+    swv = np.lib.stride_tricks.sliding_window_view
+    return aperture_from_sums(swv(valsum, params.freqwidth, axis=0),
+                              swv(weightsum, params.freqwidth, axis=0), params)
+
+def shared_offset_lag(offrng, method='offset'):
+    """
+    one whole-voxel (freq, dec, ra) offset for an entire catalogue, drawn from the
+    per-object distribution the matching cat_rand_offset function uses (rounded)
+    """
+    maxoff = shared_offset_sizes[method]
+    naxes = {'offset': 3, 'offset_freq': 1, 'offset_space': 2}[method]
+    offs = np.round(offrng.uniform(1, maxoff, naxes) * np.sign(offrng.uniform(-1, 1, naxes))).astype(int)
+
+    if method == 'offset':
+        return offs[2], offs[1], offs[0]
+    elif method == 'offset_freq':
+        return offs[0], 0, 0
+    return 0, offs[1], offs[0]
+
+def offset_lookup_bootstrap(niter, maplist, catlist, params, method='offset', shared=False,
+                            resume=False):
+    """
+    offset_bootstrap without any stacking: the aperture sums of the maps are computed once
+    and each realization is a vectorised lookup of them at its random catalogue's voxels
+    (offset_lookup), using the same random streams and checkpointing as offset_bootstrap.
+    each null has as many objects as the real stack. method picks the random catalogue
+    (see lookup_randomizers). with shared, every realization shifts the whole catalogue
+    by one offset instead (an offset method only), read out of offset_lag_cube.
+    maps that need full stacks (cutout filters, physical spacing, etc) get offset_bootstrap
+    """
+    reasons = [reason for mapinst in maplist for reason in offset_lookup_incompatible(mapinst, params)]
+    if reasons:
+        warnings.warn("Can't look up offset stacks with {}. running offset_bootstrap instead".format(
+                      ', '.join(sorted(set(reasons)))), RuntimeWarning)
+        return offset_bootstrap(niter, maplist, catlist, params, resume=resume)
+
+    boxsums = [aperture_box_sums(mapinst, params) for mapinst in maplist]
+
+    if shared:
+        maxoff = shared_offset_sizes[method]
+        lagT, lagrms = offset_lag_cube(maplist, catlist, params, maxoffset=maxoff, boxsums=boxsums)
+        def realize(i, offrng):
+            lag = np.array(shared_offset_lag(offrng, method)) + maxoff
+            return [lagT[tuple(lag)], lagrms[tuple(lag)]]
+    else:
+        # the same number of objects as the real stack in each field
+        goalnobjs = [np.count_nonzero(cutout_prefilter(catinst, mapinst, params))
+                     for (mapinst, catinst) in zip(maplist, catlist)]
+        realize = lambda i, offrng: offset_lookup(maplist, catlist, params, offrng, boxsums,
+                                                  goalnobjs=goalnobjs, method=method)
+
+    if params.verbose:
+        print('starting '+str(niter)+' offset lookups')
+
+    logfile = params.itersavefile if params.itersave else None
+    outarrs = checkpointed_realizations(niter, realize, params, ['T', 'rms'], logfile=logfile,
+                                        resume=resume, seed=params.bootstrapseed,
+                                        verbose=params.verbose, printstep=params.itersavestep)
 
     # save the final output
-    outarrs = np.stack(outarrs)
-    np.savez(params.nitersavefile, T=outarrs[:,0], rms=outarrs[:,1])
+    if getattr(params, 'resultsformat', 'csv') == 'hdf5':
+        store_write_rows(params.resultsfile, 'realizations/offset_lookup_bootstrap',
+                         {'stream': np.arange(niter), 'T': outarrs[:,0], 'rms': outarrs[:,1]})
+    else:
+        np.savez(params.nitersavefile, T=outarrs[:,0], rms=outarrs[:,1])
 
     return outarrs
 
+
+""" RESAMPLED ERRORS FROM PER-OBJECT CONTRIBUTIONS """
+def jackknife_regions(store, nregions, method='space'):
+    """
+    label each row of a contribution_store with the jackknife region it's in. 'space'
+    splits every field into nregions patches holding about the same number of objects (a
+    grid of dec strips, each cut up in ra), so there are nregions per field; 'redshift'
+    cuts the whole catalogue into nregions redshift slices of about the same size
+    """
+    def equal_bins(vals, nbins):
+        ranks = np.argsort(np.argsort(vals, kind='stable'), kind='stable')
+        return ranks * nbins // len(vals)
+
+    if method == 'redshift':
+        return equal_bins(store['z'], nregions)
+    elif method != 'space':
+        raise ValueError("jackknife_regions: don't know method '{}'".format(method))
+
+    # as close to a square grid of patches as nregions allows
+    ny = max(n for n in range(1, int(np.sqrt(nregions)) + 1) if nregions % n == 0)
+    nx = nregions // ny
+
+    labels = np.zeros(len(store), dtype=int)
+    for (j, field) in enumerate(np.unique(store['field'])):
+        rows = np.where(store['field'] == field)[0]
+        strips = equal_bins(store['dec'][rows], ny)
+        for strip in range(ny):
+            instrip = rows[strips == strip]
+            if len(instrip) == 0:
+                continue
+            labels[instrip] = j * nregions + strip * nx + equal_bins(store['ra'][instrip], nx)
+    return labels
+
+def contribution_matrix(store, weights=None):
+    """
+    the per-object sums every stack is built from as two (nobj, ncols) matrices (weighted
+    values, weights): the aperture channels followed by the spectral window, with any
+    per-object weights already folded in. a stack over multiplicities m (nreal, nobj) is
+    then just m @ matrix
+    """
+    objweights = np.ones(len(store)) if weights is None else np.asarray(weights, dtype=float)
+    valmat = np.hstack((store['apvalsum'], store['specvalsum'])) * objweights[:, None]
+    weightmat = np.hstack((store['apweightsum'], store['specweightsum'])) * objweights[:, None]
+    return valmat, weightmat
+
+def stacks_from_sums(valsums, weightsums, params, napchans):
+    """
+    aperture values and spectra (nreal and (nreal, nchan) arrays) of stacks from their
+    summed contribution_matrix rows, as contribution_store.stack does them
+    """
+    area = params.xwidth * params.ywidth
+    with np.errstate(divide='ignore', invalid='ignore'):
+        spec = area * valsums / weightsums
+    linelums = np.nansum(spec[:, :napchans], axis=1)
+    return linelums, spec[:, napchans:]
+
+def resampled_covariance(fullstack, realizations, method):
+    """
+    covariance of [aperture value, spectrum] from jackknife or bootstrap realizations of
+    it (an (nreal, 1 + nchan) array). returns the output dict of jackknife_errors
+    """
+    nreal = len(realizations)
+    devs = realizations - np.mean(realizations, axis=0)
+    if method == 'jackknife':
+        cov = (nreal - 1) / nreal * devs.T @ devs
+    else:
+        cov = devs.T @ devs / (nreal - 1)
+
+    return {'linelum': fullstack[0], 'spectrum': fullstack[1:],
+            'dlinelum': np.sqrt(cov[0, 0]), 'dspectrum': np.sqrt(np.diag(cov)[1:]),
+            'linelumcov': cov[0, 0], 'spectrumcov': cov[1:, 1:], 'cov': cov,
+            'linelums': realizations[:, 0], 'spectra': realizations[:, 1:], 'nreal': nreal,
+            'method': method}
+
+def save_resampled_errors(outdict, params, name):
+    """ save the output of jackknife_errors or catalogue_bootstrap_errors with the stack outputs """
+    arrays = {key: val for (key, val) in outdict.items() if key != 'method'}
+    if getattr(params, 'resultsformat', 'csv') == 'hdf5':
+        with store_file(params.resultsfile) as f:
+            if 'errors/' + name in f:
+                del f['errors/' + name]
+            grp = f.require_group('errors/' + name)
+            for (key, val) in arrays.items():
+                grp.create_dataset(key, data=val)
+        return
+    np.savez(params.datasavepath + '/' + name + '_errors.npz', **arrays)
+
+def jackknife_errors(store, params, regions, weights=None, save=False):
+    """
+    delete-one-region jackknife covariance of the stacked aperture value and spectrum from
+    a contribution_store (regions is one label per row, e.g. from jackknife_regions). all
+    the delete-one stacks are the full sums minus one sparse region-membership matrix
+    product, so no stacking is redone. returns a dict with the full-sample linelum and
+    spectrum, their jackknife errors and covariance ('cov' is the joint one of
+    [linelum, spectrum]) and the realizations themselves
+    """
+    valmat, weightmat = contribution_matrix(store, weights=weights)
+    napchans = store['apvalsum'].shape[1]
+
+    labels, regionidx = np.unique(regions, return_inverse=True)
+    membership = sparse.csr_matrix((np.ones(len(regionidx)), (regionidx, np.arange(len(regionidx)))),
+                                   shape=(len(labels), len(regionidx)))
+    totval, totweight = valmat.sum(axis=0), weightmat.sum(axis=0)
+    valsums = totval[None, :] - membership @ valmat
+    weightsums = totweight[None, :] - membership @ weightmat
+
+    fullstack = np.concatenate(stacks_from_sums(totval[None, :], totweight[None, :], params, napchans), axis=None)
+    realizations = np.column_stack(stacks_from_sums(valsums, weightsums, params, napchans))
+
+    outdict = resampled_covariance(fullstack, realizations, 'jackknife')
+    if save:
+        save_resampled_errors(outdict, params, 'jackknife')
+    return outdict
+
+def catalogue_bootstrap_multiplicities(store, streams, seed=None, byfield=True):
+    """
+    how many times each row of a contribution_store is drawn in bootstrap realizations
+    streams (an (nreal, nobj) array). each realization has its own random stream
+    (bootstrap_stream(seed, streamid)) and redraws as many objects as there are, from
+    each field separately if byfield
+    """
+    if byfield:
+        groups = [np.where(store['field'] == field)[0] for field in np.unique(store['field'])]
+    else:
+        groups = [np.arange(len(store))]
+
+    counts = np.zeros((len(streams), len(store)))
+    for (j, streamid) in enumerate(streams):
+        rng = bootstrap_stream(seed, streamid)
+        for rows in groups:
+            counts[j, rows] = np.bincount(rng.integers(0, len(rows), len(rows)), minlength=len(rows))
+    return counts
+
+def catalogue_bootstrap_errors(store, params, nboot, seed=None, weights=None, byfield=True,
+                               chunksize=100, save=False):
+    """
+    with-replacement catalogue bootstrap of the stacked aperture value and spectrum from a
+    contribution_store: nboot realizations, done chunksize at a time as one matrix product
+    of their resampling multiplicities with the per-object sums. the seed defaults to
+    params.bootstrapseed. returns the same dict as jackknife_errors
+    """
+    if seed is None:
+        seed = getattr(params, 'bootstrapseed', None)
+    valmat, weightmat = contribution_matrix(store, weights=weights)
+    napchans = store['apvalsum'].shape[1]
+
+    fullstack = np.concatenate(stacks_from_sums(valmat.sum(axis=0)[None, :], weightmat.sum(axis=0)[None, :],
+                                                params, napchans), axis=None)
+    realizations = []
+    for start in range(0, nboot, chunksize):
+        counts = catalogue_bootstrap_multiplicities(store, np.arange(start, min(start + chunksize, nboot)),
+                                                    seed=seed, byfield=byfield)
+        realizations.append(np.column_stack(stacks_from_sums(counts @ valmat, counts @ weightmat,
+                                                             params, napchans)))
+
+    outdict = resampled_covariance(fullstack, np.concatenate(realizations), 'bootstrap')
+    if save:
+        save_resampled_errors(outdict, params, 'bootstrap')
+    return outdict
+
+
 def bin_get_rand_cutouts(ncutouts, binzlims, comap, galcat, params, field=None, seed=None):
     """
     wrapper to return ncutout randomly located cutouts in a single field +
@@ -391,12 +837,14 @@ def bin_get_rand_cutouts(ncutouts, binzlims, comap, galcat, params, field=None,
     randra = rng.uniform(comap.xlims[0], comap.xlims[1], size=int(ncutouts*fac))
     randdec = rng.uniform(comap.ylims[0], comap.ylims[1], size=int(ncutouts*fac))
     randcoords = SkyCoord(randra*u.deg, randdec*u.deg)
-    randidx = np.arange(ncutouts*fac)
+    randidx = np.arange(int(ncutouts*fac))
 
     randcat = empty_table()
     randcat.coords = randcoords
     randcat.z = randz
     randcat.idx = randidx
+    # (single_cutout labels each cutout with its catalogue index)
+    randcat.catfileidx = randidx
 
     cutoutlist = []
     ngoodcuts = 0
@@ -486,7 +934,8 @@ def random_stacker_setup(maplist, galcatlist, params):
 def random_stacker(actcatidx, maplist, galcatlist, params, verbose=False, seed=None):
     """
     wrapper to perform a stack on random locations binned to match
-    the numbers of the stack in actcatidx
+    the numbers of the stack in actcatidx. seed can also be a np.random.Generator, which
+    then carries on from bin to bin and field to field
     """
 
     fields = [1,2,3]
@@ -514,8 +963,8 @@ def random_stacker(actcatidx, maplist, galcatlist, params, verbose=False, seed=N
         freqstack = []
         freqrms = []
     for cut in allcutouts:
-        Tvals.append(cut.T)
-        rmsvals.append(cut.rms)
+        Tvals.append(cut.linelum)
+        rmsvals.append(cut.dlinelum)
         catidxs.append(cut.catidx)
 
         if params.plotspace:
@@ -594,8 +1043,8 @@ def field_random_stacker(actcatidx, mapinst, galcatinst, params, verbose=False,
         freqstack = []
         freqrms = []
     for cut in allcutouts:
-        Tvals.append(cut.T)
-        rmsvals.append(cut.rms)
+        Tvals.append(cut.linelum)
+        rmsvals.append(cut.dlinelum)
         catidxs.append(cut.catidx)
 
         if params.plotspace:
@@ -617,32 +1066,35 @@ def field_random_stacker(actcatidx, mapinst, galcatinst, params, verbose=False,
         freqstack = np.array(freqstack)
         freqrms = np.array(freqrms)
 
+    # overall stack for T value
+    stacktemp, stackrms = weightmean(Tvals, rmsvals)
+
     return stacktemp, stackrms
 
 
-def n_random_stacks(nstacks, actidxlist, maplist, galcatlist, params, verbose=True):
+def n_random_stacks(nstacks, actidxlist, maplist, galcatlist, params, verbose=True, resume=False):
     """
     wrapper to perform n different stacks on random locations to match the original
-    catalogue
+    catalogue. stack n draws its random locations (and rotations) from its own stream,
+    bootstrap_stream(0, n). if params.itersave, every
+    finished stack is checkpointed to params.itersavefile -- pass resume=True to pick up a
+    run that died
     """
 
-    stackTlist = []
-    stackrmslist = []
-
-    for n in range(nstacks):
-        if verbose:
-            if n % 10 == 0:
-                print('iteration {}'.format(n))
-
-        stackT, stackrms, _, _, _ = random_stacker(actidxlist, maplist, galcatlist, params, seed=n*10)
-        stackTlist.append(stackT)
-        stackrmslist.append(stackrms)
+    logfile = params.itersavefile if params.itersave else None
+    # only the aperture values are kept, so don't build the images and spectra
+    randparams = params.copy()
+    randparams.plotspace = False
+    randparams.plotfreq = False
+    realize = lambda n, rng: random_stacker(actidxlist, maplist, galcatlist, randparams, seed=rng)[:2]
+    outarrs = checkpointed_realizations(nstacks, realize, randparams, ['T', 'rms'], logfile=logfile,
+                                        resume=resume, seed=0, verbose=verbose)
 
-        if params.itersave:
-            if n % params.itersavestep == 0:
-                np.savez(params.itersavefile, T=stackTlist, rms=stackrmslist)
+    if getattr(params, 'resultsformat', 'csv') == 'hdf5':
+        store_write_rows(params.resultsfile, 'realizations/random_stacks',
+                         {'stream': np.arange(nstacks), 'T': outarrs[:,0], 'rms': outarrs[:,1]})
 
-    return stackTlist, stackrmslist
+    return list(outarrs[:,0]), list(outarrs[:,1])
 
 def histoverplot(bootfile, stackdict, nbins=30, p0=(1000, 0, 2), rethist=False,
                  writefit=None):
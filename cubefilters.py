@@ -5,79 +5,152 @@ from .plottools import *
 import os
 import copy
 import numpy as np
-import matplotlib.pyplot as plt
+plt = lazy_import('matplotlib.pyplot')
 from astropy.coordinates import SkyCoord
 from astropy.cosmology import FlatLambdaCDM
 import astropy.units as u
 import astropy.constants as const
 from astropy.convolution import convolve, Gaussian2DKernel, Tophat2DKernel
-from astropy.modeling import models, fitting
+models = lazy_import('astropy.modeling.models')
+fitting = lazy_import('astropy.modeling.fitting')
 import warnings
 import csv
 warnings.filterwarnings("ignore", message="invalid value encountered in true_divide")
 warnings.filterwarnings("ignore", message="invalid value encountered in power")
 warnings.filterwarnings("ignore", message="divide by zero encountered in true_divide")
 
+def fit_plane(ims, rmss):
+    """
+    closed-form weighted least-squares fit of a plane c0_0 + c1_0*x + c0_1*y to an image
+    (ny, nx) or a stack of images (..., ny, nx), weighting by 1/rms**2 and ignoring nans.
+    x and y are pixel indices in the image. solves the 3x3 normal equations directly
+    (batched over any leading axes)
+    returns the coefficients ordered like astropy's Polynomial2D(degree=1) parameters,
+    shape (..., 3). images that can't be fit (fewer than three usable pixels or a
+    degenerate layout) get nans
+    """
+    ny, nx = ims.shape[-2:]
+    y, x = np.mgrid[:ny, :nx]
+    basis = np.stack((np.ones((ny, nx)), x, y))
+
+    wt = 1 / rmss**2
+    good = np.isfinite(ims) & np.isfinite(wt)
+    wt = np.where(good, wt, 0.)
+    wdat = np.where(good, ims, 0.) * wt
+
+    # normal equations A^T W A c = A^T W d
+    ata = np.einsum('iyx,jyx,...yx->...ij', basis, basis, wt)
+    atb = np.einsum('iyx,...yx->...i', basis, wdat)
+
+    # flag the degenerate ones and give them something solvable
+    singular = np.abs(np.linalg.det(ata)) <= 1e-12 * np.abs(ata[..., 0, 0])**3
+    ata[singular] = np.eye(3)
+    coeffs = np.linalg.solve(ata, atb[..., None])[..., 0]
+    coeffs[singular] = np.nan
+
+    return coeffs
+
+
+def plane_model(coeffs, shape, origin=(0, 0)):
+    """
+    evaluate plane coefficients (..., 3) from fit_plane on a (ny, nx) grid. origin is the
+    (y, x) pixel in this grid that was pixel (0, 0) in the fit
+    """
+    y, x = np.mgrid[:shape[0], :shape[1]]
+    y, x = y - origin[0], x - origin[1]
+    coeffs = np.asarray(coeffs)[..., None, None]
+    return coeffs[..., 0, :, :] + coeffs[..., 1, :, :] * x + coeffs[..., 2, :, :] * y
+
+
+def lowmode_region(beamyidx, beamxidx, params):
+    """
+    geometry of the low-mode fit for aperture indices beamyidx and beamxidx, shape (2,) or
+    (ncutouts, 2): the aperture plus (fitmasknbeams-1) apertures either side is masked,
+    and the region within (fitnbeams-1) apertures of that is fit. returns the (y, x)
+    corner of the fit region in each image and the mask of the masked part of it (the
+    same for every cutout)
+    """
+    beamyidx, beamxidx = np.asarray(beamyidx), np.asarray(beamxidx)
+    maskrad = int((params.fitmasknbeams - 1) * params.xwidth)
+    cliprad = int((params.fitnbeams - 1) * params.xwidth)
+
+    y0 = beamyidx[..., 0] - maskrad - cliprad
+    x0 = beamxidx[..., 0] - maskrad - cliprad
+    ny = int(np.max(beamyidx[..., 1] - beamyidx[..., 0])) + 2 * (maskrad + cliprad)
+    nx = int(np.max(beamxidx[..., 1] - beamxidx[..., 0])) + 2 * (maskrad + cliprad)
+
+    mask = np.zeros((ny, nx), dtype=bool)
+    mask[cliprad:ny - cliprad, cliprad:nx - cliprad] = True
+
+    return (y0, x0), mask
+
+
+def lowmode_cuts(coeffs, params):
+    """
+    whether low-mode fits (..., 3) are usable: if the mean in these central channels is
+    way off then assume the whole cutout is bad, and also cut on slopes > 10 in either of
+    the two gradient directions
+    """
+    return ((np.abs(coeffs[..., 0]) <= params.fitmeanlimit) & (np.abs(coeffs[..., 1]) <= 10)
+            & (np.abs(coeffs[..., 2]) <= 10))
+
+
+def lowmode_fit(spaceim, spacerms, beamxidx, beamyidx, params):
+    """
+    plane fit used by the low-mode filter for one (ny, nx) image, in the same units as
+    spaceim (the filter passes uK). beamxidx and beamyidx are the aperture indices in the
+    image (the fit region is set by lowmode_region)
+    returns the coefficients (relative to the corner of the fit region), the slices of the
+    fit region in the image, and whether the fit passes the fitmeanlimit and slope (> 10)
+    cuts
+    """
+    (y0, x0), mask = lowmode_region(beamyidx, beamxidx, params)
+    clipsl = (slice(y0, y0 + mask.shape[0]), slice(x0, x0 + mask.shape[1]))
+
+    coeffs = fit_plane(np.where(mask, np.nan, spaceim[clipsl]), spacerms[clipsl])
+
+    return coeffs, clipsl, bool(lowmode_cuts(coeffs, params))
+
+
 def remove_cutout_lowmodes(cutout, params, plot=False, plotfit=False):
     """
-    function that will return a copy of the passed cutout object with a 2D linear polynomial
-    fit to the spatial image and subtracted
+    function that will fit a 2D linear polynomial to the spatial image of the passed cutout
+    and subtract it (from the image and from every channel of the cubelet). works on the
+    cutout in place (returning it), or returns None if the fit fails the fitmeanlimit or
+    slope cuts
     """
 
     # pull the cutout over the correct number of frequency channels
     try:
-        cutim = cutout.spacestack * 1e6
-        cutrms = cutout.spacestackrms * 1e6
+        _ = cutout.spacestack
     except AttributeError:
-        aperture_collapse_cubelet_freq(cutout, params)
-        cutim = cutout.spacestack * 1e6
-        cutrms = cutout.spacestackrms * 1e6
+        cutout.spacestack, cutout.spacestackrms = aperture_collapse_cubelet_freq(cutout.cubestack,
+                                                                                 cutout.cubestackrms, params)
 
-    # mask out the source aperture and the edges -- clip to just the center
-    maskrad = int((params.fitmasknbeams - 1) * params.xwidth)
-    maskext = np.array([-maskrad, maskrad])
-    beamxidx = cutout.xidx - cutout.spacexidx[0] + maskext
-    beamyidx = cutout.yidx - cutout.spaceyidx[0] + maskext
-
-    cutim[beamyidx[0]:beamyidx[1], beamxidx[0]:beamxidx[1]] = np.nan
-    cutrms[beamyidx[0]:beamyidx[1], beamxidx[0]:beamxidx[1]] = np.nan
+    # aperture indices in the cutout
+    beamxidx = np.array(cutout.xidx) - cutout.spacexidx[0]
+    beamyidx = np.array(cutout.yidx) - cutout.spaceyidx[0]
 
-    # radius around the center to keep for fitting
-    cliprad = int((params.fitnbeams - 1) * params.xwidth)
-    clipext = np.array([-cliprad, cliprad])
-    clipxidx, clipyidx = beamxidx + clipext, beamyidx + clipext
-
-    # final cutout to fit
     # has to go into uk so as to not cause problems
-    cutim = cutim[clipyidx[0]:clipyidx[1], clipxidx[0]:clipxidx[1]]
-    cutrms = cutrms[clipyidx[0]:clipyidx[1], clipxidx[0]:clipxidx[1]]
-
-    # Fit the data using astropy.modeling -- set up a 2d polynomial to fit
-    p_init = models.Polynomial2D(degree=1)
-    fit_p = fitting.LevMarLSQFitter()
-    # x and y axes
-    y,x = np.mgrid[:len(cutim), :len(cutim)]
-
-    # mask nans because the fitter can't deal with them
-    mask = np.isfinite(cutim)
-    p = fit_p(p_init, x[mask], y[mask], cutim[mask], weights=1/cutrms[mask])
-
-    # if the mean in these central channels is way off then assume the whole
-    # cutout is bad
-    # also cutting on slopes > 10 in either of the two gradient directions
-    if np.abs(p.c0_0) > params.fitmeanlimit or np.abs(p.c1_0) > 10 or np.abs(p.c0_1) > 10:
+    coeffs, clipsl, good = lowmode_fit(cutout.spacestack * 1e6, cutout.spacestackrms * 1e6,
+                                       beamxidx, beamyidx, params)
+    if not good:
         return None
 
+    fullcutim = cutout.spacestack
+    polyfit = plane_model(coeffs, fullcutim.shape, (clipsl[0].start, clipsl[1].start)) / 1e6
+
     if plotfit:
+        cutim, cutrms, fitim = fullcutim[clipsl] * 1e6, cutout.spacestackrms[clipsl] * 1e6, polyfit[clipsl] * 1e6
         fig,axs = plt.subplots(1,4, sharey=True, sharex=True)
         vl,vu = simlims(cutim)
         axs[0].pcolormesh(cutim, vmin=vl, vmax=vu, cmap='PiYG_r')
         axs[0].set_title('Raw Cutout')
-        vl,vu = simlims(p(x,y))
-        axs[1].pcolormesh(p(x, y), vmin=vl, vmax=vu, cmap='PiYG_r')
+        vl,vu = simlims(fitim)
+        axs[1].pcolormesh(fitim, vmin=vl, vmax=vu, cmap='PiYG_r')
         axs[1].set_title('Linear 2D Fit')
-        vl,vu = simlims(cutim - p(x,y))
-        axs[2].pcolormesh(cutim - p(x, y), vmin=vl, vmax=vu, cmap='PiYG_r')
+        vl,vu = simlims(cutim - fitim)
+        axs[2].pcolormesh(cutim - fitim, vmin=vl, vmax=vu, cmap='PiYG_r')
         axs[2].set_title('Residual')
         axs[3].pcolormesh(1/cutrms, cmap='PiYG_r')
         axs[3].set_title('Weighting')
@@ -85,135 +158,203 @@ def remove_cutout_lowmodes(cutout, params, plot=False, plotfit=False):
         for ax in axs:
             ax.set_aspect(aspect=1)
 
-    # subtract this polynomial from the full cutout and add it into the cutout object
-    fully, fullx = np.mgrid[:len(cutout.spacestack), :len(cutout.spacestack)]
-    fullcutim = cutout.spacestack
-
-    newcutout = cutout.copy()
-    newcutout.polyfit = p(fullx, fully) / 1e6
-    newcutout.polyfitmodel = p.parameters
-    newcutout.spacestack = fullcutim - newcutout.polyfit
-
-    # also subtract from the full cubelet
-    fullcube = cutout.cubestack
-    cubepolyfit = np.tile(newcutout.polyfit, (fullcube.shape[0],1,1))
-    newcutout.cubestack = fullcube - cubepolyfit
+    # subtract this polynomial from the image and (broadcast over channels) the full cubelet
+    cutout.polyfit = polyfit
+    cutout.polyfitmodel = coeffs
+    cutout.spacestack = fullcutim - polyfit
+    cutout.cubestack = cutout.cubestack - polyfit
 
     if plot:
         fig,axs = plt.subplots(1,3, sharey=True, sharex=True)
         vl,vu = simlims(fullcutim)
         axs[0].pcolormesh(fullcutim, vmin=vl, vmax=vu, cmap='PiYG_r')
         axs[0].set_title('Raw Cutout')
-        print(vl,vu)
-        vl,vu = simlims(newcutout.polyfit)
-        axs[1].pcolormesh(newcutout.polyfit, vmin=vl, vmax=vu, cmap='PiYG_r')
+        vl,vu = simlims(cutout.polyfit)
+        axs[1].pcolormesh(cutout.polyfit, vmin=vl, vmax=vu, cmap='PiYG_r')
         axs[1].set_title('Linear 2D Fit')
-        print(vl,vu)
-        vl,vu = simlims(newcutout.spacestack)
-        axs[2].pcolormesh(newcutout.spacestack, vmin=vl, vmax=vu, cmap='PiYG_r')
+        vl,vu = simlims(cutout.spacestack)
+        axs[2].pcolormesh(cutout.spacestack, vmin=vl, vmax=vu, cmap='PiYG_r')
         axs[2].set_title('Residual')
-        print(vl,vu)
 
         for ax in axs:
             ax.set_aspect(aspect=1)
 
-    return newcutout
+    return cutout
 
 
-def remove_cutout_chanmean(cutout, params, plot=False, plotfit=False):
+def remove_lowmodes_batch(cubes, rmss, params, beamxidx=None, beamyidx=None):
     """
-    function to, for a given cutout, find the region around the source spatially
-    but not including the actual source, find the mean value of each channel, and
-    subtract those means from the cutout
+    batched low-mode filter: fit and subtract planes for a whole 4D stack of cutouts
+    (ncutouts, nfreq, ny, nx) at once, with the same fit region and cuts as
+    remove_cutout_lowmodes. beamxidx/beamyidx are the per-cutout aperture indices
+    (ncutouts, 2); if not passed the aperture is assumed to be centered
+    returns the filtered cubes, the fitted planes (ncutouts, ny, nx), the coefficients and
+    a boolean array of which cutouts pass the fitmeanlimit / slope cuts (failed cutouts
+    are left unfiltered -- drop them)
     """
+    ncut, _, ny, nx = cubes.shape
 
-    # cubelet
-    cutim = copy.deepcopy(cutout.cubestack)
-    cutrms = copy.deepcopy(cutout.cubestackrms)
+    if beamxidx is None:
+        lo = (nx - params.xwidth) // 2
+        beamxidx = np.tile([lo, lo + params.xwidth], (ncut, 1))
+    if beamyidx is None:
+        lo = (ny - params.ywidth) // 2
+        beamyidx = np.tile([lo, lo + params.ywidth], (ncut, 1))
 
-    # mask out the source aperture and the edges -- clip to just the center
-    beamxidx = cutout.xidx - cutout.spacexidx[0]
-    beamyidx = cutout.yidx - cutout.spaceyidx[0]
-    beamfidx = cutout.freqidx - cutout.freqfreqidx[0]
+    # collapse over the aperture channels like aperture_collapse_cubelet_freq
+    lcfidx = (cubes.shape[1] - params.freqwidth) // 2
+    spaceims = np.nansum(cubes[:, lcfidx:lcfidx + params.freqwidth], axis=1)
+    spacerms = np.sqrt(np.nansum(rmss[:, lcfidx:lcfidx + params.freqwidth]**2, axis=1))
+
+    # pull the fit region out of each image (fancy indexing so offsets can differ per cutout)
+    (y0, x0), mask = lowmode_region(beamyidx, beamxidx, params)
+    cutidx = np.arange(ncut)[:, None, None]
+    yy = y0[:, None, None] + np.arange(mask.shape[0])[:, None]
+    xx = x0[:, None, None] + np.arange(mask.shape[1])[None, :]
+
+    # (in uK, like the per-cutout version)
+    coeffs = fit_plane(np.where(mask, np.nan, spaceims[cutidx, yy, xx] * 1e6), spacerms[cutidx, yy, xx] * 1e6)
+    good = lowmode_cuts(coeffs, params)
+
+    y, x = np.mgrid[:ny, :nx]
+    y = y - y0[:, None, None]
+    x = x - x0[:, None, None]
+    polyfits = (coeffs[:, 0, None, None] + coeffs[:, 1, None, None] * x + coeffs[:, 2, None, None] * y) / 1e6
+    polyfits[~good] = 0.
+
+    return cubes - polyfits[:, None], polyfits, coeffs, good
 
-    cutim[beamfidx[0]:beamfidx[1],
-          beamyidx[0]:beamyidx[1],
-          beamxidx[0]:beamxidx[1]] = np.nan
-    cutrms[beamfidx[0]:beamfidx[1],
-           beamyidx[0]:beamyidx[1],
-           beamxidx[0]:beamxidx[1]] = np.nan
 
+def masked_weightmean(vals, rmss, mask, axis=None):
+    """
+    same as weightmean, but ignoring anything where mask (which broadcasts against vals) is
+    True -- so vals and rmss can be views into a cubelet instead of nan-masked copies
+    """
+    weights = np.where(mask, 0., 1 / rmss**2)
+
+    meanval = np.nansum(vals * weights, axis=axis) / np.nansum(weights, axis=axis)
+    meanrms = np.sqrt(1 / np.nansum(weights, axis=axis))
+
+    return meanval, meanrms
+
+
+def chanmean_region(beamfidx, beamyidx, beamxidx, nfreq, params):
+    """
+    slices of the region used to find per-channel means (the aperture plus (fitnbeams-1)
+    apertures either side, all channels) and the mask of the source aperture within it
+    """
     # radius around the center to keep for fitting in space (keep all freq channels)
-    cliprad = (params.fitnbeams - 1) * params.xwidth
-    clipext = np.array([-cliprad, cliprad])
-    clipxidx, clipyidx = beamxidx + clipext, beamyidx + clipext
+    cliprad = int((params.fitnbeams - 1) * params.xwidth)
+    clipsl = (slice(None), slice(beamyidx[0] - cliprad, beamyidx[1] + cliprad),
+              slice(beamxidx[0] - cliprad, beamxidx[1] + cliprad))
+
+    # mask out the source aperture
+    fmask = (np.arange(nfreq) >= beamfidx[0]) & (np.arange(nfreq) < beamfidx[1])
+    ymask = np.zeros(beamyidx[1] - beamyidx[0] + 2*cliprad, dtype=bool)
+    ymask[cliprad:-cliprad or None] = True
+    xmask = np.zeros(beamxidx[1] - beamxidx[0] + 2*cliprad, dtype=bool)
+    xmask[cliprad:-cliprad or None] = True
+    mask = fmask[:, None, None] & ymask[None, :, None] & xmask[None, None, :]
 
-    # final cutout to fit
-    cutim = cutim[:, clipyidx[0]:clipyidx[1], clipxidx[0]:clipxidx[1]]
-    cutrms = cutrms[:, clipyidx[0]:clipyidx[1], clipxidx[0]:clipxidx[1]]
+    return clipsl, mask
+
+
+def remove_cutout_chanmean(cutout, params, plot=False, plotfit=False):
+    """
+    function to, for a given cutout, find the region around the source spatially
+    but not including the actual source, find the mean value of each channel, and
+    subtract those means from the cutout (in place -- the cutout is returned, or None if
+    the means are too large)
+    """
+
+    # mask out the source aperture and the edges -- clip to just the center
+    beamxidx = np.array(cutout.xidx) - cutout.spacexidx[0]
+    beamyidx = np.array(cutout.yidx) - cutout.spaceyidx[0]
+    beamfidx = np.array(cutout.freqidx) - cutout.freqfreqidx[0]
+    clipsl, mask = chanmean_region(beamfidx, beamyidx, beamxidx, cutout.cubestack.shape[0], params)
 
     # use the variance-weighted mean to find a mean value for each channel in the cube
-    chanmeans, _ = weightmean(cutim, cutrms, axis=(1,2))
+    chanmeans, _ = masked_weightmean(cutout.cubestack[clipsl], cutout.cubestackrms[clipsl], mask, axis=(1,2))
 
     # check the mean channels to make sure they aren't too crazy
     if np.all(chanmeans[beamfidx[0]:beamfidx[1]] > params.fitmeanlimit/1e6):
         return None
 
-    # subtract off the means and store in a new cutout object
-    newcutout = cutout.copy()
-    newcutout.chanmeans = chanmeans
-    # ugly flipping bc the freq axis is on the wrong side
-    newcutout.cubestack = (cutout.cubestack.T - chanmeans).T
+    # subtract off the means
+    cutout.chanmeans = chanmeans
+    cutout.cubestack = cutout.cubestack - chanmeans[:, None, None]
 
-    return newcutout
+    return cutout
 
 
-def remove_cutout_spectral_mean(cutout, params, plot=False):
+def remove_chanmean_batch(cubes, rmss, params, beamfidx=None, beamyidx=None, beamxidx=None):
     """
-    function to, for a given cutout, find the region around the source spectrally
-    (not including the actual source), find the global mean value of this nearby
-    spectrum, and subtract that mean from the cutout
+    batched version of remove_cutout_chanmean for a 4D stack of cutouts (ncutouts, nfreq,
+    ny, nx) that share the same aperture indices (centered unless passed)
+    returns the filtered cubes, the channel means (ncutouts, nfreq) and a boolean array of
+    which cutouts pass the fitmeanlimit cut
     """
+    _, nfreq, ny, nx = cubes.shape
+    if beamfidx is None:
+        beamfidx = ((nfreq - params.freqwidth) // 2, (nfreq - params.freqwidth) // 2 + params.freqwidth)
+    if beamyidx is None:
+        beamyidx = ((ny - params.ywidth) // 2, (ny - params.ywidth) // 2 + params.ywidth)
+    if beamxidx is None:
+        beamxidx = ((nx - params.xwidth) // 2, (nx - params.xwidth) // 2 + params.xwidth)
+
+    clipsl, mask = chanmean_region(beamfidx, beamyidx, beamxidx, nfreq, params)
+    clipsl = (slice(None),) + clipsl
+
+    chanmeans, _ = masked_weightmean(cubes[clipsl], rmss[clipsl], mask, axis=(2,3))
+    good = ~np.all(chanmeans[:, beamfidx[0]:beamfidx[1]] > params.fitmeanlimit/1e6, axis=1)
+
+    return cubes - chanmeans[:, :, None, None], chanmeans, good
 
+
+def spectral_mean_region(apidx, params):
+    """
+    channels used to find the spectral mean (the aperture plus (frequsewidth-1) apertures
+    either side) and the mask of the ones that probably contain the source (the aperture
+    plus (freqmaskwidth-1) apertures either side) within them
+    """
     # find the channels to mask
-    apidx = cutout.freqidx - cutout.freqfreqidx[0]
     if params.freqmaskwidth > 1:
-        maskrad = (params.freqmaskwidth - 1) * params.freqwidth
-        maskext = np.array([-maskrad, maskrad])
-        maskfidx = apidx + maskext
+        maskrad = int((params.freqmaskwidth - 1) * params.freqwidth)
     else:
-        maskfidx = apidx
+        maskrad = 0
 
-    try:
-        # copy of the spectrum (there was weird overwriting stuff if not)
-        maskarr = copy.deepcopy(cutout.freqstack)
-        maskrms = copy.deepcopy(cutout.freqstackrms)
-    except AttributeError:
-        aperture_collapse_cubelet_space(cutout, params)
-        # copy of the spectrum (there was weird overwriting stuff if not)
-        maskarr = copy.deepcopy(cutout.freqstack)
-        maskrms = copy.deepcopy(cutout.freqstackrms)
+    # outer channels to exclude (this is a passed parameter for now but maybe base it on the rms?)
+    cliprad = int((params.frequsewidth - 1) * params.freqwidth)
+    clipsl = slice(apidx[0] - cliprad, apidx[1] + cliprad)
 
-    # mask the channels that probably contain the source
-    maskarr[maskfidx[0]:maskfidx[1]] = np.nan
-    maskrms[maskfidx[0]:maskfidx[1]] = np.nan
+    chans = np.arange(apidx[0] - cliprad, apidx[1] + cliprad)
+    mask = (chans >= apidx[0] - maskrad) & (chans < apidx[1] + maskrad)
 
-    # outer channels to exclude (this is a passed parameter for now but maybe base it on the rms?)
-    cliprad = (params.frequsewidth - 1) * params.freqwidth
-    clipext = np.array([-cliprad, cliprad])
-    clipidx = apidx + clipext
+    return clipsl, mask
+
+
+def remove_cutout_spectral_mean(cutout, params, plot=False):
+    """
+    function to, for a given cutout, find the region around the source spectrally
+    (not including the actual source), find the global mean value of this nearby
+    spectrum, and subtract that mean from the cutout (in place -- the cutout is returned)
+    """
+
+    try:
+        freqstack, freqstackrms = cutout.freqstack, cutout.freqstackrms
+    except AttributeError:
+        freqstack, freqstackrms = aperture_collapse_cubelet_space(cutout.cubestack, cutout.cubestackrms, params)
+        cutout.freqstack, cutout.freqstackrms = freqstack, freqstackrms
 
-    # clip off the faraway channels
-    maskarr = maskarr[clipidx[0]:clipidx[1]]
-    maskrms = maskrms[clipidx[0]:clipidx[1]]
+    apidx = np.array(cutout.freqidx) - cutout.freqfreqidx[0]
+    clipsl, mask = spectral_mean_region(apidx, params)
 
     # noise-weighted mean value
-    freqmean, _ = weightmean(maskarr, maskrms)
+    freqmean, _ = masked_weightmean(freqstack[clipsl], freqstackrms[clipsl], mask)
 
-    # new cutout object with the mean subtracted
-    newcutout = cutout.copy()
-    newcutout.freqmean = freqmean
-    newcutout.cubestack = cutout.cubestack - freqmean
+    # subtract the mean
+    cutout.freqmean = freqmean
+    cutout.cubestack = cutout.cubestack - freqmean
 
     # diagnostic plotter
     if plot:
@@ -223,13 +364,14 @@ def remove_cutout_spectral_mean(cutout, params, plot=False):
         else:
             freqarr = np.arange(params.freqstackwidth * 2 + 1)*31.25e-3 - (params.freqstackwidth)*31.25e-3
 
-        maskfreqarr = copy.deepcopy(freqarr)[clipidx[0]:clipidx[1]]
+        maskfreqarr = freqarr[clipsl]
+        maskarr = np.where(mask, np.nan, freqstack[clipsl])
 
         fig, ax = plt.subplots(1, tight_layout=True)
         plt.style.use('seaborn-talk')
 
         # original array
-        ax.step(freqarr, testcut.freqstack*1e6, color='0.5', where='mid')
+        ax.step(freqarr, freqstack*1e6, color='0.5', where='mid')
         # part of the array from which the mean value is calculated
         ax.step(maskfreqarr, maskarr*1e6, color='indigo', where='mid')
 
@@ -237,13 +379,34 @@ def remove_cutout_spectral_mean(cutout, params, plot=False):
         ax.axhline(freqmean, color='k', ls='--')
 
         # lines to show the demarcations
-        ax.axvline(freqarr[maskfidx[0]], color='0.8')
-        ax.axvline(freqarr[maskfidx[1]], color='0.8')
-        ax.axvline(freqarr[clipidx[0]], color='0.8')
-        ax.axvline(freqarr[clipidx[1]], color='0.8')
+        ax.axvline(maskfreqarr[mask][0], color='0.8')
+        ax.axvline(maskfreqarr[mask][-1], color='0.8')
+        ax.axvline(maskfreqarr[0], color='0.8')
+        ax.axvline(maskfreqarr[-1], color='0.8')
 
 
         ax.set_xlabel(r'$\Delta_\nu$ [GHz]')
         ax.set_ylabel(r'T$_b$ [$\mu$K]')
 
-    return newcutout
+    return cutout
+
+
+def remove_spectral_mean_batch(cubes, rmss, params, apidx=None):
+    """
+    batched version of remove_cutout_spectral_mean for a 4D stack of cutouts (ncutouts,
+    nfreq, ny, nx) that share the same aperture channels (centered unless passed)
+    returns the filtered cubes and the per-cutout means
+    """
+    ncut, nfreq, ny, nx = cubes.shape
+    if apidx is None:
+        apidx = ((nfreq - params.freqwidth) // 2, (nfreq - params.freqwidth) // 2 + params.freqwidth)
+
+    # spectra through the aperture (like aperture_collapse_cubelet_space)
+    lcxidx, lcyidx = (nx - params.xwidth) // 2, (ny - params.ywidth) // 2
+    apsl = (slice(None), slice(None), slice(lcyidx, lcyidx + params.ywidth), slice(lcxidx, lcxidx + params.xwidth))
+    specs, specrms = weightmean(cubes[apsl], rmss[apsl], axis=(2,3))
+
+    clipsl, mask = spectral_mean_region(apidx, params)
+    freqmeans, _ = masked_weightmean(specs[:, clipsl], specrms[:, clipsl], mask, axis=1)
+
+    return cubes - freqmeans[:, None, None, None], freqmeans
@@ -48,12 +48,12 @@ plotcubelet False
 """ bootstrap-specific parameters """
 # number of redshift bins to use for getting the redshift distribution
 nzbins 3
-# parameters for saving as the bootstrap runs (in case it crashes partway through)
-# this is the worst possible way to do this -- need to set up a better iterator
+# checkpoint every realization to itersavefile as the bootstrap runs (in case it crashes
+# partway through -- resume=True picks it back up)
 itersave = True
 # file for the saves during the run
 itersavefile = params.savepath + 'random_stacker_iter_output.csv'
 # file for saving at the end of the run
 nitersavefile = params.savepath + 'random_stacker_output.npz'
-# every N iterations, save
+# every N iterations, print progress
 itersavestep = 10
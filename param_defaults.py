@@ -5,6 +5,14 @@ xwidth 3
 ywidth 3
 # number of frequency channels at map freq resolution
 freqwidth 3
+# other aperture sizes to measure the stack in as well, as lists like [1,3,5,7] (odd widths
+# only; any left False just use the width above). every combination is read off one stack
+# of the objects that fit the largest aperture (the run's own stack is left as it is; with
+# the cutout filters on, that stack's cutouts are filtered for the largest aperture) and
+# saved as one table (aperture_sweep.csv/.npz, or apertures/ in the results store)
+sweepxwidths False
+sweepywidths False
+sweepfreqwidths False
 
 """ properties of the map """
 # CO(1-0) emitted frequency (GHz)
@@ -13,6 +21,9 @@ centfreq 115.27
 beamwidth 4.5
 # cosmology to use (default 'comap' is the one from the ES papers)
 cosmo comap
+# tabulate the cosmological distances over the map's redshift range and interpolate
+# them instead of integrating every time one is needed
+cosmocache True
 
 """ stacking metaparameters """
 # only take a specific feed to stack on
@@ -68,11 +79,26 @@ verbose True
 savedata True
 # file path for saving the stack data
 savepath stack_output
+# 'single' stores the maps and cutouts as float32 (and hits as integers) to halve their
+# memory -- stacks and weights are still accumulated in double precision
+precision double
+# 'csv' saves output_values.csv and npz files for each stack, 'hdf5' saves everything
+# into one results store per run (data/results.h5)
+resultsformat csv
 # for simulations -- to hit a target number of objects exactly
 # to split this up by field, pass a list [n_field1, n_field2, n_field3]
 goalnumcutouts False
 # return the actual cutout objects
 returncutlist False
+# stack each field by cross-correlating the map with the catalogue's voxel counts (FFTs)
+# instead of cutout by cutout. same answer for unrotated stacks with no cutout filters
+# (with line luminosities taken at the centre of each object's channel), and the cost
+# doesn't depend on the number of objects
+fftstack False
+# keep a table of what every object put into the stack (its aperture sums and weights
+# per channel, redshift, field, position within its voxel) so subset, re-weighted or
+# goalnumcutouts-truncated stacks can be redone from it with contribution_store.stack
+contribstore False
 
 """ plotting parameters """
 # save plots to disk
@@ -93,6 +119,13 @@ freqstackwidth 40
 plotcubelet True
 # units to make the plots ITO ('linelum' for line luminosity or 'flux')
 plotunits linelum
+# don't draw anything during the run: record the arrays each plot needs under
+# plotsavepath/.../deferred and draw them afterwards with render_deferred_plots
+deferplots False
+
+# record wall time per stack stage and why catalogue objects were rejected (attached to
+# the output cubelet as .profile and saved with the rest of the outputs)
+profile False
 
 """ parallelization """
 parallelize False
@@ -100,6 +133,8 @@ nthreads 5
 
 """ physical spacing"""
 physicalspace False
+# use precomputed sparse operators for the physical spacing instead of the spectral-cube version
+psfast False
 cosmogrid False
 
 """ adaptive photometry """
@@ -118,7 +153,8 @@ prf_stacklco 0
 # number of pixels on either side of central pixel for optimized fitting
 optcut 40
 
-# method used for fitting amplitude
+# method used for fitting amplitude ('matchedfilter' solves the same weighted fit in closed
+# form, and with fftstack reads every object's amplitude off matched-filtered maps)
 prf_fitmethod curve_fit
 
 # Lorentzian spectral profile for 3D PRF (DTC 2025/10/25)
@@ -2,14 +2,17 @@ from __future__ import print_function
 from .tools import *
 from .stack import *
 import numpy as np
-from scipy.optimize import curve_fit
-import matplotlib.pyplot as plt
-from matplotlib.colors import SymLogNorm
-from mpl_toolkits.axes_grid1 import make_axes_locatable
-from mpl_toolkits.axes_grid1.inset_locator import inset_axes
-from matplotlib.patches import Rectangle
-import matplotlib.gridspec as gridspec
-from photutils.aperture import CircularAnnulus, CircularAperture, aperture_photometry
+# plotting and fitting packages are only imported when they're actually used
+curve_fit = lazy_import('scipy.optimize', 'curve_fit')
+plt = lazy_import('matplotlib.pyplot')
+SymLogNorm = lazy_import('matplotlib.colors', 'SymLogNorm')
+make_axes_locatable = lazy_import('mpl_toolkits.axes_grid1', 'make_axes_locatable')
+inset_axes = lazy_import('mpl_toolkits.axes_grid1.inset_locator', 'inset_axes')
+Rectangle = lazy_import('matplotlib.patches', 'Rectangle')
+gridspec = lazy_import('matplotlib.gridspec')
+CircularAnnulus = lazy_import('photutils.aperture', 'CircularAnnulus')
+CircularAperture = lazy_import('photutils.aperture', 'CircularAperture')
+aperture_photometry = lazy_import('photutils.aperture', 'aperture_photometry')
 import astropy.units as u
 import astropy.constants as const
 from astropy.coordinates import SkyCoord
@@ -20,11 +23,14 @@ import h5py
 import csv
 import warnings
 import copy
+import glob
+import pickle
+import multiprocessing
 warnings.filterwarnings("ignore", message="invalid value encountered in true_divide")
 warnings.filterwarnings("ignore", message="invalid value encountered in power")
 warnings.filterwarnings("ignore", message="divide by zero encountered in true_divide")
 
-cmap = plt.get_cmap('twilight')
+cmap = 'twilight'
 cosmo = FlatLambdaCDM(H0=70*u.km / (u.Mpc*u.s), Om0=0.286, Ob0=0.047)
 
 
@@ -270,7 +276,83 @@ def changrid(cubelet, rmslet, params, smooth=None, rad=None, ext=None, offset=0,
 
     return fig
 
-def radprof(cubelet, rmslet, params, chan=None, apcoll=False, centwidth=0.5, apwidth=0.5):
+_radprofgeometries = {}
+
+def radial_profile_weights(shape, redges, center=None, method='exact'):
+    """
+    weights for binning an image of the passed (ny, nx) shape into circular annuli with
+    radii redges (in pixels) around center (x, y; defaults to the central spaxel). the first
+    'annulus' is the central circle if redges[0] is 0
+    method='exact' gives a (nannuli, ny*nx) matrix of the fraction of each pixel falling in
+    each annulus (from photutils' exact overlaps), method='center' gives an (ny*nx) array of
+    annulus labels from the radii of the pixel centers (-1 outside all of them)
+    these only depend on the geometry, so they're computed once and cached
+    """
+    if center is None:
+        center = (int(shape[1] / 2), int(shape[0] / 2))
+    key = (tuple(shape), tuple(np.round(redges, 10)), tuple(center), method)
+    try:
+        return _radprofgeometries[key]
+    except KeyError:
+        pass
+
+    if method == 'exact':
+        circles = [np.zeros(shape)]
+        for r in redges[1:]:
+            circles.append(CircularAperture(center, r).to_mask(method='exact').to_image(shape))
+        circles = np.array(circles)
+        if redges[0] > 0:
+            circles[0] = CircularAperture(center, redges[0]).to_mask(method='exact').to_image(shape)
+        weights = np.diff(circles, axis=0).reshape(len(redges) - 1, -1)
+    elif method == 'center':
+        yy, xx = np.indices(shape)
+        rpix = np.sqrt((xx - center[0])**2 + (yy - center[1])**2).flatten()
+        weights = np.searchsorted(redges, rpix, side='right') - 1
+        weights[(rpix < redges[0]) | (rpix >= redges[-1])] = -1
+    else:
+        raise ValueError("radial_profile_weights: don't know method '{}'".format(method))
+
+    _radprofgeometries[key] = weights
+    return weights
+
+def radial_profiles(cube, rmscube, centwidth=0.5, apwidth=0.5, center=None, method='exact'):
+    """
+    inverse-variance weighted mean Tb in a central circle of radius centwidth and annuli of
+    width apwidth outside of it, out to the edge of the image, for every image in cube at once
+    (cube can have any number of leading axes -- channels, cutouts, bootstrap realizations --
+    in front of the two spatial ones). returns the profiles and their rmss, both with shape
+    (..., nannuli), and the outer radius of each annulus in pixels
+    """
+    shape = cube.shape[-2:]
+    spacecent = int(shape[0] / 2)
+    router = np.concatenate([[centwidth], np.arange(centwidth+apwidth, spacecent, apwidth)])
+    redges = np.concatenate([[0], router])
+    weights = radial_profile_weights(shape, redges, center=center, method=method)
+
+    lead = cube.shape[:-2]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pixweights = (1 / rmscube**2).reshape(-1, shape[0]*shape[1])
+        valweights = (cube.reshape(-1, shape[0]*shape[1]) * pixweights)
+        pixweights = np.where(np.isnan(pixweights), 0., pixweights)
+        valweights = np.where(np.isnan(valweights), 0., valweights)
+
+        if method == 'exact':
+            num, den = valweights @ weights.T, pixweights @ weights.T
+        else:
+            nbins = len(router)
+            inbin = weights >= 0
+            labels = (np.arange(pixweights.shape[0])[:,None] * nbins + weights[None,inbin]).flatten()
+            num = np.bincount(labels, weights=valweights[:,inbin].flatten(),
+                              minlength=pixweights.shape[0]*nbins).reshape(-1, nbins)
+            den = np.bincount(labels, weights=pixweights[:,inbin].flatten(),
+                              minlength=pixweights.shape[0]*nbins).reshape(-1, nbins)
+
+        profs = num / den
+        rmsprofs = np.sqrt(1 / den)
+
+    return profs.reshape(lead + (len(router),)), rmsprofs.reshape(lead + (len(router),)), router
+
+def radprof(cubelet, rmslet, params, chan=None, apcoll=False, centwidth=0.5, apwidth=0.5, method='exact'):
     """
     gets the integrated Tb in circular annuli extending radially outwards from
     the central spaxel in a given channel
@@ -281,8 +363,6 @@ def radprof(cubelet, rmslet, params, chan=None, apcoll=False, centwidth=0.5, apw
     if len(cubelet.shape) > 2:
         # indexing
         freqcent = int(cubelet.shape[0] / 2)
-        spaceext = cubelet.shape[1]
-        spacecent = int(spaceext / 2)
 
         if not chan:
             chan = freqcent
@@ -293,28 +373,8 @@ def radprof(cubelet, rmslet, params, chan=None, apcoll=False, centwidth=0.5, apw
             im, imrms = cubelet[chan,:,:], rmslet[chan,:,:]
     else:
         im, imrms = cubelet, rmslet
-        spaceext = im.shape[0]
-        spacecent = int(spaceext / 2)
-
-    # central circular aperture
-    cent = CircularAperture((spacecent, spacecent), centwidth)
-    centmask = cent.to_mask()
-    centim, centrms = weightmean(centmask.cutout(im), centmask.cutout(imrms), axis=(0,1))
-
-    router = np.arange(centwidth+apwidth, spacecent, apwidth) # in pixels
-    # the rest of the annuli
-    meanlist = [centim]
-    rmsmeanlist = [centrms]
-    for r in router:
-        aper = CircularAnnulus((spacecent, spacecent), r-apwidth, r)
-        apmask = aper.to_mask()#.to_image(im.shape)
-        apim, aprms = weightmean(apmask.cutout(im), apmask.cutout(imrms), axis=(0,1))
-        meanlist.append(apim)
-        rmsmeanlist.append(aprms)
 
-    router = np.concatenate([[centwidth], router])
-
-    return np.array(meanlist), np.array(rmsmeanlist), router
+    return radial_profiles(im, imrms, centwidth=centwidth, apwidth=apwidth, method=method)
 
 def radprofoverplot(cubelet, rmslet, params, nextra=5, offset=0, profsum=False):
     """
@@ -335,9 +395,12 @@ def radprofoverplot(cubelet, rmslet, params, nextra=5, offset=0, profsum=False):
 
     carr = np.abs(chans - freqcent) / (chans[-1] - freqcent)
 
+    # profiles for all the channels in one go
+    allprofs, allrmsprofs, router = radial_profiles(cubelet[chans], rmslet[chans])
+
     chanprofs = []
     for i, chan in enumerate(chans):
-        chanprof, rmsprof, xaxis = radprof(cubelet, rmslet, params, chan=chan)
+        chanprof, rmsprof, xaxis = allprofs[i], allrmsprofs[i], router
 
         if profsum:
             chanprof = np.cumsum(chanprof)
@@ -376,23 +439,30 @@ def radprofoverplot(cubelet, rmslet, params, nextra=5, offset=0, profsum=False):
 
     return fig
 
-def spaceweightmean(cubelet, rmslet):
-
-    ccubelet = np.ones_like(cubelet)
-    crmslet = np.ones_like(cubelet)
+def spaceweightmean(cubelet, rmslet, width=3):
+    """
+    inverse-variance weighted mean of each spaxel's width x width neighbourhood, in every
+    channel. the weight and weighted-value sums are done as box sums over the whole cube
+    rather than one weightmean call per spaxel. each window is laid out contiguously before
+    summing so the additions happen in the same order as nansum's and the output is
+    bit-for-bit what the per-spaxel weightmean gives
+    """
 
-    padcubelet = np.pad(cubelet, ((0,0), (1,1), (1,1)), 'constant', constant_values=np.nan)
-    padrmslet = np.pad(rmslet, ((0,0), (1,1), (1,1)), 'constant', constant_values=np.nan)
+    swv = np.lib.stride_tricks.sliding_window_view
+    padwidth = ((0,0), (width//2, (width-1)//2), (width//2, (width-1)//2))
 
-    for i in range(cubelet.shape[1]):
-        for j in range(cubelet.shape[2]):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = 1 / rmslet**2
+        valweights = cubelet * weights
 
-            ii1, ii2 = i, i+3
-            ij1, ij2 = j, j+3
+        sums = []
+        for arr in [valweights, weights]:
+            arr = np.pad(np.where(np.isnan(arr), 0., arr), padwidth, 'constant', constant_values=0.)
+            windows = swv(arr, (width, width), axis=(1, 2))
+            sums.append(windows.reshape(windows.shape[:3] + (width**2,)).sum(axis=-1))
 
-            t, rms = weightmean(padcubelet[:,ii1:ii2,ij1:ij2], padrmslet[:,ii1:ii2,ij1:ij2], axis=(1,2))
-            ccubelet[:,i,j] = t
-            crmslet[:,i,j] = rms
+        ccubelet = sums[0] / sums[1]
+        crmslet = np.sqrt(1 / sums[1])
 
     return ccubelet, crmslet
 
@@ -1455,3 +1525,102 @@ def voxel_occupation(catinst, mapinst, title=None):
     
     return fig, perocc
     return fig, (usax,sax,freqax)
+
+
+""" DEFERRED PLOTTING """
+def plot_params(params):
+    """
+    shallow copy of params without the big cached operators, for recording with a deferred plot
+    """
+    plotpars = copy.copy(params)
+    for attr in ['pscache']:
+        try:
+            delattr(plotpars, attr)
+        except AttributeError:
+            pass
+    return plotpars
+
+def plot_cat(cat, inobjidx):
+    """ just the catalogue columns the overplotters use, for the objects in inobjidx """
+    plotcat = empty_table()
+    plotcat.z = cat.z[inobjidx]
+    plotcat.coords = cat.coords[inobjidx]
+    plotcat.idx = cat.idx[inobjidx]
+    try:
+        plotcat.catfileidx = cat.catfileidx[inobjidx]
+    except AttributeError:
+        pass
+    return plotcat
+
+def plot_map(comap):
+    """ the channel-averaged rms and the bin edges of a map (all the overplotters use) """
+    plotmap = empty_table()
+    plotmap.rms = np.nanmean(comap.rms, axis=0)[None,:,:]
+    plotmap.rabe, plotmap.decbe = comap.rabe, comap.decbe
+    return plotmap
+
+def plot_cubelet(cube):
+    """ shallow copy of a cubelet without any per-cutout or padded arrays hanging off it """
+    plotcube = copy.copy(cube)
+    for attr in ['cubestack', 'cubestackrms', 'padcube', 'padcuberms']:
+        try:
+            delattr(plotcube, attr)
+        except AttributeError:
+            pass
+    return plotcube
+
+def record_plot(plotter, name, params, args=(), kwargs=None, fieldstr=None):
+    """
+    instead of drawing it, pickle the (small) arguments for a call plotter(*args, **kwargs)
+    to the plotting function named plotter into plotsavepath/fieldstr/deferred/name.pkl, to be drawn later by
+    render_deferred_plots. the arguments should already have been slimmed down (with
+    plot_params, plot_cubelet, etc)
+    """
+    if not fieldstr:
+        fieldstr = ''
+
+    plotdir = params.plotsavepath + fieldstr + '/deferred'
+    if not os.path.exists(plotdir):
+        os.makedirs(plotdir)
+
+    if not kwargs:
+        kwargs = {}
+
+    recipe = {'plotter': plotter, 'args': args, 'kwargs': kwargs}
+    recipefile = plotdir + '/' + name + '.pkl'
+    with open(recipefile, 'wb') as f:
+        pickle.dump(recipe, f)
+
+    return recipefile
+
+def render_plot(recipefile):
+    """ draw (and save, if the recorded params say to) a single recorded plot with Agg """
+    plt.switch_backend('Agg')
+
+    with open(recipefile, 'rb') as f:
+        recipe = pickle.load(f)
+
+    globals()[recipe['plotter']](*recipe['args'], **recipe['kwargs'])
+    plt.close('all')
+
+    return recipefile
+
+def render_deferred_plots(plotdir, nthreads=1, remove=False):
+    """
+    draw all the plots recorded (by a run with deferplots on) anywhere under plotdir. with
+    nthreads > 1 they're drawn in a process pool. if remove, the recordings are deleted
+    once their plot is drawn
+    """
+    recipefiles = sorted(glob.glob(os.path.join(plotdir, '**', 'deferred', '*.pkl'), recursive=True))
+
+    if nthreads > 1:
+        with multiprocessing.Pool(nthreads) as pool:
+            done = pool.map(render_plot, recipefiles)
+    else:
+        done = [render_plot(recipefile) for recipefile in recipefiles]
+
+    if remove:
+        for recipefile in done:
+            os.remove(recipefile)
+
+    return done
@@ -0,0 +1,30 @@
+# load some base packages
+import sys
+
+# load in the stacking package
+import lim_stacker as st
+from lim_stacker.benchmark import _git_commit
+
+"""example file to benchmark the code"""
+
+""" RUN """
+# times the stacking hot paths on deterministic synthetic COMAP-shaped maps and a
+# HETDEX-like catalogue (nothing needs to be downloaded). results are saved as JSON,
+# named after the commit if one isn't given
+outfile = sys.argv[1] if len(sys.argv) > 1 else None
+if not outfile:
+    commit, dirty = _git_commit(st.__path__[0])
+    outfile = 'benchmark_{}{}.json'.format(str(commit)[:10], '_dirty' if dirty else '')
+
+results = st.run_benchmarks(outfile, nobj=300, nrep=3, niter=3, nthreads=2)
+
+""" COMPARE """
+# to compare against an earlier run (ratios above 1 are slowdowns):
+if len(sys.argv) > 2:
+    st.compare_benchmarks(sys.argv[2], outfile)
+
+""" SCALING """
+# to characterise parallel_field_stack (speed-up, worker memory, queue traffic) over
+# numbers of processes, catalogue sizes and map sizes:
+# rows = st.scaling_study('scaling.json', nthreads=(1, 2, 4, 8), nobjs=(300, 1000, 3000),
+#                         npixs=(60, 120), plotdir='scaling_plots')
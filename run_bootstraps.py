@@ -68,7 +68,7 @@ tidxlist = st.random_stacker_setup(comaplist, qsolist, params)
 print('Done Setup')
 
 """ STACKS ON RANDOM LOCATIONS """
-# ****fix your VERY bad saving iteratively!!
-""" STACKS ON RANDOM LOCATIONS """
+# each finished stack is checkpointed to params.itersavefile -- if the run dies,
+# rerun with resume=True to pick up where it left off
 Tvals, Trmsvals = st.n_random_stacks(10000, tidxlist, comaplist, qsolist, params,
-                                         verbose=True, itersave=True)
+                                         verbose=True, resume=False)
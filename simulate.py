@@ -2,16 +2,16 @@ from __future__ import absolute_import, print_function
 from .tools import *
 from .stack import *
 import numpy as np
-import matplotlib.pyplot as plt
+plt = lazy_import('matplotlib.pyplot')
 import astropy.units as u
 import astropy.constants as const
 import os
-import pandas as pd
+pd = lazy_import('pandas')
 import h5py
 import glob
 from astropy.convolution import convolve, Gaussian2DKernel
 from astropy.convolution import convolve_fft, Gaussian1DKernel, Kernel
-from astropy.io import fits
+fits = lazy_import('astropy.io.fits')
 import warnings
 warnings.filterwarnings("ignore", message="invalid value encountered in true_divide")
 warnings.filterwarnings("ignore", message="invalid value encountered in power")
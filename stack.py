@@ -4,39 +4,46 @@ from .plottools import *
 from .cubefilters import *
 import os
 import copy
+import time
+import pickle
 import numpy as np
-import matplotlib.pyplot as plt
 from astropy.coordinates import SkyCoord
 from astropy.cosmology import FlatLambdaCDM
 import astropy.units as u
 import astropy.constants as const
 from astropy.convolution import convolve, Gaussian2DKernel, Tophat2DKernel
-from astropy.modeling import models, fitting
 import warnings
 import csv
-import pandas as pd
 import multiprocessing
 from multiprocessing import Queue, Process, Manager
 
-from spectral_cube import SpectralCube
-from spectral_cube.utils import SpectralCubeWarning
-from radio_beam import Beam
-from reproject import reproject_adaptive
+# heavy optional dependencies: only imported when they're actually used
+plt = lazy_import('matplotlib.pyplot')
+models = lazy_import('astropy.modeling.models')
+fitting = lazy_import('astropy.modeling.fitting')
+pd = lazy_import('pandas')
+
+SpectralCube = lazy_import('spectral_cube', 'SpectralCube')
+Beam = lazy_import('radio_beam', 'Beam')
+reproject_adaptive = lazy_import('reproject', 'reproject_adaptive')
 
 # for photometric aperture extraction
-from photutils.psf import PSFPhotometry, CircularGaussianSigmaPRF
+PSFPhotometry = lazy_import('photutils.psf', 'PSFPhotometry')
+CircularGaussianSigmaPRF = lazy_import('photutils.psf', 'CircularGaussianSigmaPRF')
 IntegratedGaussianPRF = CircularGaussianSigmaPRF
-from astropy.table import QTable
+QTable = lazy_import('astropy.table', 'QTable')
 
 # for fitting gaussian 3D PRF extraction
 from scipy import special as sp
-from scipy.optimize import curve_fit
-from scipy.optimize import least_squares
+from scipy import sparse
+ndimage = lazy_import('scipy.ndimage')
+curve_fit = lazy_import('scipy.optimize', 'curve_fit')
+sfft = lazy_import('scipy.fft')
+least_squares = lazy_import('scipy.optimize', 'least_squares')
 
 # ignore warnings:
 # divide by zero
 np.seterr(divide='ignore', invalid='ignore')
-warnings.filterwarnings("ignore", category=SpectralCubeWarning, append=True)
 
 # photutils fitting warnings
 import warnings
@@ -135,12 +142,22 @@ class cubelet():
         self.drhoh2 = cutout.drhoh2
 
     def from_files(self, path, params, xstep=None):
+        """
+        path is either a directory of output_values.csv/npz files, or a results store: either
+        'results.h5/name' for the stack 'name' in it ('combined' if no name is given) or a
+        directory with only a results.h5. the cube and rms arrays are only read from a
+        results store when they're first used
+        """
 
         # paths to specific data files
         cubefile = path + '/stacked_3d_cubelet.npz'
         valuefile = path + '/output_values.csv'
         idxfile = path + '/included_cat_indices.npz'
 
+        storefile, name = split_store_path(path)
+        if not storefile and not os.path.exists(cubefile) and os.path.exists(path + '/results.h5'):
+            storefile, name = path + '/results.h5', 'combined'
+
         # params info
         self.unit = params.plotunits
         self.adaptivephotometry = params.adaptivephotometry
@@ -157,15 +174,23 @@ class cubelet():
         self.freqwidth = params.freqwidth
 
         # load in cubelet
-        with np.load(cubefile) as f:
-            cubevals = f['T']
-            rmsvals = f['rms']
+        if storefile:
+            with store_file(storefile, 'r') as f:
+                grp = f['stacks/' + name]
+                cubeshape = grp['cube'].shape
+                storevals = dict(grp.attrs)
+                indices = grp['catidx'][()]
+            self._storesource = (storefile, 'stacks/' + name)
+        else:
+            with np.load(cubefile) as f:
+                cubevals = f['T']
+                rmsvals = f['rms']
 
-        self.cube = cubevals
-        self.cuberms = rmsvals
+            self.cube = cubevals
+            self.cuberms = rmsvals
+            cubeshape = cubevals.shape
 
         # metainfo about cubelet
-        cubeshape = cubevals.shape
         self.cubexwidth = cubeshape[2]
         self.cubeywidth = cubeshape[1]
         self.cubefreqwidth = cubeshape[0]
@@ -192,6 +217,14 @@ class cubelet():
         else:
             self.xarr = np.arange(params.spacestackwidth * 2 + 1) * xstep - (params.spacestackwidth) * xstep
 
+        if storefile:
+            self.linelum, self.dlinelum = storevals['linelum'], storevals['dlinelum']
+            self.rhoh2, self.drhoh2 = storevals['rhoh2'], storevals['drhoh2']
+            self.ncutouts = storevals['nobj']
+            self.nuobs_mean, self.z_mean = storevals['nuobs_mean'], storevals['z_mean']
+            self.catidx = indices
+            return
+
         # load in output values
         outvals = pd.read_csv(valuefile)
 
@@ -222,6 +255,17 @@ class cubelet():
 
         self.catidx = indices
 
+    def __getattr__(self, attr):
+        # cubelets read from a results store only pull the cube arrays in when they're used
+        storesource = self.__dict__.get('_storesource')
+        if attr in ['cube', 'cuberms'] and storesource:
+            with store_file(storesource[0], 'r') as f:
+                self.cube = f[storesource[1] + '/cube'][()]
+                self.cuberms = f[storesource[1] + '/rms'][()]
+            del self._storesource
+            return getattr(self, attr)
+        raise AttributeError(attr)
+
     def stackin(self, cutout):
         # add a single cutout into the stacked cubelet
 
@@ -285,6 +329,17 @@ class cubelet():
         if not cubelet:
             del (cubelet)
             return
+
+        # the stacks an aperture sweep is measured on, if either isn't just the whole stack
+        # (sweepcube is None if nothing fit the largest swept aperture)
+        sweepmerge = hasattr(self, 'sweepcube') or hasattr(cubelet, 'sweepcube')
+        if sweepmerge:
+            sweepcube = self.sweepcube if hasattr(self, 'sweepcube') else self.copy()
+            othersweep = getattr(cubelet, 'sweepcube', cubelet)
+            if not sweepcube:
+                sweepcube = othersweep.copy() if othersweep else None
+            else:
+                sweepcube.stackin_cubelet(othersweep, params, weights=weights)
         
         # stack together the 3d cubelets
         cubevals = np.stack((self.cube, cubelet.cube))
@@ -367,6 +422,15 @@ class cubelet():
         self.z_mean = z_mean
         self.ncutouts = self.ncutouts + cubelet.ncutouts
 
+        # per-object contributions go along with the objects
+        if getattr(cubelet, 'contributions', None) is not None:
+            if getattr(self, 'contributions', None) is None:
+                self.contributions = contribution_store()
+            self.contributions.concatenate(cubelet.contributions)
+
+        if sweepmerge:
+            self.sweepcube = sweepcube
+
             # print('stacked lco list length: ', len(self.prf_stacklco))
         del (cubelet)
         return
@@ -406,7 +470,7 @@ class cubelet():
 
         # actual COMAP beam
         try:
-            beam_fwhm = (params.goalbeamscale / cosmo.kpc_proper_per_arcmin(self.z_mean)).to(u.arcmin)
+            beam_fwhm = (params.goalbeamscale / get_cosmo(params).kpc_proper_per_arcmin(self.z_mean)).to(u.arcmin)
             self.beamscale = beam_fwhm
         except AttributeError:
             beam_fwhm = params.beamwidth * u.arcmin
@@ -465,13 +529,14 @@ class cubelet():
 
         freqbc = self.nuobs_mean[0] + self.freqarr
 
-        nuobs = np.tile(freqbc, (self.cube.shape[2], self.cube.shape[1], 1)).T * u.GHz
+        # observed frequency of each channel (broadcasts across the spatial axes)
+        nuobs = freqbc[:, None, None] * u.GHz
 
         # find redshift from nuobs:
         zval = freq_to_z(params.centfreq * u.GHz, nuobs)  # *****************
 
         # luminosity distance in Mpc
-        DLs = params.cosmo.luminosity_distance(zval)
+        DLs = get_cosmo(params).luminosity_distance(zval)
 
         # line luminosity
         linelum = const.c ** 2 / (2 * const.k_B) * self.cube * DLs ** 2 / (nuobs ** 2 * (1 + zval) ** 3)
@@ -498,8 +563,9 @@ class cubelet():
         dlinelum = dlinelum.to(u.K * u.km / u.s * u.pc ** 2)
 
         # store in object
-        self.cube = linelum.value.astype('float64')
-        self.cuberms = dlinelum.value.astype('float64')
+        # (cutouts keep the map's storage precision -- stacks get accumulated in double)
+        self.cube = linelum.value.astype(storage_dtype(params))
+        self.cuberms = dlinelum.value.astype(storage_dtype(params))
         self.unit = 'linelum'
 
         return
@@ -749,6 +815,54 @@ class cubelet():
             self.aperture_rms = dval
         return val, dval
 
+    def aperture_sweep(self, xwidths, ywidths, freqwidths):
+        """
+        the weightmean aperture value, spectrum and image (as get_aperture, get_spectrum
+        and get_image give them) for every combination of the passed (odd) aperture widths,
+        all read off nested box sums of this cubelet. returns a dict of columns with one
+        row per aperture (and the number of objects stacked in nobj)
+        """
+        cube, cuberms = as_double(self.cube), as_double(self.cuberms)
+        cent = self.centpix
+        for (widths, n) in [(freqwidths, cube.shape[0]), (ywidths, cube.shape[1]), (xwidths, cube.shape[2])]:
+            if np.any(np.array(widths) % 2 == 0) or np.max(widths) > n:
+                raise ValueError("aperture_sweep: widths {} have to be odd and fit in the cubelet".format(widths))
+
+        # summed-area tables of every channel, so each centred spatial box is four lookups
+        weights = 1 / cuberms**2
+        valweights = np.where(np.isnan(cube * weights), 0., cube * weights)
+        weights = np.where(np.isnan(weights), 0., weights)
+        tables = [np.pad(np.cumsum(np.cumsum(arr, axis=1), axis=2), ((0, 0), (1, 0), (1, 0)))
+                  for arr in (valweights, weights)]
+
+        def boxsums(ywidth, xwidth):
+            y0, y1 = cent[1] - ywidth // 2, cent[1] + ywidth // 2 + 1
+            x0, x1 = cent[2] - xwidth // 2, cent[2] + xwidth // 2 + 1
+            return [table[:, y1, x1] - table[:, y0, x1] - table[:, y1, x0] + table[:, y0, x0]
+                    for table in tables]
+
+        columns = {key: [] for key in ['freqwidth', 'ywidth', 'xwidth', 'linelum', 'dlinelum',
+                                       'spectrum', 'dspectrum', 'image', 'dimage']}
+        for freqwidth in freqwidths:
+            apchans = slice(cent[0] - freqwidth // 2, cent[0] + freqwidth // 2 + 1)
+            im = np.nansum(cube[apchans], axis=0)
+            dim = np.sqrt(np.nansum(cuberms[apchans] ** 2, axis=0))
+            for ywidth in ywidths:
+                for xwidth in xwidths:
+                    valsum, weightsum = boxsums(ywidth, xwidth)
+                    # correct for adjusted solid angle
+                    spec = valsum / weightsum * xwidth * ywidth
+                    dspec = np.sqrt(1 / weightsum) * xwidth * ywidth
+
+                    for (key, val) in [('freqwidth', freqwidth), ('ywidth', ywidth), ('xwidth', xwidth),
+                                       ('linelum', np.nansum(spec[apchans])),
+                                       ('dlinelum', np.sqrt(np.nansum(dspec[apchans] ** 2))),
+                                       ('spectrum', spec), ('dspectrum', dspec), ('image', im), ('dimage', dim)]:
+                        columns[key].append(val)
+
+        columns['nobj'] = [self.ncutouts] * len(columns['linelum'])
+        return {key: np.array(val) for (key, val) in columns.items()}
+
     def pad(self):
         """ padwidth = (freq, x, y) is the amount added to each axis """
 
@@ -803,24 +917,26 @@ class cubelet():
             self.aperture_rms = dval
         return val, dval
     
-    def aperture_vid(self):
-        """ get intensity distribution of aperture-sized regions in the cubelet """
+    def aperture_vid(self, method='weightmean'):
+        """
+        get intensity distribution of aperture-sized regions in the cubelet. all the
+        offset apertures are done at once with box sums over the padded cubelet, in the
+        same order the offsets were looped over in (freq, then y, then x)
+        """
+
+        fpad, xypad = self.freqwidth, self.xwidth
+        pcube = np.pad(self.cube, ((fpad,fpad), (xypad,xypad), (xypad,xypad)), mode='constant', constant_values=np.nan)
+        pcuberms = np.pad(self.cuberms, ((fpad,fpad), (xypad,xypad), (xypad,xypad)), mode='constant', constant_values=np.nan)
 
-        self.pad()
+        apshape = np.array(self.apmaxpix) - np.array(self.apminpix)
+        vals, dvals = aperture_box_values(pcube, pcuberms, *apshape, method=method)
 
-        outvallist, outdvallist = [], []
         fext = (self.cube.shape[0] - self.freqwidth)//2
         xext = (self.cube.shape[1] - self.xwidth)//2
-        for i in np.arange(-fext,fext):
-            for j in np.arange(-xext,xext):
-                for k in np.arange(-xext,xext):
-                    val, dval = self.get_offset_aperture(offset=(i,j,k))
-
-                    outvallist.append(val)
-                    outdvallist.append(dval)
-
-        return np.array(outvallist).flatten(), np.array(outdvallist).flatten()
+        f0, y0, x0 = np.array(self.apminpix) + (fpad, xypad, xypad)
+        window = (slice(f0 - fext, f0 + fext), slice(y0 - xext, y0 + xext), slice(x0 - xext, x0 + xext))
 
+        return vals[window].flatten(), dvals[window].flatten()
 
     def get_output_dict(self, in_place=False, params=None):
         if self.adaptivephotometry:
@@ -879,7 +995,18 @@ class cubelet():
         if not isinstance(comap, list):
 
             if params.saveplots:
-                field_catalogue_overplotter(galcat, comap, self.catidx, params, fieldstr=fieldstr)
+                if getattr(params, 'deferplots', False):
+                    inobjidx = np.where(np.in1d(galcat.catfileidx, self.catidx))
+                    record_plot('field_catalogue_overplotter', 'catalogue_object_distribution', params,
+                                args=(plot_cat(galcat, inobjidx), plot_map(comap), self.catidx,
+                                      plot_params(params)),
+                                kwargs={'fieldstr': fieldstr}, fieldstr=fieldstr)
+                else:
+                    field_catalogue_overplotter(galcat, comap, self.catidx, params, fieldstr=fieldstr)
+
+            if not (params.plotspace and params.plotfreq):
+                # nothing else to plot (and don't import matplotlib for nothing)
+                return
 
             if params.plotspace and params.plotfreq:
                 if params.adaptivephotometry:
@@ -910,7 +1037,13 @@ class cubelet():
 
         else:
             if params.saveplots:
-                catalogue_overplotter(galcat, comap, self.catidx, params)
+                if getattr(params, 'deferplots', False):
+                    plotcats = [plot_cat(cat, np.where(np.in1d(cat.idx, self.catidx))) for cat in galcat]
+                    record_plot('catalogue_overplotter', 'catalogue_object_distribution', params,
+                                args=(plotcats, [plot_map(m) for m in comap], self.catidx,
+                                      plot_params(params)))
+                else:
+                    catalogue_overplotter(galcat, comap, self.catidx, params)
 
             if params.plotspace and params.plotfreq:
                 if params.adaptivephotometry:
@@ -936,9 +1069,16 @@ class cubelet():
 
         outdict = self.get_output_dict(params=params)
 
-        combined_plotter(self, params, stackim=im, stackrms=dim,
-                        stackspec=spec, cmap='PiYG_r',
-                        stackresult=outdict, comment=comment, fieldstr=fieldstr)
+        if getattr(params, 'deferplots', False):
+            record_plot('combined_plotter', 'combinedstackim', params,
+                        args=(plot_cubelet(self), plot_params(params)),
+                        kwargs={'stackim': im, 'stackrms': dim, 'stackspec': spec, 'cmap': 'PiYG_r',
+                                'stackresult': outdict, 'comment': comment, 'fieldstr': fieldstr},
+                        fieldstr=fieldstr)
+        else:
+            combined_plotter(self, params, stackim=im, stackrms=dim,
+                            stackspec=spec, cmap='PiYG_r',
+                            stackresult=outdict, comment=comment, fieldstr=fieldstr)
 
         return
 
@@ -947,6 +1087,32 @@ class cubelet():
         if not fieldstr:
             fieldstr = ''
 
+        # timings/rejection counts, if this stack was profiled
+        save_profile(getattr(self, 'profile', None), params, fieldstr)
+
+        # per-object contributions, if they were kept
+        if getattr(self, 'contributions', None) is not None:
+            self.contributions.save(params, fieldstr)
+
+        # the stack in other aperture sizes, if sweeping (on its own stack if some of the
+        # objects didn't fit the largest aperture)
+        sweepwidths = aperture_sweep_widths(params)
+        if sweepwidths:
+            sweepcube = getattr(self, 'sweepcube', self)
+            if sweepcube:
+                save_aperture_sweep(sweepcube.aperture_sweep(*sweepwidths), params, fieldstr)
+            else:
+                warnings.warn("No objects fit the largest swept aperture -- not saving an aperture sweep",
+                              RuntimeWarning)
+
+        # everything into the one results store
+        if getattr(params, 'resultsformat', 'csv') == 'hdf5':
+            outdict = self.get_output_dict(params=params)
+            store_params(params.resultsfile, params)
+            store_cubelet(params.resultsfile, fieldstr.strip('/') or 'combined', self.cube,
+                          self.cuberms, self.catidx, outdict)
+            return
+
         # save the output values
         ovalfile = params.datasavepath + fieldstr + '/output_values.csv'
         # strip the values of their units before saving them (otherwise really annoying
@@ -963,6 +1129,102 @@ class cubelet():
         return
 
 
+""" APERTURE SWEEPS """
+
+
+def aperture_sweep_widths(params):
+    """
+    the (xwidths, ywidths, freqwidths) lists to sweep the stack aperture over, or None if
+    no sweep is set. any not given are just the run's own width
+    """
+    sweep = [getattr(params, 'sweep' + name + 'widths', False) for name in ['x', 'y', 'freq']]
+    if not any(sweep):
+        return None
+    own = [params.xwidth, params.ywidth, params.freqwidth]
+    return tuple([width] if not widths else list(np.atleast_1d(widths))
+                 for (widths, width) in zip(sweep, own))
+
+
+def aperture_sweep_params(params):
+    """
+    a copy of params with the largest aperture of the sweep (and the run's own), for the
+    cutout cuts every object in a swept stack has to pass. None if there's no sweep
+    """
+    sweepwidths = aperture_sweep_widths(params)
+    if not sweepwidths:
+        return None
+    sweepparams = params.copy()
+    sweepparams.xwidth, sweepparams.ywidth, sweepparams.freqwidth = (
+        int(max(max(widths), width)) for (widths, width) in zip(sweepwidths, (params.xwidth, params.ywidth,
+                                                                               params.freqwidth)))
+    return sweepparams
+
+
+def aperture_sweep_filter_params(params):
+    """
+    aperture_sweep_params if any of the cutout filters are on and the sweep goes past the
+    run's own aperture, otherwise None. the filters size their masks and fit regions from
+    the aperture, so a swept stack has to be of cutouts filtered for its largest aperture
+    (or the bigger apertures would overlap the regions the filters were fit to)
+    """
+    if not (params.specmeanfilter or params.chanmeanfilter or params.lowmodefilter):
+        return None
+    sweepparams = aperture_sweep_params(params)
+    if not sweepparams:
+        return None
+    if (sweepparams.xwidth, sweepparams.ywidth, sweepparams.freqwidth) == (params.xwidth, params.ywidth,
+                                                                           params.freqwidth):
+        return None
+    return sweepparams
+
+
+def sweep_stackin(sweepinst, newinst, params, weight=None):
+    """
+    add the (unweighted) cubelet of one object into the aperture sweep's stack sweepinst,
+    starting it if it's None. returns the sweep's stack
+    """
+    if sweepinst is None:
+        sweepinst = newinst.copy()
+        if weight:
+            sweepinst.weight_rms(weight)
+    else:
+        sweepinst.stackin_cubelet(newinst, params, weights=weight)
+    return sweepinst
+
+
+def sweep_prefilter(galcat, comap, params, keep, profile=null_profile):
+    """
+    the objects out of the cutout_prefilter result keep that would also pass with the
+    largest aperture of an aperture sweep (if there is one), so every aperture in the
+    sweep is measured on the same objects. only the sweep table is cut down to these --
+    the stack itself is still of everything in keep
+    """
+    sweepparams = aperture_sweep_params(params)
+    if not sweepparams:
+        return keep
+    sweepkeep = keep & cutout_prefilter(galcat, comap, sweepparams)
+    profile.count('sweepdropped', np.count_nonzero(keep & ~sweepkeep))
+    return sweepkeep
+
+
+def save_aperture_sweep(columns, params, fieldstr=None):
+    """
+    save an aperture_sweep table with the rest of the stack outputs: the aperture values
+    in aperture_sweep.csv and every column (spectra and images too) in aperture_sweep.npz,
+    or the lot under apertures/ in the results store
+    """
+    if not fieldstr:
+        fieldstr = ''
+    if getattr(params, 'resultsformat', 'csv') == 'hdf5':
+        store_write_rows(params.resultsfile, 'apertures/' + (fieldstr.strip('/') or 'combined'), columns)
+        return
+
+    scalars = [key for (key, val) in columns.items() if val.ndim == 1]
+    dict_saver([{key: columns[key][i] for key in scalars} for i in range(len(columns['linelum']))],
+               params.datasavepath + fieldstr + '/aperture_sweep.csv')
+    np.savez(params.datasavepath + fieldstr + '/aperture_sweep.npz', **columns)
+
+
 """ CUTOUT FILTERS """
 
 
@@ -1002,7 +1264,7 @@ def physical_spacing_setup(mapinst, params):
     zexts = freq_to_z(params.centfreq, fexts)
 
     # kpc/arcmin in the extrema
-    worstchanscale = params.cosmo.kpc_proper_per_arcmin(zexts[1])
+    worstchanscale = get_cosmo(params).kpc_proper_per_arcmin(zexts[1])
 
     # worst beam scale in mpc
     worstbeamscale = (worstchanscale * params.beamwidth * u.arcmin).to(u.Mpc)
@@ -1030,6 +1292,46 @@ def physical_spacing_setup(mapinst, params):
     params.goaldv = goaldv
     params.goalfsize = oldnaxis1
 
+    # any cached physical spacing operators were built for the old scales
+    params.pscache = {}
+
+
+def physical_spacing_wcs(cutout, mapinst, params, oversamp_factor=5):
+    """
+    input (oversampled cutout) and goal wcs headers for the physical spacing of cutout.
+    the precomputed operators are registered off the same pair so both versions of
+    physical_spacing put the object in the same place
+    """
+
+    xstep = mapinst.xstep / oversamp_factor
+    xpixcent = params.spacestackwidth * oversamp_factor
+    fpixval = (mapinst.freq[cutout.freqidx[0] + params.freqwidth // 2] + mapinst.fstep / 2) * 1e9
+    xpixval = mapinst.ra[cutout.xidx[0] + params.xwidth // 2] + mapinst.xstep / 2
+    ypixval = mapinst.dec[cutout.yidx[0] + params.ywidth // 2] + mapinst.ystep / 2
+
+    inwcsdict = {"CTYPE1": 'FREQ', 'CDELT1': mapinst.fstep * 1e9, 'CRPIX1': params.freqstackwidth + 1,
+                'CRVAL1': fpixval,
+                "CTYPE3": 'RA---CAR', 'CUNIT3': 'deg', 'CDELT3': xstep, 'CRPIX3': xpixcent, 'CRVAL3': xpixval,
+                "CTYPE2": 'DEC--CAR', 'CUNIT2': 'deg', 'CDELT2': xstep, 'CRPIX2': xpixcent, 'CRVAL2': ypixval,
+                "ZSOURCE": cutout.z}
+
+    #  set up the goal wcs -- new cdelt
+    chanscale = get_cosmo(params).kpc_proper_per_arcmin(cutout.z)
+    chansize = (chanscale * xstep * u.deg).to(u.Mpc)
+    resampfac = (params.goalres / chansize).value
+    outcdelt2 = xstep * resampfac
+    # set up the goal wcs -- new crpix
+    mapcent = params.goalxsize // 2
+    fmapcent = params.freqstackwidth
+    outwcsdict = {"CTYPE1": 'FREQ', 'CDELT1': mapinst.fstep * 1e9, 'CRPIX1': fmapcent,
+                'CRVAL1': (cutout.freq - mapinst.fstep) * 1e9,
+                "CTYPE3": 'RA---CAR', 'CUNIT3': 'deg', 'CDELT3': outcdelt2,
+                'CRPIX3': mapcent, 'CRVAL3': cutout.x,
+                "CTYPE2": 'DEC--CAR', 'CUNIT2': 'deg', 'CDELT2': outcdelt2,
+                'CRPIX2': mapcent, 'CRVAL2': cutout.y}
+
+    return inwcsdict, outwcsdict
+
 
 def physical_spacing(cutout, mapinst, params, oversamp_factor=5, do_spectral=True, conserve_flux=False):
     """
@@ -1062,6 +1364,11 @@ def physical_spacing(cutout, mapinst, params, oversamp_factor=5, do_spectral=Tru
         elif mapinst.unit == 'flux':
             print('Map is in flux units -- unit conversion will be done improperly')
 
+    # precomputed sparse operators unless the spectral-cube/reproject version is asked for
+    if getattr(params, 'psfast', False) and not conserve_flux:
+        return physical_spacing_apply(cutout, mapinst, params, oversamp_factor=oversamp_factor,
+                                      do_spectral=do_spectral)
+
     # test to make sure the prep function has been run
     # ** maybe force this to run anyways in field stack? in case map parameters change in a jupyter notebook session or smth
     try:
@@ -1076,18 +1383,13 @@ def physical_spacing(cutout, mapinst, params, oversamp_factor=5, do_spectral=Tru
     ### set up the input cube
     # WCS object w the oversampling taken into account
     xstep = mapinst.xstep / oversamp_factor
-    xpixcent = params.spacestackwidth * oversamp_factor
-    fpixval = (mapinst.freq[outcutout.freqidx[0] + params.freqwidth // 2] + mapinst.fstep / 2) * 1e9
-    xpixval = mapinst.ra[outcutout.xidx[0] + params.xwidth // 2] + mapinst.xstep / 2
-    ypixval = mapinst.dec[outcutout.yidx[0] + params.ywidth // 2] + mapinst.ystep / 2
-
-    inwcsdict = {"CTYPE1": 'FREQ', 'CDELT1': mapinst.fstep * 1e9, 'CRPIX1': params.freqstackwidth + 1,
-                'CRVAL1': fpixval,
-                "CTYPE3": 'RA---CAR', 'CUNIT3': 'deg', 'CDELT3': xstep, 'CRPIX3': xpixcent, 'CRVAL3': xpixval,
-                "CTYPE2": 'DEC--CAR', 'CUNIT2': 'deg', 'CDELT2': xstep, 'CRPIX2': xpixcent, 'CRVAL2': ypixval,
-                "ZSOURCE": outcutout.z}
+    inwcsdict, outwcsdict = physical_spacing_wcs(outcutout, mapinst, params, oversamp_factor)
     inwcs = wcs.WCS(inwcsdict)
 
+    # spectral_cube is only imported here, so its warnings are only silenced here too
+    from spectral_cube.utils import SpectralCubeWarning
+    warnings.filterwarnings("ignore", category=SpectralCubeWarning, append=True)
+
     # input cube
     cube = SpectralCube(data=outcutout.cubestack.T, wcs=inwcs)
     cuberms = SpectralCube(data=1 / outcutout.cubestackrms.T ** 2, wcs=inwcs)
@@ -1102,7 +1404,7 @@ def physical_spacing(cutout, mapinst, params, oversamp_factor=5, do_spectral=Tru
 
     ### reconvolve to the uniform beam scale
     # physical scale conversion in this channel
-    chanscale = params.cosmo.kpc_proper_per_arcmin(outcutout.z)
+    chanscale = get_cosmo(params).kpc_proper_per_arcmin(outcutout.z)
     # beam size in this channel to give constant beam resolution in mpc
     goalchanbeam = (params.goalbeamscale / chanscale).to(u.arcmin)
     # as a beam object -- this is the common beam to convolve to
@@ -1112,19 +1414,7 @@ def physical_spacing(cutout, mapinst, params, oversamp_factor=5, do_spectral=Tru
     rcrms = cuberms.convolve_to(goal_beam)
 
     ### spatial reprojection
-    #  set up the goal wcs -- new cdelt
-    chansize = (chanscale * xstep * u.deg).to(u.Mpc)
-    resampfac = (params.goalres / chansize).value
-    outcdelt2 = xstep * resampfac
-    # set up the goal wcs -- new crpix
-    mapcent = params.goalxsize // 2
-    fmapcent = params.freqstackwidth
-    outwcsdict = {"CTYPE1": 'FREQ', 'CDELT1': mapinst.fstep * 1e9, 'CRPIX1': fmapcent,
-                'CRVAL1': (outcutout.freq - mapinst.fstep) * 1e9,
-                "CTYPE3": 'RA---CAR', 'CUNIT3': 'deg', 'CDELT3': outcdelt2,
-                'CRPIX3': mapcent, 'CRVAL3': outcutout.x,
-                "CTYPE2": 'DEC--CAR', 'CUNIT2': 'deg', 'CDELT2': outcdelt2,
-                'CRPIX2': mapcent, 'CRVAL2': outcutout.y}
+    # the goal wcs
     outwcs = wcs.WCS(outwcsdict)
     spacehdr = outwcs.to_header()
     spacehdr['NAXIS'] = 3
@@ -1207,16 +1497,359 @@ def physical_spacing(cutout, mapinst, params, oversamp_factor=5, do_spectral=Tru
     return outcutout
 
 
+def physical_spacing_spectral_kernel(nin, nout, cent, ratio):
+    """
+    one-dimensional sparse linear-interpolation operator for the spectral axis: output
+    channel k sits at input channel cent + (k - nout//2) * ratio. anything falling off the
+    end of the input is flagged so it can be set to nan
+    """
+    outpos = cent + (np.arange(nout) - nout // 2) * ratio
+    inbounds = (outpos >= 0) & (outpos <= nin - 1)
+
+    lo = np.clip(np.floor(outpos).astype(int), 0, nin - 2)
+    frac = outpos - lo
+    rows = np.concatenate((np.arange(nout), np.arange(nout)))
+    cols = np.concatenate((lo, lo + 1))
+    vals = np.concatenate((1 - frac, frac))
+    vals[~np.concatenate((inbounds, inbounds))] = 0.
+
+    weights = sparse.csr_matrix((vals, (rows, cols)), shape=(nout, nin))
+    support = sparse.csr_matrix(((vals != 0).astype(float), (rows, cols)), shape=(nout, nin))
+
+    return weights, support, inbounds
+
+
+def physical_spacing_centre(cutout, mapinst, params, oversamp_factor=5):
+    """
+    position (in cutout pixels, pixel centres at integers) of the central output voxel of
+    the physical spacing grid, worked out from the same wcs pair the spectral-cube version
+    of physical_spacing reprojects between
+    """
+
+    inwcsdict, outwcsdict = physical_spacing_wcs(cutout, mapinst, params, oversamp_factor)
+    inwcs = wcs.WCS(inwcsdict).celestial
+    outwcs = wcs.WCS(outwcsdict).celestial
+
+    mapcent = params.goalxsize // 2
+    world = outwcs.wcs_pix2world([[mapcent, mapcent]], 0)
+    decpix, rapix = (inwcs.wcs_world2pix(world, 0)[0] + 0.5) / oversamp_factor - 0.5
+
+    # the spectral-cube version hands reproject the transposed channels, so the ra axis of
+    # its wcs runs along the y axis of the cutout (and dec along x)
+    xcent, ycent = decpix, rapix
+
+    # and its velocity axis is centred on the object's channel
+    fcent = cutout.freqidx[0] + params.freqwidth // 2 - cutout.freqfreqidx[0]
+
+    return xcent, ycent, fcent
+
+
+def physical_spacing_operators(cutout, mapinst, params, oversamp_factor=5, zbinwidth=1e-3,
+                               noffbins=20, kernel_width=1.3, sample_region_width=4):
+    """
+    precompute (or pull from the cache in params.pscache) the sparse operators that
+    take a cutout onto the physical spacing grid. operators are binned in redshift (width
+    zbinwidth) and in sub-pixel offset of the object (noffbins per pixel) so they only have
+    to be built once for a given catalogue
+    kernel_width and sample_region_width follow the reproject_adaptive conventions (in
+    output pixels)
+    """
+
+    try:
+        _ = params.goalbeamscale
+    except AttributeError:
+        physical_spacing_setup(mapinst, params)
+
+    if not isinstance(getattr(params, 'pscache', None), dict):
+        params.pscache = {}
+    cache = params.pscache
+
+    nf, ny, nx = cutout.cubestack.shape
+    pcosmo = get_cosmo(params)
+
+    # redshift bin -- everything is evaluated at the bin centre
+    zbin = int(np.round(cutout.z / zbinwidth))
+    zcent = zbin * zbinwidth
+
+    # centre of the output grid in input pixel coordinates
+    xcent, ycent, fcent = physical_spacing_centre(cutout, mapinst, params, oversamp_factor)
+    xbin = int(np.round(xcent * noffbins))
+    ybin = int(np.round(ycent * noffbins))
+    fbin = int(np.round(fcent * noffbins))
+
+    # spatial scales for this redshift bin
+    skey = (zbin, nx, ny)
+    if skey not in cache:
+        chanscale = pcosmo.kpc_proper_per_arcmin(zcent)
+        inpix = (mapinst.xstep * u.deg).to(u.arcmin)
+        # output pixel size (arcmin) and ratio to the input pixel size
+        outpix = (params.goalres / chanscale).to(u.arcmin)
+        ratio = (outpix / inpix).value
+        # reconvolution to the common physical beam and the adaptive resampling window
+        goalchanbeam = (params.goalbeamscale / chanscale).to(u.arcmin).value
+        sigma = float(resampling_sigma(params.beamwidth, goalchanbeam, inpix.value, ratio, kernel_width))
+        halfwidth = sample_region_width / 2 * max(ratio, 1.)
+        cache[skey] = (ratio, sigma, halfwidth, outpix.value)
+    ratio, sigma, halfwidth, outpix = cache[skey]
+
+    xkey = ('space', zbin, nx, xbin)
+    if xkey not in cache:
+        cache[xkey] = resampling_operator(nx, params.goalxsize, xbin / noffbins, ratio, sigma, halfwidth)
+    ykey = ('space', zbin, ny, ybin)
+    if ykey not in cache:
+        cache[ykey] = resampling_operator(ny, params.goalxsize, ybin / noffbins, ratio, sigma, halfwidth)
+
+    # spectral axis: radio velocity relative to the observed line frequency
+    fkey = ('spec', zbin, nf, fbin)
+    if fkey not in cache:
+        nuobs = params.centfreq / (1 + zcent)
+        dfreq = (nuobs * params.goaldv / const.c.to(u.km / u.s)).value
+        cache[fkey] = physical_spacing_spectral_kernel(nf, params.goalfsize, fbin / noffbins,
+                                                       -dfreq / mapinst.fstep) + (dfreq,)
+
+    return cache[xkey], cache[ykey], cache[fkey], outpix
+
+
+def physical_spacing_apply(cutout, mapinst, params, oversamp_factor=5, do_spectral=True):
+    """
+    physical spacing using precomputed sparse operators (see physical_spacing_operators).
+    the map is reconvolved, resampled in space and interpolated in velocity as a few sparse
+    matrix products over all channels at once, and the variance is propagated through the
+    squared operators. nans are handled as normalized convolution: masked voxels get no
+    weight, and output voxels with no valid input in their support (or off the edge of the
+    cutout) are nan
+    """
+
+    (xop, xsupp, xin), (yop, ysupp, yin), (fop, fsupp, fin, dfreq), outpix = \
+        physical_spacing_operators(cutout, mapinst, params, oversamp_factor=oversamp_factor)
+
+    outcutout = cutout.copy()
+
+    data = np.asarray(cutout.cubestack, dtype=float)
+    var = np.asarray(cutout.cubestackrms, dtype=float) ** 2
+    good = np.isfinite(data) & np.isfinite(var)
+
+    # stack value and mask cubes so they share each sparse product; the variance goes
+    # through the squared operators
+    nf, ny, nx = data.shape
+    stackcube = np.stack((np.where(good, data, 0.), good.astype(float)))
+    varcube = np.where(good, var, 0.)
+
+    # x axis, then y axis
+    stackcube = (stackcube.reshape(-1, nx) @ xop.T).reshape(2, nf, ny, -1)
+    varcube = (varcube.reshape(-1, nx) @ xop.power(2).T).reshape(nf, ny, -1)
+    nxo = stackcube.shape[3]
+    stackcube = (stackcube.transpose(0, 1, 3, 2).reshape(-1, ny) @ yop.T).reshape(2, nf, nxo, -1)
+    varcube = (varcube.transpose(0, 2, 1).reshape(-1, ny) @ yop.power(2).T).reshape(nf, nxo, -1)
+    stackcube = stackcube.transpose(0, 1, 3, 2)
+    varcube = varcube.transpose(0, 2, 1)
+
+    # normalized by the summed kernel weight on good data
+    with np.errstate(divide='ignore', invalid='ignore'):
+        newcube = stackcube[0] / stackcube[1]
+        newvar = varcube / stackcube[1] ** 2
+    bad = (stackcube[1] <= 0) | ~yin[None, :, None] | ~xin[None, None, :]
+    newcube[bad] = np.nan
+    newvar[bad] = np.nan
+
+    if do_spectral:
+        nyo = newcube.shape[1]
+        bad = (fsupp @ bad.reshape(nf, -1).astype(float)) > 0
+        bad |= ~fin[:, None]
+        newcube = fop @ np.where(np.isnan(newcube), 0., newcube).reshape(nf, -1)
+        newvar = fop.power(2) @ np.where(np.isnan(newvar), 0., newvar).reshape(nf, -1)
+        newcube[bad] = np.nan
+        newvar[bad] = np.nan
+        newcube = newcube.reshape(-1, nyo, nxo)
+        newvar = newvar.reshape(-1, nyo, nxo)
+
+    outcutout.cubestack = newcube
+    outcutout.cubestackrms = np.sqrt(newvar)
+
+    # output grid
+    xoff = (np.array([0, params.goalxsize - 1]) - params.goalxsize // 2) * outpix / 60
+    voff = (np.array([0, params.goalfsize - 1]) - params.goalfsize // 2) * params.goaldv
+    outcutout.raext = (cutout.x + xoff / np.cos(np.deg2rad(cutout.y))) * u.deg
+    outcutout.decext = (cutout.y + xoff) * u.deg
+    outcutout.velext = voff
+    outcutout.xstep = outpix
+    outcutout.ystep = outpix
+    outcutout.vstep = params.goaldv.value
+    outcutout.fstep = dfreq
+
+    return outcutout
+
+
 """ CUTOUT-SPECIFIC FUNCTIONS """
 
 
-def single_cutout(idx, galcat, comap, params):
+def aperture_nan_tables(comap, params):
+    """
+    count tables for the aperture nan checks, cached on the map object. for an aperture
+    with its lowest-index corner at (f, y, x), total[f, y, x] is the number of masked voxels
+    in it and chanmax[f, y, x] is the largest number of masked spaxels in any one of its
+    channels. built with cumulative-sum box filters, so it's one pass over the map
+    """
+    shape = (params.freqwidth, params.ywidth, params.xwidth)
+    try:
+        if comap.apnantables[0] == shape:
+            return comap.apnantables[1:]
+    except AttributeError:
+        pass
+
+    fw, yw, xw = shape
+    nanmap = np.isnan(comap.map).astype(np.int32)
+
+    # 2D box sums in each channel
+    csum = np.zeros((nanmap.shape[0], nanmap.shape[1] + 1, nanmap.shape[2] + 1), dtype=np.int32)
+    csum[:, 1:, 1:] = nanmap.cumsum(axis=1).cumsum(axis=2)
+    chancount = csum[:, yw:, xw:] - csum[:, :-yw, xw:] - csum[:, yw:, :-xw] + csum[:, :-yw, :-xw]
+
+    # then over the aperture channels
+    fsum = np.zeros((chancount.shape[0] + 1,) + chancount.shape[1:], dtype=np.int32)
+    fsum[1:] = chancount.cumsum(axis=0)
+    total = fsum[fw:] - fsum[:-fw]
+    chanmax = np.lib.stride_tricks.sliding_window_view(chancount, fw, axis=0).max(axis=-1)
+
+    comap.apnantables = (shape, total, chanmax)
+    return total, chanmax
+
+
+def aperture_nan_checks(comap, params, fidx, yidx, xidx):
+    """
+    the separate aperture nan tests for apertures starting at the passed indices: returns
+    (inmap, totalpass, chanpass) -- whether the aperture is inside the map, has no more
+    than half its voxels masked in total, and no more than half the spaxels in any single
+    channel. works on single indices or arrays of them
+    """
+    total, chanmax = aperture_nan_tables(comap, params)
+    fidx, yidx, xidx = np.asarray(fidx), np.asarray(yidx), np.asarray(xidx)
+
+    inmap = ((fidx >= 0) & (yidx >= 0) & (xidx >= 0) & (fidx < total.shape[0])
+             & (yidx < total.shape[1]) & (xidx < total.shape[2]))
+    fidx, yidx, xidx = np.where(inmap, fidx, 0), np.where(inmap, yidx, 0), np.where(inmap, xidx, 0)
+
+    totalpass = total[fidx, yidx, xidx] <= (params.freqwidth * params.xwidth ** 2) / 2
+    chanpass = chanmax[fidx, yidx, xidx] <= params.xwidth ** 2 / 2
+
+    return inmap, totalpass, chanpass
+
+
+def aperture_nan_pass(comap, params, fidx, yidx, xidx):
+    """
+    the aperture nan rules (no more than half the aperture voxels masked in total, and no
+    more than half the spaxels in any single channel) for apertures starting at the
+    passed indices. works on single indices or arrays of them (any apertures off the edge
+    of the map fail)
+    """
+    inmap, totalpass, chanpass = aperture_nan_checks(comap, params, fidx, yidx, xidx)
+    return inmap & totalpass & chanpass
+
+
+def _last_below(axis, vals):
+    """ index of the last element of axis that is smaller than each of vals (-1 if none) """
+    if np.all(np.diff(axis) > 0):
+        return np.searchsorted(axis, vals, side='left') - 1
+    below = axis[None, :] < np.asarray(vals)[:, None]
+    return np.where(np.any(below, axis=1), len(axis) - 1 - np.argmax(below[:, ::-1], axis=1), -1)
+
+
+def cutout_prefilter(galcat, comap, params, profile=null_profile, voxels=False):
+    """
+    run the cheap single_cutout rejection tests (falling in the field, center voxel not
+    masked, aperture not off the edge of the map, aperture nan fractions) for every
+    catalogue object at once, without extracting anything. returns a boolean array of
+    objects that are worth passing to single_cutout (which will still re-check them)
+    only works for maps with 1D coordinate axes -- cosmogrid maps get everything passed
+    if profile is a stack_profile, the first test each rejected object failed is counted
+    with voxels, also returns the (freq, y, x) index arrays of the voxel each object falls
+    in and of the lowest-index corner of its aperture (None for cosmogrid maps)
+    """
+    if len(comap.ra.shape) == 2:
+        if voxels:
+            return np.ones(galcat.nobj, dtype=bool), None, None
+        return np.ones(galcat.nobj, dtype=bool)
+
+    nuobs = params.centfreq / (1 + galcat.z)
+    x, y = galcat.ra(), galcat.dec()
+
+    # find gal in each axis, test to make sure it falls into field
+    inband = (nuobs >= np.min(comap.freq)) & (nuobs <= np.max(comap.freq + comap.fstep))
+    onmap = (x >= np.min(comap.ra)) & (x <= np.max(comap.ra + comap.xstep))
+    onmap &= (y >= np.min(comap.dec)) & (y <= np.max(comap.dec + comap.ystep))
+
+    idxs, lowidxs = [], []
+    for axis, step, vals, width in [(comap.freq, comap.fstep, nuobs, params.freqwidth),
+                                    (comap.dec, comap.ystep, y, params.ywidth),
+                                    (comap.ra, comap.xstep, x, params.xwidth)]:
+        idx = _last_below(axis, vals)
+        if axis is comap.freq:
+            inband &= idx >= 0
+        else:
+            onmap &= idx >= 0
+        idx = np.clip(idx, 0, len(axis) - 1)
+        # which side of the voxel the object falls on (matters for even aperture widths)
+        lowside = np.abs(vals - axis[idx]) < step / 2
+        if width % 2 == 0:
+            lowidx = np.where(lowside, idx - width // 2, idx - width // 2 + 1)
+        else:
+            lowidx = idx - width // 2
+        idxs.append(idx)
+        lowidxs.append(lowidx)
+
+    # if the center voxel of the cutout is a nan, axe it
+    centre = ~np.isnan(comap.map[tuple(idxs)])
+
+    # make sure it's not going off the center of the map
+    freqlen, xylen = len(comap.freq), len(comap.x)
+    inside = (lowidxs[0] >= 0) & (lowidxs[1] >= 0) & (lowidxs[2] >= 0)
+    inside &= ((lowidxs[0] + params.freqwidth <= freqlen) & (lowidxs[1] + params.ywidth <= xylen)
+               & (lowidxs[2] + params.xwidth <= xylen))
+
+    inmap, totalpass, chanpass = aperture_nan_checks(comap, params, *lowidxs)
+    inside &= inmap
+
+    keep = inband & onmap & centre & inside & totalpass & chanpass
+
+    # tally up the reason each rejected object was thrown out (the first test it failed)
+    if profile:
+        failed = ~keep
+        for reason, passed in [('outofband', inband), ('offmap', onmap), ('nancentre', centre),
+                               ('offmap', inside), ('aperturenan', totalpass), ('channelnan', chanpass)]:
+            profile.reject(reason, np.count_nonzero(failed & ~passed))
+            failed &= passed
+
+    if voxels:
+        return keep, tuple(idxs), tuple(lowidxs)
+    return keep
+
+
+def map_aperture_vid(comap, params, method='weightmean', nancut=True):
+    """
+    aperture intensity distribution over a whole map (in map units), for noise
+    characterisation. every aperture position in the map is included (they overlap);
+    with nancut only the apertures that pass the same nan rules as stack cutouts are kept.
+    returns flattened arrays of aperture values and rmss
+    """
+    vals, dvals = aperture_box_values(comap.map, comap.rms, params.freqwidth, params.ywidth,
+                                      params.xwidth, method=method)
+
+    good = np.isfinite(vals) & np.isfinite(dvals)
+    if nancut:
+        good &= aperture_nan_pass(comap, params, *np.indices(vals.shape))
+
+    return vals[good], dvals[good]
+
+
+def single_cutout(idx, galcat, comap, params, profile=null_profile):
     """ can i make this prettier """
+    tick = profile.tick()
     # find gal in each axis, test to make sure it falls into field
     ## freq
     zval = galcat.z[idx]
     nuobs = params.centfreq / (1 + zval)
     if nuobs < np.min(comap.freq) or nuobs > np.max(comap.freq + comap.fstep):
+        profile.reject('outofband')
         return None
     freqidx = np.max(np.where(comap.freq < nuobs))
     if np.abs(nuobs - comap.freq[freqidx]) < comap.fstep / 2:
@@ -1231,6 +1864,7 @@ def single_cutout(idx, galcat, comap, params):
 
         x = galcat.coords[idx].ra.deg
         if x < np.min(comap.ra) or x > np.max(comap.ra) + np.max(comap.xstep):
+            profile.reject('offmap')
             return None
         xidx = np.max(np.where(comap.ra[freqidx] < x))
         if np.abs(x - comap.ra[freqidx, xidx]) < comap.xstep[freqidx] / 2:
@@ -1241,6 +1875,7 @@ def single_cutout(idx, galcat, comap, params):
 
         y = galcat.coords[idx].dec.deg
         if y < np.min(comap.dec) or y > np.max(comap.dec) + np.max(comap.ystep):
+            profile.reject('offmap')
             return None
         yidx = np.max(np.where(comap.dec[freqidx] < y))
         if np.abs(y - comap.dec[freqidx, yidx]) < comap.ystep[freqidx] / 2:
@@ -1253,6 +1888,7 @@ def single_cutout(idx, galcat, comap, params):
 
         x = galcat.coords[idx].ra.deg
         if x < np.min(comap.ra) or x > np.max(comap.ra + comap.xstep):
+            profile.reject('offmap')
             return None
         xidx = np.max(np.where(comap.ra < x))
         if np.abs(x - comap.ra[xidx]) < comap.xstep / 2:
@@ -1263,6 +1899,7 @@ def single_cutout(idx, galcat, comap, params):
 
         y = galcat.coords[idx].dec.deg
         if y < np.min(comap.dec) or y > np.max(comap.dec + comap.ystep):
+            profile.reject('offmap')
             return None
         yidx = np.max(np.where(comap.dec < y))
         if np.abs(y - comap.dec[yidx]) < comap.ystep / 2:
@@ -1272,6 +1909,7 @@ def single_cutout(idx, galcat, comap, params):
         ypixcent = (y - comap.decbe[yidx]) / comap.ystep
     # if the center voxel of the cutout is a nan, axe it
     if np.isnan(comap.map[freqidx, yidx, xidx]):
+        profile.reject('nancentre')
         return None
 
     # start setting up cutout object if it passes all these tests
@@ -1339,11 +1977,22 @@ def single_cutout(idx, galcat, comap, params):
 
     # more checks -- make sure it's not going off the center of the map
     if freqcutidx[0] < 0 or xcutidx[0] < 0 or ycutidx[0] < 0:
+        profile.reject('offmap')
         return None
     freqlen, xylen = len(comap.freq), len(comap.x)
     if freqcutidx[1] > freqlen or xcutidx[1] > xylen or ycutidx[1] > xylen:
+        profile.reject('offmap')
+        return None
+
+    # check how many aperture voxels are masked (in total and per channel) off the
+    # precomputed count tables, before anything gets copied out of the map
+    inmap, totalpass, chanpass = aperture_nan_checks(comap, params, freqcutidx[0], ycutidx[0], xcutidx[0])
+    if not (inmap and totalpass and chanpass):
+        profile.reject('offmap' if not inmap else ('aperturenan' if not totalpass else 'channelnan'))
         return None
 
+    tick = profile.lap('locate', tick)
+
     """bigger cutouts for plotting"""
     # same process as above, just wider
     df = params.freqstackwidth
@@ -1412,14 +2061,7 @@ def single_cutout(idx, galcat, comap, params):
             cutout.yidx[0]:cutout.yidx[1],
             cutout.xidx[0]:cutout.xidx[1]]
 
-    # check how many center aperture pixels are masked
-    if np.sum(np.isnan(pixval).flatten()) > (params.freqwidth * params.xwidth ** 2) / 2:
-        return None
-
-    # less than half of EACH SPECTRAL CHANNEL masked
-    for i in range(pixval.shape[0]):
-        if np.sum(np.isnan(pixval[i, :, :]).flatten()) > params.xwidth ** 2 / 2:
-            return None
+    tick = profile.lap('extract', tick)
 
     """ more advanced stacks """
     # subtract global spectral mean
@@ -1428,6 +2070,7 @@ def single_cutout(idx, galcat, comap, params):
 
     # check if the cutout failed the tests in these functions
     if not cutout:
+        profile.reject('filter')
         return None
 
     # subtract the per-channel means
@@ -1436,6 +2079,7 @@ def single_cutout(idx, galcat, comap, params):
 
     # check if the cutout failed the tests in these functions
     if not cutout:
+        profile.reject('filter')
         return None
 
     # subtract the low-order modes
@@ -1444,8 +2088,12 @@ def single_cutout(idx, galcat, comap, params):
 
     # check if the cutout failed the tests in these functions
     if not cutout:
+        profile.reject('filter')
         return None
 
+    if params.specmeanfilter or params.chanmeanfilter or params.lowmodefilter:
+        tick = profile.lap('filters', tick)
+
     # put the cutout into line luminosity units
     # if comap.unit != 'linelum':
     #     print('putting cutout into line lum')
@@ -1464,14 +2112,18 @@ def single_cutout(idx, galcat, comap, params):
         fmin, fmax = params.freqstackwidth - params.freqwidth // 2, params.freqstackwidth + params.freqwidth // 2 + 1
         aperture = cutout.cubestack[fmin:fmax, xmin:xmax, xmin:xmax]
         if np.isnan(aperture[params.freqwidth // 2, params.xwidth // 2, params.xwidth // 2]):
+            profile.reject('physicalspacing')
             return None
-        for i in range(aperture.shape[0]):
-            if np.sum(np.isnan(aperture[i, :, :]).flatten()) > params.xwidth ** 2 / 2:
-                return None
+        if np.any(np.count_nonzero(np.isnan(aperture), axis=(1, 2)) > params.xwidth ** 2 / 2):
+            profile.reject('physicalspacing')
+            return None
+
+        tick = profile.lap('physicalspacing', tick)
 
     # *** is this still doing anything?
     if params.obsunits:
         observer_units_weightedsum(pixval, rmsval, cutout, params)
+        profile.lap('units', tick)
 
     # try:
     #     if params.physicalspace:
@@ -1497,9 +2149,10 @@ def field_stack(comap, galcat, params, field=None, goalnobj=None, weights=None):
     if not params.optcut:
         params.optcut = 40
 
-    # set up for rotating each cutout randomly if that's set to happen
-    if params.rotate:
-        params.rng = np.random.default_rng(params.rotseed)
+    # set up for rotating each cutout randomly if that's set to happen. an rng the caller has
+    # set (e.g. a bootstrap realization's own stream) carries on where it is; otherwise each
+    # field starts again from rotseed
+    ownrng = params.rotate and not params.rng_set
 
     ti = 0
     # if we're keeping track of the number of cutouts
@@ -1512,8 +2165,32 @@ def field_stack(comap, galcat, params, field=None, goalnobj=None, weights=None):
     else:
         printi = 100
 
-    for i in range(galcat.nobj):
-        cutout = single_cutout(i, galcat, comap, params)
+    # timings and the cutout funnel for just this field (does nothing unless params.profile is set)
+    prof = new_profile(params)
+    prof.count('catalogue', galcat.nobj)
+
+    # throw out anything that obviously won't pass before extracting any cutouts
+    with prof.stage('locate'):
+        keep = cutout_prefilter(galcat, comap, params, profile=prof)
+        candidates = np.where(keep)[0]
+        # the objects an aperture sweep is measured on, and the parameters to cut them out
+        # with if they can't just be the stack's own cutouts (if that isn't all of them, or
+        # the cutouts are filtered)
+        sweepkeep = sweep_prefilter(galcat, comap, params, keep, profile=prof)
+        sweepparams = aperture_sweep_filter_params(params)
+        if sweepparams is None and np.array_equal(sweepkeep, keep):
+            sweepkeep = None
+    sweepinst = None
+
+    # what each object put into the stack, if that's being kept
+    contribrows = []
+
+    for (n, i) in enumerate(candidates):
+        insweep = sweepkeep is not None and sweepkeep[i]
+        # (the sweep's own cutout of this object has to be rotated the same way)
+        if insweep and sweepparams is not None and params.rotate:
+            sweepparams.rng = copy.deepcopy(params.rng)
+        cutout = single_cutout(i, galcat, comap, params, profile=prof)
 
         # if it passed all the tests, keep it
         if cutout:
@@ -1526,18 +2203,45 @@ def field_stack(comap, galcat, params, field=None, goalnobj=None, weights=None):
                 weight = None
 
             # stack as you go
+            tick = prof.tick()
             if ti == 0:
                 stackinst = cubelet(cutout, params)
+                tick = prof.lap('merge', tick)
                 if  stackinst.unit != 'linelum':
                     stackinst.to_linelum(params)
+                    tick = prof.lap('units', tick)
+                if params.contribstore:
+                    contribrows.append(cubelet_contribution(stackinst, cutout, field=field, weight=weight))
+                if insweep and sweepparams is None:
+                    sweepinst = sweep_stackin(sweepinst, stackinst, params, weight=weight)
                 if weight:
                     stackinst.weight_rms(weight)
                 ti = 1
             else:
                 stackinst_new = cubelet(cutout, params)
+                tick = prof.lap('merge', tick)
                 if stackinst_new.unit != 'linelum':
                     stackinst_new.to_linelum(params)
+                    tick = prof.lap('units', tick)
+                if params.contribstore:
+                    contribrows.append(cubelet_contribution(stackinst_new, cutout, field=field, weight=weight))
                 stackinst.stackin_cubelet(stackinst_new, params, weights=weight)
+                if insweep and sweepparams is None:
+                    sweepinst = sweep_stackin(sweepinst, stackinst_new, params, weight=weight)
+            tick = prof.lap('merge', tick)
+            prof.count('stacked')
+
+            # filtered cutouts for the sweep have their filters sized for its largest aperture
+            if insweep and sweepparams is not None:
+                sweepcutout = single_cutout(i, galcat, comap, sweepparams)
+                if sweepcutout:
+                    sweepnew = cubelet(sweepcutout, sweepparams)
+                    if sweepnew.unit != 'linelum':
+                        sweepnew.to_linelum(sweepparams)
+                    sweepinst = sweep_stackin(sweepinst, sweepnew, sweepparams, weight=weight)
+                else:
+                    prof.count('sweepdropped')
+                prof.lap('sweep', tick)
 
             if goalnobj:
                 field_nobj += 1     
@@ -1545,14 +2249,21 @@ def field_stack(comap, galcat, params, field=None, goalnobj=None, weights=None):
                 if field_nobj == goalnobj:
                     if params.verbose:
                         print("Hit goal number of {} cutouts".format(goalnobj))
-                        break
+                    prof.count('skipped', len(candidates) - n - 1)
+                    break
 
         if params.verbose:
             if i % printi == 0:
                 print('   done {} of {} cutouts in this field'.format(i, galcat.nobj))
 
+    if contribrows:
+        stackinst.contributions = contribution_store(contribrows)
+    if sweepkeep is not None and ti:
+        stackinst.sweepcube = sweepinst
+
     try:
-        stackinst.make_plots(comap, galcat, params, field=field)
+        with prof.stage('plot'):
+            stackinst.make_plots(comap, galcat, params, field=field)
     except UnboundLocalError:
         print('No values to stack in this field')
         # return None
@@ -1564,18 +2275,42 @@ def field_stack(comap, galcat, params, field=None, goalnobj=None, weights=None):
 
     try:
         if stackinst:
-            stackinst.save_cubelet(params, fieldstr)
+            stackinst.profile = prof.summary()
+            with prof.stage('save'):
+                stackinst.save_cubelet(params, fieldstr)
 
         return stackinst
     except UnboundLocalError:
         return None
+    finally:
+        # the run's profile adds up every field (the combined stack's summary comes from it)
+        get_profile(params).merge(prof)
+        if ownrng:
+            params.rng = None
     
 def field_stack_queued(comap, galcat, params, field, queue):
     if params.verbose:
         print('Starting a process with {} catalog objects'.format(galcat.nobj))
 
+    start = time.perf_counter()
     pcube = field_stack(comap, galcat, params, field=field)
-    queue.put(pcube)
+
+    # what this process did, for characterising the parallel stack
+    info = {'pid': os.getpid(), 'nobj': galcat.nobj, 'seconds': time.perf_counter() - start,
+            'peakmemory': peak_memory()}
+
+    # pickle the result here so the size of what goes back through the queue is known
+    queue.put(pickle.dumps((info, pcube), protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def unpack_queued(queued):
+    """
+    unpickle the (info, cube) sent back by field_stack_queued, adding the number of bytes
+    it took to the info dict
+    """
+    info, pcube = pickle.loads(queued)
+    info['transferbytes'] = len(queued)
+    return info, pcube
     
     
 def parallel_field_stack(comap, galcat, params, field=None, goalnobj=None, weights=None):
@@ -1588,6 +2323,7 @@ def parallel_field_stack(comap, galcat, params, field=None, goalnobj=None, weigh
     """
 
     # housekeeping
+    prof = new_profile(params)
     
     if params.prf_fitting:
         # handle stacklco lists here
@@ -1620,7 +2356,7 @@ def parallel_field_stack(comap, galcat, params, field=None, goalnobj=None, weigh
         for p in processes:
             p.start()   
 
-        cubelist = [qout.get() for p in processes]
+        workerinfo, cubelist = zip(*[unpack_queued(qout.get()) for p in processes])
 
         for p in processes:
             p.join()
@@ -1677,7 +2413,7 @@ def parallel_field_stack(comap, galcat, params, field=None, goalnobj=None, weigh
         for p in processes:
             p.start()   
 
-        cubelist = [qout.get() for p in processes]
+        workerinfo, cubelist = zip(*[unpack_queued(qout.get()) for p in processes])
 
         for p in processes:
             p.join()
@@ -1697,12 +2433,443 @@ def parallel_field_stack(comap, galcat, params, field=None, goalnobj=None, weigh
             finalcube = finalcubelist[0].copy()
             for cube in finalcubelist[1:]:
                 finalcube.stackin_cubelet(cube, params)
+
+    # keep track of what each process did
+    if finalcube:
+        finalcube.workerinfo = list(workerinfo)
+
+    # add the per-process timings and funnels into this field's, then into the run's
+    if prof:
+        for cube in finalcubelist:
+            prof.merge(getattr(cube, 'profile', None))
+        if finalcube:
+            finalcube.profile = prof.summary()
+        get_profile(params).merge(prof)
     
     # return finalcubelist
     return finalcube
 
 
 
+""" PER-OBJECT CONTRIBUTIONS """
+
+
+def cubelet_contribution(cube, cutout, field=None, weight=None):
+    """
+    one object's row of a contribution_store, from its single-cutout cubelet (already in
+    line luminosity units): the inverse-variance weighted values and the weights summed
+    over the spatial aperture in every channel, plus the object's own aperture values and
+    where it sat on the map (from the cutout the cubelet was made from)
+    """
+    spatial = (slice(None), slice(cube.apminpix[1], cube.apmaxpix[1]),
+               slice(cube.apminpix[2], cube.apmaxpix[2]))
+    weights = 1 / as_double(cube.cuberms[spatial])**2
+    specvalsum = np.nansum(as_double(cube.cube[spatial]) * weights, axis=(1, 2))
+    specweightsum = np.nansum(weights, axis=(1, 2))
+    apchans = slice(cube.apminpix[0], cube.apmaxpix[0])
+
+    return {'catidx': cube.catidx[0], 'field': field or 0, 'z': cube.z_mean[0],
+            'nuobs': cube.nuobs_mean[0], 'ra': cutout.x, 'dec': cutout.y,
+            'freqpixcent': cube.freqpixcent,
+            'ypixcent': cube.ypixcent, 'xpixcent': cube.xpixcent,
+            'weight': weight if weight else 1., 'linelum': cube.linelum,
+            'dlinelum': cube.dlinelum, 'rhoh2': cube.rhoh2, 'drhoh2': cube.drhoh2,
+            'apvalsum': specvalsum[apchans], 'apweightsum': specweightsum[apchans],
+            'specvalsum': specvalsum, 'specweightsum': specweightsum}
+
+
+def map_contribution_sums(valmap, weightmap, idxs, params, chunksize=2000):
+    """
+    the specvalsum/specweightsum columns of a contribution_store for objects centred on
+    voxels idxs, read straight off the line luminosity weight maps (linelum_weight_maps)
+    instead of from cutouts. channels past the edge of the map count as empty
+    """
+    nobj = len(idxs[0])
+    shape = valmap.shape
+    offsets = [np.arange(-params.freqstackwidth, params.freqstackwidth + 1),
+               np.arange(params.ywidth) - params.ywidth // 2,
+               np.arange(params.xwidth) - params.xwidth // 2]
+
+    specvalsum = np.zeros((nobj, len(offsets[0])))
+    specweightsum = np.zeros((nobj, len(offsets[0])))
+    for start in range(0, nobj, chunksize):
+        chunk = slice(start, start + chunksize)
+        fi = idxs[0][chunk][:, None, None, None] + offsets[0][None, :, None, None]
+        yi = idxs[1][chunk][:, None, None, None] + offsets[1][None, None, :, None]
+        xi = idxs[2][chunk][:, None, None, None] + offsets[2][None, None, None, :]
+        valid = (fi >= 0) & (fi < shape[0]) & (yi >= 0) & (yi < shape[1]) & (xi >= 0) & (xi < shape[2])
+        take = (np.clip(fi, 0, shape[0] - 1), np.clip(yi, 0, shape[1] - 1), np.clip(xi, 0, shape[2] - 1))
+        specvalsum[chunk] = np.sum(np.where(valid, valmap[take], 0.), axis=(2, 3))
+        specweightsum[chunk] = np.sum(np.where(valid, weightmap[take], 0.), axis=(2, 3))
+    return specvalsum, specweightsum
+
+
+class contribution_store():
+    """
+    columnar table of what each object put into a stack (one row per object, in the order
+    they were stacked). the stacked aperture value and spectrum of any subset of the rows,
+    re-weighted or cut down to a goal number of objects, are sums over its columns, so
+    they can be redone without going back to the map
+    """
+
+    def __init__(self, input=None, name='combined'):
+        """
+        can pass a list of rows (dicts from cubelet_contribution), a dict of columns, or
+        a path to load one from (a .npz file, or a results store with the name of the
+        stack it belongs to)
+        """
+        if isinstance(input, str):
+            if input.endswith('.npz'):
+                with np.load(input) as f:
+                    self.columns = {key: f[key] for key in f.files}
+            else:
+                self.columns = store_read_rows(input, 'contributions/' + name)
+        elif isinstance(input, dict):
+            self.columns = {key: np.asarray(val) for (key, val) in input.items()}
+        elif input:
+            self.columns = {key: np.array([row[key] for row in input]) for key in input[0].keys()}
+        else:
+            self.columns = {}
+
+    def __len__(self):
+        try:
+            return len(self.columns['catidx'])
+        except KeyError:
+            return 0
+
+    def __getitem__(self, key):
+        return self.columns[key]
+
+    def concatenate(self, other):
+        """ add the rows of another store onto the end of this one """
+        if len(other) == 0:
+            return
+        if len(self) == 0:
+            self.columns = {key: val.copy() for (key, val) in other.columns.items()}
+            return
+        self.columns = {key: np.concatenate((val, other.columns[key])) for (key, val) in self.columns.items()}
+
+    def select(self, idx=None, goalnobj=None):
+        """
+        the rows in idx (a boolean mask or index array, default all of them) that would be
+        stacked if each field stopped at goalnobj objects -- either one number for every
+        field or a list with one per field, by field number like stacker's goalnumcutouts
+        (field n stops at goalnobj[n-1]; objects with no field use goalnobj[0]) -- as an
+        index array
+        """
+        rows = np.arange(len(self))
+        if idx is not None:
+            rows = rows[idx]
+        if not goalnobj:
+            return rows
+
+        fields = self.columns['field'][rows]
+        keep = np.zeros(len(rows), dtype=bool)
+        for field in np.unique(fields):
+            if isinstance(goalnobj, (int, float)):
+                fieldgoal = int(goalnobj)
+            else:
+                fieldgoal = int(goalnobj[max(int(field), 1) - 1])
+            keep[np.where(fields == field)[0][:fieldgoal]] = True
+        return rows[keep]
+
+    def subset(self, idx=None, goalnobj=None):
+        """ a new store with just the rows select() picks out """
+        rows = self.select(idx=idx, goalnobj=goalnobj)
+        return contribution_store({key: val[rows] for (key, val) in self.columns.items()})
+
+    def stack(self, params, idx=None, weights=None, goalnobj=None):
+        """
+        the output values (as cubelet.get_output_dict gives them for a weightmean aperture,
+        plus the aperture spectrum) of stacking the rows select() picks out. weights, one
+        per row of the whole store, scale each object's inverse-variance weights the way
+        weightmean's weights do
+        """
+        rows = self.select(idx=idx, goalnobj=goalnobj)
+        if np.any(weights):
+            objweights = np.asarray(weights, dtype=float)[rows]
+        else:
+            objweights = np.ones(len(rows))
+
+        area = params.xwidth * params.ywidth
+        outdict = {}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for prefix in ['ap', 'spec']:
+                valsum = objweights @ self.columns[prefix + 'valsum'][rows]
+                weightsum = objweights @ self.columns[prefix + 'weightsum'][rows]
+                outdict[prefix] = (area * valsum / weightsum, area * np.sqrt(1 / weightsum))
+
+        spec, dspec = outdict['ap']
+        rhoh2, drhoh2 = weightmean(self.columns['rhoh2'][rows], self.columns['drhoh2'][rows],
+                                   weights=objweights)
+
+        return {'linelum': np.nansum(spec),
+                'dlinelum': np.sqrt(np.nansum(dspec ** 2)),
+                'rhoh2': rhoh2,
+                'drhoh2': drhoh2,
+                'nuobs_mean': np.mean(self.columns['nuobs'][rows]),
+                'z_mean': np.mean(self.columns['z'][rows]),
+                'nobj': len(rows),
+                'spectrum': outdict['spec'][0],
+                'dspectrum': outdict['spec'][1]}
+
+    def save(self, params, fieldstr=None):
+        """ save next to the stack's other outputs (or into the results store) """
+        if not fieldstr:
+            fieldstr = ''
+        if getattr(params, 'resultsformat', 'csv') == 'hdf5':
+            store_write_rows(params.resultsfile, 'contributions/' + (fieldstr.strip('/') or 'combined'),
+                             self.columns)
+            return
+        np.savez(params.datasavepath + fieldstr + '/per_object_contributions.npz', **self.columns)
+
+
+""" FFT STACKING """
+
+
+def fft_stack_incompatible(comap, params, goalnobj=None, weights=None):
+    """
+    the reasons (if any) a stack can't be done as one cross-correlation of the map with
+    the catalogue: every cutout has to be the same unrotated, unfiltered window on the
+    map around its object's voxel (PRF fitting only with the matched filter)
+    """
+    reasons = [name for name in ['rotate', 'specmeanfilter', 'chanmeanfilter', 'lowmodefilter',
+                                 'physicalspace', 'adaptivephotometry']
+               if getattr(params, name, False)]
+    if getattr(params, 'prf_fitting', False) and params.prf_fitmethod != 'matchedfilter':
+        reasons.append('prf_fitting')
+    if len(comap.ra.shape) == 2:
+        reasons.append('cosmogrid')
+    if params.freqwidth % 2 == 0 or params.xwidth % 2 == 0 or params.ywidth % 2 == 0:
+        reasons.append('even aperture widths')
+    if goalnobj:
+        reasons.append('goalnumcutouts')
+    if np.any(weights):
+        reasons.append('weights')
+    return reasons
+
+
+def map_linelum_factors(comap, params):
+    """
+    per-channel factors that take the map (and rms) from K to the line luminosity units
+    stacks are made in. this is the conversion cubelet.to_linelum does to a cutout centred
+    on a voxel, evaluated at the central frequency of each map channel
+    """
+    conv = cubelet.__new__(cubelet)
+    conv.unit = 'K'
+    conv.cube = np.ones((len(comap.freq), 1, 1))
+    conv.cuberms = np.ones((len(comap.freq), 1, 1))
+    conv.freqarr = comap.freq + comap.fstep / 2
+    conv.nuobs_mean = [0.]
+    conv.z_mean = [np.mean(freq_to_z(params.centfreq, conv.freqarr))]
+    conv.xarr = np.array([0., comap.xstep * 60])
+    conv.to_linelum(params)
+    return conv.cube[:, 0, 0].astype(np.float64)
+
+
+def linelum_weight_maps(comap, params):
+    """
+    the map in line luminosity units as (inverse-variance weighted values, weights), with
+    masked voxels set to zero so they drop out of sums the way nans do in weightmean
+    """
+    factors = map_linelum_factors(comap, params)[:, None, None]
+    weightmap = 1 / (as_double(comap.rms) * factors)**2
+    weightmap[~np.isfinite(weightmap)] = 0.
+    valmap = as_double(comap.map) * factors * weightmap
+    valmap[~np.isfinite(valmap)] = 0.
+    return valmap, weightmap
+
+
+def catalogue_voxel_counts(galcat, comap, params, profile=null_profile):
+    """
+    the catalogue as a histogram on the map's voxel grid, counting only the objects that
+    make it through cutout_prefilter. returns (counts, keep, idxs, lowidxs): keep is the
+    prefilter result and idxs/lowidxs are the voxel and aperture-corner indices of every
+    object
+    """
+    keep, idxs, lowidxs = cutout_prefilter(galcat, comap, params, profile=profile, voxels=True)
+    return voxel_counts(idxs, keep, comap.map.shape), keep, idxs, lowidxs
+
+
+def voxel_counts(idxs, keep, shape):
+    """ histogram of the objects in keep on a voxel grid of shape, from their voxel indices idxs """
+    counts, _ = np.histogramdd(np.transpose([idx[keep] for idx in idxs]), bins=shape,
+                               range=[(0, n) for n in shape])
+    return counts
+
+
+def fft_correlate(counts, fields, lagwidths):
+    """
+    cross-correlate counts with each of fields (arrays the same shape as counts):
+    out[d] = sum_p counts[p] * field[p + d] for lags d from -lagwidths to +lagwidths along
+    each axis, so each output has shape 2*lagwidths+1. uses zero-padded FFTs, so nothing
+    wraps around the map edges and the cost doesn't depend on how many objects there are
+    """
+    fftshape = [sfft.next_fast_len(int(n + w + 1), real=True) for (n, w) in zip(counts.shape, lagwidths)]
+    countsft = np.conj(sfft.rfftn(counts, fftshape))
+    lagidx = np.ix_(*[np.arange(-w, w + 1) % n for (w, n) in zip(lagwidths, fftshape)])
+
+    out = []
+    for field in fields:
+        corr = sfft.irfftn(countsft * sfft.rfftn(field, fftshape), fftshape)
+        out.append(corr[lagidx])
+    return out
+
+
+def fft_stack_cube(counts, valmap, weightmap, lagwidths):
+    """
+    the stacked (cube, cuberms) of the objects in counts, from the weighted map and weights
+    that linelum_weight_maps gives (nan/inf in voxels no object had data in)
+    """
+    valsum, weightsum, nsum = fft_correlate(counts, [valmap, weightmap, (weightmap > 0) * 1.], lagwidths)
+    empty = nsum < 0.5
+    cube = np.where(empty, np.nan, valsum / weightsum)
+    cuberms = np.where(empty, np.inf, np.sqrt(1 / weightsum))
+    return cube, cuberms
+
+
+def fft_field_stack(comap, galcat, params, field=None, goalnobj=None, weights=None):
+    """
+    same stack as field_stack, done all at once: the stacked cubelet is the cross-correlation
+    of the inverse-variance weighted map with the catalogue's voxel counts, normalised by
+    the correlation of the weights with the same counts. exact for unrotated stacks with
+    no cutout filters if every object sits at the centre of its channel (otherwise the line
+    luminosity conversion is taken at the channel centre). anything else falls back to
+    field_stack
+    """
+    reasons = fft_stack_incompatible(comap, params, goalnobj=goalnobj, weights=weights)
+    if reasons:
+        warnings.warn("Can't FFT stack with {}. stacking cutout by cutout instead".format(
+                      ', '.join(reasons)), RuntimeWarning)
+        return field_stack(comap, galcat, params, field=field, goalnobj=goalnobj, weights=weights)
+
+    prof = new_profile(params)
+    prof.count('catalogue', galcat.nobj)
+
+    with prof.stage('locate'):
+        counts, keep, idxs, lowidxs = catalogue_voxel_counts(galcat, comap, params, profile=prof)
+        # the objects an aperture sweep is measured on, if that isn't all of them
+        sweepkeep = sweep_prefilter(galcat, comap, params, keep, profile=prof)
+        if np.array_equal(sweepkeep, keep):
+            sweepkeep = None
+    stackidx = np.where(keep)[0]
+    prof.count('stacked', len(stackidx))
+
+    if len(stackidx) == 0:
+        print('No values to stack in this field')
+        get_profile(params).merge(prof)
+        return None
+
+    with prof.stage('correlate'):
+        valmap, weightmap = linelum_weight_maps(comap, params)
+        lags = (params.freqstackwidth, params.spacestackwidth, params.spacestackwidth)
+        cube, cuberms = fft_stack_cube(counts, valmap, weightmap, lags)
+        if sweepkeep is not None:
+            sweepcube, sweeprms = fft_stack_cube(voxel_counts(idxs, sweepkeep, comap.map.shape),
+                                                 valmap, weightmap, lags)
+        if params.contribstore:
+            specvalsum, specweightsum = map_contribution_sums(valmap, weightmap,
+                                                              [idx[stackidx] for idx in idxs], params)
+        del valmap, weightmap
+
+    with prof.stage('units'):
+        # per-object aperture line luminosities, the way single_cutout does them
+        offsets = np.indices((params.freqwidth, params.ywidth, params.xwidth)).reshape(3, -1)
+        apidx = tuple(low[stackidx][:, None] + off[None, :] for (low, off) in zip(lowidxs, offsets))
+        apshape = (len(stackidx), params.freqwidth, params.ywidth, params.xwidth)
+        pcllum, dpcllum = weightmean(comap.map[apidx].reshape(apshape),
+                                     comap.rms[apidx].reshape(apshape), axis=(2, 3))
+        linelums = np.nansum(pcllum, axis=1)
+        dlinelums = np.sqrt(np.nansum(dpcllum ** 2, axis=1))
+
+        nuobs = params.centfreq / (1 + galcat.z[stackidx])
+        llumunit = u.K * u.km / u.s * u.pc ** 2
+        rhoh2s = rho_h2(linelums * llumunit, nuobs, params).value
+        drhoh2s = rho_h2(dlinelums * llumunit, nuobs, params).value
+
+    # package it up as a stacked cubelet (position info is the first object's, as in field_stack)
+    first = stackidx[0]
+    fidx, yidx, xidx = (idx[first] for idx in idxs)
+    stack = empty_table()
+    stack.catidx = galcat.catfileidx[first]
+    stack.freq = nuobs[0]
+    stack.z = galcat.z[first]
+    stack.fstep = comap.fstep
+    stack.xstep = comap.xstep * 60
+    stack.freqpixcent = (nuobs[0] - comap.freqbe[fidx]) / comap.fstep
+    stack.ypixcent = (galcat.dec()[first] - comap.decbe[yidx]) / comap.ystep
+    stack.xpixcent = (galcat.ra()[first] - comap.rabe[xidx]) / comap.xstep
+    stack.cubestack, stack.cubestackrms = cube, cuberms
+    stack.linelum, stack.dlinelum = weightmean(linelums, dlinelums)
+    stack.rhoh2, stack.drhoh2 = weightmean(rhoh2s, drhoh2s)
+
+    stackinst = cubelet(stack, params)
+    stackinst.unit = 'linelum'
+    stackinst.ncutouts = len(stackidx)
+    stackinst.catidx = galcat.catfileidx[stackidx]
+    stackinst.nuobs_mean = np.array([np.mean(nuobs)])
+    stackinst.z_mean = np.array([np.mean(galcat.z[stackidx])])
+
+    # the aperture sweep's stack, from just its own objects
+    if sweepkeep is not None:
+        sub = np.where(sweepkeep[stackidx])[0]
+        if len(sub) == 0:
+            stackinst.sweepcube = None
+        else:
+            sweepinst = stackinst.copy()
+            sweepinst.cube, sweepinst.cuberms = sweepcube, sweeprms
+            sweepinst.linelum, sweepinst.dlinelum = weightmean(linelums[sub], dlinelums[sub])
+            sweepinst.rhoh2, sweepinst.drhoh2 = weightmean(rhoh2s[sub], drhoh2s[sub])
+            sweepinst.ncutouts = len(sub)
+            sweepinst.catidx = galcat.catfileidx[stackidx[sub]]
+            sweepinst.nuobs_mean = np.array([np.mean(nuobs[sub])])
+            sweepinst.z_mean = np.array([np.mean(galcat.z[stackidx[sub]])])
+            stackinst.sweepcube = sweepinst
+
+    if params.contribstore:
+        apchans = slice(params.freqstackwidth - params.freqwidth // 2,
+                        params.freqstackwidth + params.freqwidth // 2 + 1)
+        fidxs, yidxs, xidxs = (idx[stackidx] for idx in idxs)
+        stackinst.contributions = contribution_store({
+            'catidx': galcat.catfileidx[stackidx], 'field': np.full(len(stackidx), field or 0),
+            'z': galcat.z[stackidx], 'nuobs': nuobs,
+            'ra': galcat.ra()[stackidx], 'dec': galcat.dec()[stackidx],
+            'freqpixcent': (nuobs - comap.freqbe[fidxs]) / comap.fstep,
+            'ypixcent': (galcat.dec()[stackidx] - comap.decbe[yidxs]) / comap.ystep,
+            'xpixcent': (galcat.ra()[stackidx] - comap.rabe[xidxs]) / comap.xstep,
+            'weight': np.ones(len(stackidx)), 'linelum': linelums, 'dlinelum': dlinelums,
+            'rhoh2': rhoh2s, 'drhoh2': drhoh2s,
+            'apvalsum': specvalsum[:, apchans], 'apweightsum': specweightsum[:, apchans],
+            'specvalsum': specvalsum, 'specweightsum': specweightsum})
+
+    # per-object PRF amplitudes straight from the matched-filtered maps
+    if params.prf_fitting:
+        with prof.stage('prf'):
+            _, stackinst.prf_stacklco, stackinst.prf_stacklcorms = prf_matched_filter_amplitudes(
+                galcat, comap, params)
+
+    if params.verbose:
+        print('   stacked {} of {} objects in this field'.format(len(stackidx), galcat.nobj))
+
+    with prof.stage('plot'):
+        stackinst.make_plots(comap, galcat, params, field=field)
+
+    if field:
+        fieldstr = '/field' + str(field)
+    else:
+        fieldstr = ''
+
+    stackinst.profile = prof.summary()
+    with prof.stage('save'):
+        stackinst.save_cubelet(params, fieldstr)
+
+    # the run's profile adds up every field (the combined stack's summary comes from it)
+    get_profile(params).merge(prof)
+
+    return stackinst
+
+
+
 def stacker(maplist, catlist, params):
     """
     wrapper to perform a full stack on all available values in the catalogue.
@@ -1710,6 +2877,12 @@ def stacker(maplist, catlist, params):
 
     # set up: all the housekeeping stuff
     fields = [1, 2, 3]
+    # (the output directories don't exist until something is about to be saved in them)
+    try:
+        params.make_output_dirs()
+    except AttributeError:
+        pass
+    prof = get_profile(params)
 
     # for simulations -- if the stacker should stop after a certain number
     # of cutouts. set this up to be robust against per-field or total vals
@@ -1743,7 +2916,9 @@ def stacker(maplist, catlist, params):
 
         if params.verbose:
             print('Starting field {}'.format(i + 1))
-        if params.parallelize:
+        if params.fftstack:
+            cube = fft_field_stack(maplist[i], catlist[i], params, field=fields[i], goalnobj=numcutoutlist[i])
+        elif params.parallelize:
             cube = parallel_field_stack(maplist[i], catlist[i], params, field=fields[i])
         else:
             cube = field_stack(maplist[i], catlist[i], params, field=fields[i], goalnobj=numcutoutlist[i])
@@ -1758,16 +2933,22 @@ def stacker(maplist, catlist, params):
     # stops prf fitting from adding extra averages to the raw amplitude lco list
     params.add_to_lcolist = False
 
-    stackedcube = cubelist[0]
-    stackedcube.stackin_cubelet(cubelist[1], params)
-    stackedcube.stackin_cubelet(cubelist[2], params)
+    with prof.stage('merge'):
+        stackedcube = cubelist[0]
+        stackedcube.stackin_cubelet(cubelist[1], params)
+        stackedcube.stackin_cubelet(cubelist[2], params)
 
     llum, dllum = stackedcube.get_aperture()
 
     # make plots, save stuff
     if params.plotspace:
-        stackedcube.make_plots(maplist, catlist, params)
-    stackedcube.save_cubelet(params)
+        with prof.stage('plot'):
+            stackedcube.make_plots(maplist, catlist, params)
+    stackedcube.profile = prof.summary()
+    with prof.stage('save'):
+        stackedcube.save_cubelet(params)
+    if params.verbose:
+        prof.report()
 
     # rearrange the index list by field
     stackedcube.index_by_field(catlist)
@@ -1804,7 +2985,7 @@ def line_luminosity(flux, rms, nuobs, params, summed=True):
     zval = freq_to_z(params.centfreq * u.GHz, nuobs)
 
     # luminosity distance in Mpc
-    DLs = cosmo.luminosity_distance(zval)
+    DLs = get_cosmo(params).luminosity_distance(zval)
 
     # line luminosity
     linelum = const.c ** 2 / (2 * const.k_B) * flux * DLs ** 2 / (nuobs ** 2 * (1 + zval) ** 3)
@@ -1826,7 +3007,7 @@ def linelum_to_flux(linelum, meanz, params):
     nuobs = nuem_to_nuobs(params.centfreq, meanz) * u.GHz
 
     flux = linelum * u.K * u.km / u.s * u.pc ** 2 * 2 * const.k_B / const.c ** 2
-    flux = flux * nuobs ** 2 * (1 + meanz) ** 3 / cosmo.luminosity_distance(meanz) ** 2
+    flux = flux * nuobs ** 2 * (1 + meanz) ** 3 / get_cosmo(params).luminosity_distance(meanz) ** 2
 
     return (flux).to(u.Jy * u.km / u.s)
 
@@ -1859,12 +3040,15 @@ def rho_h2(linelum, nuobs, params):
 
     (z, z1, z2) = freq_to_z(params.centfreq, np.array([nuobs, nu1, nu2]))
 
-    distdiff = cosmo.luminosity_distance(z1) / (1 + z1) - cosmo.luminosity_distance(z2) / (1 + z2)
+    # one lookup for all three redshifts
+    pcosmo = get_cosmo(params)
+    (dl1, dl2) = pcosmo.luminosity_distance(np.array([z1, z2]))
+    distdiff = dl1 / (1 + z1) - dl2 / (1 + z2)
 
     # proper volume of the cube
     # volus = ((cosmo.kpc_proper_per_arcmin(z) * params.xwidth * 2*u.arcmin).to(u.Mpc))**2 * distdiff
     beamx = 4.5 * u.arcmin / (2 * np.sqrt(2 * np.log(2)))
-    volus = ((cosmo.kpc_comoving_per_arcmin(z) * params.xwidth * beamx).to(u.Mpc)) ** 2 * distdiff
+    volus = ((pcosmo.kpc_comoving_per_arcmin(z) * params.xwidth * beamx).to(u.Mpc)) ** 2 * distdiff
 
     rhoh2 = (mh2 / volus).to(u.Msun / u.Mpc ** 3)
 
@@ -1909,7 +3093,7 @@ def perchannel_flux_sum(tbvals, rmsvals, nuobs, params):
     # if physical spacing can't use the hardcoded value
     try:
         redshift = params.centfreq / nuobs - 1
-        res = (params.goalres / cosmo.kpc_proper_per_arcmin(redshift)).to(u.arcmin)
+        res = (params.goalres / get_cosmo(params).kpc_proper_per_arcmin(redshift)).to(u.arcmin)
         omega_B(res ** 2).to(u.sr)
     except AttributeError:
         omega_B = ((2 * u.arcmin) ** 2).to(u.sr)
@@ -2381,7 +3565,7 @@ def fit_amplitude(xcent=50, ycent=50, speccent=100, xstd=10, ystd=10, spatstd=No
 
         return popt, pcov
     
-    elif method =='curve_fit':
+    elif method == 'curve_fit' or method == 'matchedfilter':
         # The PRF function fit to the noisy data. 
         if sloren:
             spgamma = specstd*2.355/2
@@ -2414,8 +3598,121 @@ def fit_amplitude(xcent=50, ycent=50, speccent=100, xstd=10, ystd=10, spatstd=No
 
         #theoretically, cuts out nans from the coord array
 
+        if method == 'matchedfilter':
+            # the model is linear in amp, so the weighted least-squares fit has a closed form
+            # (the same answer curve_fit converges to)
+            prf = gauss3d_fitfunc(coorddata, 1.)
+            ivar = np.sum(prf ** 2 / rms_array.ravel() ** 2)
+            popt = np.array([np.sum(prf * cut_cutout_forfit.ravel() / rms_array.ravel() ** 2) / ivar])
+            return popt, np.array([[1 / ivar]])
+
         popt, pcov = curve_fit(gauss3d_fitfunc, coorddata, cut_cutout_forfit.ravel(), p0=3*10**8, maxfev=2000, sigma=rms_array.ravel(), absolute_sigma=True)
         return popt, pcov
     else:
         print('Not a valid amplitude fitting method :(')
 
+
+""" MATCHED-FILTER PRF AMPLITUDES """
+
+
+def prf_spectral_bins(params, nbins):
+    """
+    sub-channel offsets of the PRF centre (from the low edge of the object's channel, as
+    freqpixcent is measured) at the centres of nbins equal bins, and the 1D spectral PRF
+    over the window get_spectrum fits for each of them
+    """
+    sigma_spec = params.specwidth / (2 * np.sqrt(2 * np.log(2)))
+    specprf = Lorentz_1DPRF if params.sloren else Gaussian1DPRF
+
+    fhalf = min(params.optcut, params.freqstackwidth)
+    offs = (np.arange(nbins) + 0.5) / nbins
+    return offs, [specprf(np.arange(-fhalf, fhalf + 1), off, sigma_spec) for off in offs]
+
+
+def prf_matched_filter_maps(comap, params, nbins=4):
+    """
+    spectrally matched-filtered maps for PRF amplitudes: the weighted map (T/sigma^2)
+    correlated with the spectral PRF, and the weights (1/sigma^2) with its square, for a
+    PRF centred in each of nbins sub-channel offset bins. both in line luminosity units,
+    shape (nbins,) + map shape, zero-padded by spacestackwidth on the spatial axes so the
+    (exact) spatial part of the filter can be read out around any voxel. cached on the map
+    object -- this takes 2*nbins map-sized arrays of memory
+    """
+    key = (nbins, params.specwidth, params.sloren, params.optcut, params.freqstackwidth,
+           params.spacestackwidth)
+    try:
+        if comap.prfmaps[0] == key:
+            return comap.prfmaps[1:]
+    except AttributeError:
+        pass
+
+    offs, kernels = prf_spectral_bins(params, nbins)
+
+    valmap, weightmap = linelum_weight_maps(comap, params)
+    # voxels fit_amplitude would drop as nans don't count towards the weights either
+    weightmap[np.isnan(comap.map)] = 0.
+
+    pad = params.spacestackwidth
+    filtmaps = []
+    for (vals, power) in [(valmap, 1), (weightmap, 2)]:
+        filtmap = np.zeros((nbins, vals.shape[0], vals.shape[1] + 2 * pad, vals.shape[2] + 2 * pad),
+                           dtype=storage_dtype(params))
+        for (i, kernel) in enumerate(kernels):
+            filtmap[i, :, pad:-pad, pad:-pad] = ndimage.correlate1d(vals, kernel ** power, axis=0, mode='constant')
+        filtmaps.append(filtmap)
+
+    comap.prfmaps = (key, offs, filtmaps[0], filtmaps[1])
+    return comap.prfmaps[1:]
+
+
+def prf_matched_filter_amplitudes(galcat, comap, params, nbins=4, interpolate=True, chunksize=2000):
+    """
+    PRF amplitudes (and errors) for every catalogue object that passes cutout_prefilter:
+    the spectral part of the matched filter is looked up in prf_matched_filter_maps at each
+    object's voxel (interpolating linearly in the sub-channel offset, unless interpolate
+    is False) and the spatial part is done exactly, with the beam PRF at the object's
+    sub-pixel position over the cutout window. these are the amplitudes fit_amplitude gets
+    from each unrotated cutout (with the line luminosity conversion taken at channel
+    centres). objects are done chunksize at a time. returns (keep, amps, damps)
+    """
+    keep, idxs, _ = cutout_prefilter(galcat, comap, params, voxels=True)
+    binoffs, valfilt, weightfilt = prf_matched_filter_maps(comap, params, nbins=nbins)
+
+    fidx, yidx, xidx = [idx[keep] for idx in idxs]
+    nuobs = params.centfreq / (1 + galcat.z[keep])
+    foffs = (nuobs - comap.freqbe[fidx]) / comap.fstep
+    yoffs = (galcat.dec()[keep] - comap.decbe[yidx]) / comap.ystep - 0.5
+    xoffs = (galcat.ra()[keep] - comap.rabe[xidx]) / comap.xstep - 0.5
+
+    # the spectral offset bins each object sits between (or just the nearest one). the
+    # half-bins at either end of the channel are extrapolated from the two outer bins
+    pos = (foffs - binoffs[0]) * nbins
+    if interpolate and nbins > 1:
+        lowbin = np.clip(np.floor(pos).astype(int), 0, nbins - 2)
+        highfrac = pos - lowbin
+    else:
+        lowbin = np.clip(np.round(pos), 0, nbins - 1).astype(int)
+        highfrac = np.zeros(len(pos))
+
+    beamsigmapix = params.beamwidth / (2 * np.sqrt(2 * np.log(2))) / (comap.xstep * 60)
+    window = np.arange(-params.spacestackwidth, params.spacestackwidth + 1)
+
+    valsum, weightsum = np.zeros(len(fidx)), np.zeros(len(fidx))
+    for start in range(0, len(fidx), chunksize):
+        chunk = slice(start, start + chunksize)
+        yprf = Gaussian1DPRF(window[None, :], yoffs[chunk, None], beamsigmapix)
+        xprf = Gaussian1DPRF(window[None, :], xoffs[chunk, None], beamsigmapix)
+        # spatial windows around each object in the (padded) filtered maps
+        ywin = (yidx[chunk, None] + params.spacestackwidth + window)[:, :, None]
+        xwin = (xidx[chunk, None] + params.spacestackwidth + window)[:, None, :]
+
+        for (binidx, frac) in [(lowbin[chunk], 1 - highfrac[chunk]), (lowbin[chunk] + 1, highfrac[chunk])]:
+            if not np.any(frac):
+                continue
+            binidx = np.minimum(binidx, nbins - 1)
+            vals = valfilt[binidx[:, None, None], fidx[chunk, None, None], ywin, xwin]
+            weights = weightfilt[binidx[:, None, None], fidx[chunk, None, None], ywin, xwin]
+            valsum[chunk] += frac * np.einsum('nij,ni,nj->n', vals, yprf, xprf)
+            weightsum[chunk] += frac * np.einsum('nij,ni,nj->n', weights, yprf ** 2, xprf ** 2)
+
+    return keep, valsum / weightsum, 1 / np.sqrt(weightsum)
@@ -8,20 +8,132 @@ from astropy.coordinates import SkyCoord
 from astropy.convolution import Gaussian2DKernel, Box2DKernel, convolve
 from astropy import wcs
 from astropy.cosmology import FlatLambdaCDM
-from pixell import utils
-from reproject import reproject_adaptive
+from scipy import sparse
+from scipy.special import ndtr
 import os
 import sys
 import h5py
 import csv
 import warnings
 import copy
+import time
+import multiprocessing
+import importlib
 from tqdm import tqdm
 warnings.filterwarnings("ignore", message="invalid value encountered in true_divide")
 warnings.filterwarnings("ignore", message="invalid value encountered in power")
 warnings.filterwarnings("ignore", message="divide by zero encountered in true_divide")
 
 
+""" LAZY IMPORTS """
+class lazy_import():
+    """
+    stand-in for a module (or for one object in a module) that only actually gets imported
+    the first time it's used, so the heavy optional dependencies (spectral_cube, reproject,
+    photutils, matplotlib, etc) aren't loaded by stacks that never touch them
+    lazy_import('pandas') acts like the pandas module, and
+    lazy_import('reproject', 'reproject_adaptive') like the reproject_adaptive function
+    """
+    def __init__(self, module, name=None):
+        self._lazymodule = module
+        self._lazyname = name
+        self._lazyobj = None
+
+    def _lazyload(self):
+        if self._lazyobj is None:
+            obj = importlib.import_module(self._lazymodule)
+            if self._lazyname:
+                obj = getattr(obj, self._lazyname)
+            self._lazyobj = obj
+        return self._lazyobj
+
+    def __getattr__(self, attr):
+        if attr.startswith('_lazy') or attr.startswith('__'):
+            raise AttributeError(attr)
+        return getattr(self._lazyload(), attr)
+
+    def __call__(self, *args, **kwargs):
+        return self._lazyload()(*args, **kwargs)
+
+    def __repr__(self):
+        return "<lazy import of '{}'>".format(self._lazymodule + ('.' + self._lazyname if self._lazyname else ''))
+
+utils = lazy_import('pixell.utils')
+reproject_adaptive = lazy_import('reproject', 'reproject_adaptive')
+
+# everything the package only imports lazily. (scipy.optimize and astropy.modeling aren't
+# on the list: astropy.convolution pulls them in, and plain stacks need that for the beam
+# kernel and the isolated pixel mask)
+lazy_packages = ['spectral_cube', 'radio_beam', 'reproject', 'photutils', 'pixell', 'pandas',
+                 'matplotlib']
+
+def loaded_lazy_packages():
+    """ which of the lazily-imported packages have actually been imported so far """
+    return [pkg for pkg in lazy_packages if pkg in sys.modules]
+
+def _fresh_python(code):
+    """ run code in a new interpreter that can import this package; returns its stdout """
+    import subprocess
+    pkgparent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([pkgparent, os.environ.get('PYTHONPATH', '')]),
+               MPLBACKEND='Agg')
+    out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    return out.stdout
+
+def import_benchmark(nrep=5):
+    """
+    time importing the package in nrep fresh interpreters. returns the import times (s) and
+    the lazy packages that got loaded by the import alone (should be none)
+    """
+    code = ("import time, sys; t = time.perf_counter(); import {0}; t = time.perf_counter() - t; "
+            "print(t); print(','.join({0}.loaded_lazy_packages()))").format(__package__)
+    times = []
+    for i in range(nrep):
+        out = _fresh_python(code).splitlines()
+        times.append(float(out[0]))
+        loaded = [pkg for pkg in out[1].split(',') if pkg]
+
+    return np.array(times), loaded
+
+def plain_stack_import_check(stack=True, nobj=100, npix=60, nchan=64):
+    """
+    import the package in a fresh interpreter and make sure none of the lazy packages got
+    imported with it. if stack, that interpreter then runs a plain single-field stack (no
+    plots, physical spacing, photometry or fitting) on a small synthetic field made in a
+    temporary directory and checks again, so no data files are needed. returns a dict of
+    the lazy packages loaded after the import and after the stack (raises an
+    AssertionError if there are any)
+    """
+    code = [
+        "import sys",
+        "import {0} as st".format(__package__),
+        "print(','.join(pkg for pkg in st.lazy_packages if pkg in sys.modules))"]
+    if stack:
+        code += [
+            "import os, shutil, tempfile, warnings",
+            "from {0}.benchmark import synthetic_fields, benchmark_params".format(__package__),
+            "workdir = tempfile.mkdtemp()",
+            "mapfiles, catfile = synthetic_fields(os.path.join(workdir, 'data'), nobj={}, nfields=1, "
+            "npix={}, nchan={})".format(nobj, npix, nchan),
+            "params = benchmark_params(os.path.join(workdir, 'output'))",
+            "params.plotspace = params.plotfreq = False",
+            "warnings.simplefilter('ignore')",
+            "maplist, catlist = st.setup(mapfiles, catfile, params)",
+            "cube = st.field_stack(maplist[0], catlist[0], params, field=1)",
+            "shutil.rmtree(workdir, ignore_errors=True)",
+            "print(','.join(pkg for pkg in st.lazy_packages if pkg in sys.modules))"]
+
+    out = _fresh_python('\n'.join(code)).splitlines()
+    loaded = {'import': [pkg for pkg in out[0].split(',') if pkg]}
+    if stack:
+        loaded['stack'] = [pkg for pkg in out[-1].split(',') if pkg]
+
+    assert not loaded['import'], "importing {} loaded {}".format(__package__, loaded['import'])
+    assert not loaded.get('stack'), "a plain stack imported {}".format(loaded['stack'])
+
+    return loaded
+
+
 """ OBJECTS AND DICTS AND RELATED CONVENIENCE FUNCTIONS """
 class empty_table():
     """
@@ -43,180 +155,328 @@ class empty_table():
             else: attrlist.append(i)
         print(attrlist)
 
+""" PARAMETER SCHEMA """
+# every parameter read from param_defaults.py / a paramfile: name -> (type, fallback).
+# a fallback of None means a missing or unparseable value just gets a warning
+param_schema = {
+    # integer-valued
+    'xwidth': ('int', None), 'ywidth': ('int', None), 'freqwidth': ('int', None),
+    'usefeed': ('int', None), 'voxelhitlimit': ('int', None), 'nthreads': ('int', None),
+    'rmsscale': ('int', None), 'isolatedpixkernel': ('int', None), 'specwidth': ('int', None),
+    'optcut': ('int', None),
+    'fitnbeams': ('int', 3), 'fitmasknbeams': ('int', 1),
+    'freqmaskwidth': ('int', 1), 'frequsewidth': ('int', 10),
+    'rotseed': ('int', 12345),
+    'spacestackwidth': ('int', None), 'freqstackwidth': ('int', None),
+    # float-valued
+    'centfreq': ('float', None), 'beamwidth': ('float', None), 'fitmeanlimit': ('float', None),
+    'voxelrmslimit': ('float', None), 'isolatedpixcutoff': ('float', None),
+    'prf_stacklco': ('float', None),
+    # boolean
+    'cubelet': ('bool', None), 'obsunits': ('bool', None), 'rotate': ('bool', None),
+    'lowmodefilter': ('bool', None), 'chanmeanfilter': ('bool', None),
+    'specmeanfilter': ('bool', None), 'verbose': ('bool', None), 'returncutlist': ('bool', None),
+    'savedata': ('bool', None), 'saveplots': ('bool', None), 'savefields': ('bool', None),
+    'plotspace': ('bool', None), 'plotfreq': ('bool', None), 'plotcubelet': ('bool', None),
+    'physicalspace': ('bool', None), 'parallelize': ('bool', None),
+    'adaptivephotometry': ('bool', None), 'cosmogrid': ('bool', None),
+    'scalermscuts': ('bool', None), 'maskisolatedpix': ('bool', None),
+    'prf_fitting': ('bool', None), 'cosmocache': ('bool', None), 'psfast': ('bool', None),
+    'deferplots': ('bool', None), 'sloren': ('bool', False), 'profile': ('bool', False),
+    'fftstack': ('bool', False),
+    'contribstore': ('bool', False),
+    # strings
+    'prf_fitmethod': ('str', 'curve_fit'), 'plotunits': ('str', 'linelum'),
+    'resultsformat': ('str', 'csv'), 'savepath': ('str', None), 'cosmo': ('str', 'comap'),
+    'precision': ('str', 'double'),
+    # an int or a list of ints (one per field)
+    'goalnumcutouts': ('intlist', None),
+    # an int or a list of ints (aperture widths to measure the stack in)
+    'sweepxwidths': ('intlist', False), 'sweepywidths': ('intlist', False),
+    'sweepfreqwidths': ('intlist', False),
+}
+
+# extra explanation for the warning when one of these falls back to its default
+param_fallback_messages = {
+    'prf_fitmethod': "Didn't pass method for PRF fitting, defaulting to 'curve_fit'.",
+    'rotseed': "Missing random seed for rotation. Using 12345 as default",
+    'fitnbeams': "Missing number of beams for cutout fitting. Using 3 as default",
+    'fitmasknbeams': "Missing number of beams for cutout fitting aperture mask. Using 1 as default",
+    'freqmaskwidth': "Missing number of apertures to mask for calculating spectral mean. Using 1 as default",
+    'frequsewidth': "Missing number of apertures for calculating spectral mean. Using 10 as default",
+    'plotunits': "Parameter 'plotunits' should be a string. defaulting to linelum units",
+    'resultsformat': "Parameter 'resultsformat' should be a string. defaulting to csv files",
+}
+
+# parameters that only matter (and so are only checked) when another one is switched on
+param_conditions = {'rotseed': 'rotate', 'spacestackwidth': 'plotspace',
+                    'freqstackwidth': 'plotfreq'}
+
+# attributes that aren't read from the parameter file but get set on params objects
+# along the way (everything a parameters object can hold has to be listed somewhere)
+param_extras = (
+    # filled in from the map being stacked on
+    'nchans', 'chanwidth', 'pixbeamwidth', 'xstep', 'beammodel',
+    # physical-spacing regridding targets
+    'goalres', 'goalxsize', 'goalfsize', 'goaldv', 'goalbeamscale', 'pspacefac',
+    # bootstrap / random-stack bookkeeping
+    'itersave', 'itersavestep', 'itersavefile', 'nitersavefile', 'nzbins',
+    'bootstrapseed', 'bootstraprng', 'bootverbose', 'fieldcents', 'tophat_kernel',
+    'field_1_sensmap', 'field_2_sensmap', 'field_3_sensmap', 'redshift_sensmap',
+    # stack outputs and plot bookkeeping
+    'add_to_lcolist', 'prf_stacklcorms', 'plotcomment', 'oldfreqwidth',
+    # caches
+    'pscache', 'cosmotable', 'stackprofile',
+)
+
+# parsed parameter files and compiled configs, keyed by file path(s) and modification time
+_param_file_cache = {}
+_param_config_cache = {}
+
+# named cosmologies (astropy cosmologies are immutable, so every params object can share one)
+_cosmologies = {}
+
+def read_param_file(paramfile):
+    """
+    read the 'name value' lines of a parameter file into a dict of strings. anything that
+    isn't exactly two words (comments, blank lines, section headers) is ignored. files are
+    only parsed again if they've been modified since the last read
+    """
+    key = (os.path.abspath(paramfile), os.path.getmtime(paramfile))
+    try:
+        return _param_file_cache[key]
+    except KeyError:
+        pass
+
+    rawdir = {}
+    with open(paramfile) as f:
+        for line in f:
+            words = line.split()
+            if len(words) == 2:
+                rawdir[words[0]] = words[1]
+
+    _param_file_cache[key] = rawdir
+    return rawdir
+
+def parse_param(val, ptype):
+    """
+    convert the string val from a parameter file into type ptype. raises ValueError if it
+    can't be done
+    """
+    if ptype == 'int':
+        return int(val)
+    elif ptype == 'float':
+        return float(val)
+    elif ptype == 'bool':
+        return val == 'True'
+    elif ptype == 'intlist':
+        if val[0] == '[':
+            return [int(v) for v in val[1:-1].split(',')]
+        return int(val)
+    return val
+
+def compile_params(paramfile=None):
+    """
+    merge param_defaults.py with paramfile (if passed) and convert everything in
+    param_schema to its type. returns (rawdir, values, messages): the merged strings, the
+    typed values, and the warnings to give for anything that fell back to a default.
+    the result is cached until either file changes
+    """
+    defaultfile = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'param_defaults.py')
+    key = (os.path.abspath(defaultfile), os.path.getmtime(defaultfile))
+    if paramfile:
+        key += (os.path.abspath(paramfile), os.path.getmtime(paramfile))
+    try:
+        return _param_config_cache[key]
+    except KeyError:
+        pass
+
+    rawdir = dict(read_param_file(defaultfile))
+    if paramfile:
+        rawdir.update(read_param_file(paramfile))
+
+    values = {}
+    messages = []
+    for (attr, (ptype, fallback)) in param_schema.items():
+        try:
+            values[attr] = parse_param(rawdir[attr], ptype)
+            continue
+        except (KeyError, ValueError, IndexError):
+            values[attr] = fallback
+
+        # only complain about a bad value if it would actually be used
+        condition = param_conditions.get(attr)
+        if condition and rawdir.get(condition) != 'True':
+            continue
+        # (these are just switched off by anything that isn't a number)
+        if ptype == 'intlist':
+            continue
+        if attr in param_fallback_messages:
+            messages.append(param_fallback_messages[attr])
+        elif ptype == 'str':
+            messages.append("Parameter '"+attr+"' should be a string")
+        else:
+            messages.append("Parameter '"+attr+"' should be "+
+                            {'int': 'an integer', 'float': 'a float', 'bool': 'boolean'}[ptype])
+
+    # unknown cosmologies fall back to the COMAP one
+    if values['cosmo'] not in ['comap']:
+        messages.append("Don't recognize parameter 'cosmo'. defaulting to COMAP values")
+        values['cosmo'] = 'comap'
+
+    _param_config_cache[key] = (rawdir, values, tuple(messages))
+    return _param_config_cache[key]
+
+def named_cosmology(name):
+    """ the (shared) astropy cosmology object for a cosmology name from the parameter file """
+    try:
+        return _cosmologies[name]
+    except KeyError:
+        pass
+    # only the COMAP one (from the ES papers) so far
+    _cosmologies[name] = FlatLambdaCDM(H0=70*u.km / (u.Mpc*u.s), Om0=0.286, Ob0=0.047)
+    return _cosmologies[name]
+
 class parameters():
     """
     class creating a custom object used to hold the various stacking parameters
-    will autofill defaults
+    will autofill defaults. everything in param_schema and param_extras has a fixed slot,
+    so setting anything else (e.g. a misspelled parameter) raises an AttributeError
     """
 
+    # (cosmo is a property, built from the name in dir)
+    __slots__ = tuple([attr for attr in param_schema if attr != 'cosmo']) + param_extras + (
+                 'dir', 'plotsavepath', 'datasavepath', 'cubesavepath', 'resultsfile',
+                 '_gauss_kernel', '_kernelbeam', '_cosmo', '_rng')
+
     def __init__(self, paramfile=None):
         """
         assign each of the parameters a default value
         if paramfile is passed, assign each of the parameters their value from paramfile
         paramfile can have as many or as few of the inputs as need be
+        this doesn't touch the disk beyond reading the parameter files: output directories
+        are only made by make_output_dirs (called by setup and stacker), and the beam
+        kernel, cosmology and random generator are only built when first used
         """
 
-        modpath = getattr(sys.modules['lim_stacker.tools'], '__file__')
-        abspath = modpath.split('tools.py')[0]
-
-        # load defaults in from the separate file that should be in the same directory
-        # save them in a directory to do stuff with
-        default_dir = {}
-        with open(abspath+'param_defaults.py') as f:
-            for line in f:
-                try:
-                    (attr, val) = line.split()
-                    default_dir[attr] = val
-                except:
-                    continue
-
-        # if any of the parameters are not default, replace them here
-        if paramfile:
-            with open(paramfile) as f:
-                for line in f:
-                    # if the line in the file contains an actual parameter
-                    try:
-                        (attr, val) = line.split()
-                        # replace the default parameter value with the new one
-                        default_dir[attr] = val
-                    except:
-                        continue
-
-        self.dir = default_dir
-
-        # integer-valued parameters
-        for attr in ['xwidth', 'ywidth', 'freqwidth', 'usefeed', 'voxelhitlimit', 'nthreads', 'rmsscale',
-                     'isolatedpixkernel', 'specwidth', 'optcut']:
-            try:
-                val = int(default_dir[attr])
-                setattr(self, attr, val)
-            except:
-                warnings.warn("Parameter '"+attr+"' should be an integer", RuntimeWarning)
-                setattr(self, attr, None)
-        # condition for pulling a specific feed
-        if self.usefeed > 20:
-            self.usefeed = False
+        rawdir, values, messages = compile_params(paramfile)
+        for msg in messages:
+            warnings.warn(msg, RuntimeWarning)
 
-        # float-valued parameters
-        for attr in ['centfreq', 'beamwidth', 'fitmeanlimit', 'voxelrmslimit', 'isolatedpixcutoff', 'prf_stacklco']:
-            try:
-                val = float(default_dir[attr])
-                setattr(self, attr, val)
-            except:
-                warnings.warn("Parameter '"+attr+"' should be a float", RuntimeWarning)
-                setattr(self, attr, None)
+        self.dir = dict(rawdir)
+        for (attr, val) in values.items():
+            # lists are the only mutable values -- don't share them between objects
+            if isinstance(val, list):
+                val = list(val)
+            setattr(self, attr, val)
 
-        # boolean parameters
-        for attr in ['cubelet', 'obsunits', 'rotate', 'lowmodefilter', 'chanmeanfilter',
-                    'specmeanfilter', 'verbose', 'returncutlist', 'savedata', 'saveplots',
-                    'savefields', 'plotspace', 'plotfreq', 'plotcubelet', 'physicalspace',
-                    'parallelize', 'adaptivephotometry', 'cosmogrid', 'scalermscuts',
-                    'maskisolatedpix', 'prf_fitting']:
-            try:
-                val = default_dir[attr] == 'True'
-                setattr(self, attr, val)
-            except:
-                warnings.warn("Parameter '"+attr+"' should be boolean", RuntimeWarning)
-                setattr(self, attr, None)
-
-        # prf fitting (string parameter)
-            try:
-                setattr(self, 'prf_fitmethod', default_dir['prf_fitmethod'])
-            except:
-                setattr(self, 'prf_fitmethod', 'curve_fit')
-                warnings.warn("Didn't pass method for PRF fitting, defaulting to 'curve_fit'.")
-
-        # make sure you're not trying to plot a cubelet if you're not actually making one
-        if not self.cubelet:
-            self.plotcubelet = False
-            warnings.warn("plotcubelet==True when cubelet==False -- set plotcubelet to False", RuntimeWarning)
-
-        # optional parameters
-        if self.rotate:
-            try:
-                setattr(self, 'rotseed', int(default_dir['rotseed']))
-            except:
-                self.rotseed = 12345
-                warnings.warn("Missing random seed for rotation. Using 12345 as default", RuntimeWarning)
-            self.rng = np.random.default_rng(self.rotseed)
-
-        try:
-            setattr(self, 'fitnbeams', int(default_dir['fitnbeams']))
-        except:
-            self.fitnbeams = 3
-            warnings.warn("Missing number of beams for cutout fitting. Using 3 as default", RuntimeWarning)
-
-        try:
-            setattr(self, 'fitmasknbeams', int(default_dir['fitmasknbeams']))
-        except:
-            self.fitmasknbeams = 1
-            warnings.warn("Missing number of beams for cutout fitting aperture mask. Using 1 as default", RuntimeWarning)
-        try:
-            setattr(self, 'freqmaskwidth', int(default_dir['freqmaskwidth']))
-        except:
-            self.freqmaskwidth = 1
-            warnings.warn("Missing number of apertures to mask for calculating spectral mean. Using 1 as default", RuntimeWarning)
-        try:
-            setattr(self, 'frequsewidth', int(default_dir['frequsewidth']))
-        except:
-            self.frequsewidth = 10
-            warnings.warn("Missing number of apertures for calculating spectral mean. Using 10 as default", RuntimeWarning)
+        self._gauss_kernel = None
+        self._kernelbeam = None
+        self._cosmo = None
+        self._rng = None
+        self.plotsavepath = None
+        self.datasavepath = None
+        self.cubesavepath = None
+        self.resultsfile = None
 
+        self.validate()
 
         if self.savedata:
-            setattr(self, 'savepath', default_dir['savepath'])
-            self.make_output_pathnames()
+            self.output_pathnames()
         else:
-            setattr(self, 'savepath', None)
+            self.savepath = None
 
-        if self.plotspace:
-            try:
-                setattr(self, 'spacestackwidth', int(default_dir['spacestackwidth']))
-            except:
-                warnings.warn("Parameter 'spacestackwidth' should be an integer", RuntimeWarning)
-        else:
-            setattr(self, 'savepath', None)
+        # plotspace/plotfreq off has always meant no saved output
+        if not self.plotspace or not self.plotfreq:
+            self.savepath = None
 
-        if self.plotfreq:
-            try:
-                setattr(self, 'freqstackwidth', int(default_dir['freqstackwidth']))
-            except:
-                warnings.warn("Parameter 'freqstackwidth' should be an integer", RuntimeWarning)
-        else:
-            setattr(self, 'savepath', None)
+    def validate(self):
+        """
+        check the parameter values against param_schema (and each other), warning about
+        and fixing up anything that doesn't make sense
+        """
+        for (attr, (ptype, fallback)) in param_schema.items():
+            if attr == 'cosmo':
+                continue
+            val = getattr(self, attr, None)
+            if val is None:
+                continue
+            if attr == 'usefeed' and isinstance(val, bool):
+                continue
+            pytype = {'int': (int, np.integer), 'float': (float, int, np.floating),
+                      'bool': (bool, np.bool_), 'str': (str,),
+                      'intlist': (int, list, tuple, np.ndarray)}[ptype]
+            if not isinstance(val, pytype):
+                warnings.warn("Parameter '"+attr+"' should be of type "+ptype, RuntimeWarning)
 
-        # units for plotting
-        try:
-            setattr(self, 'plotunits', default_dir['plotunits'])
-        except:
-            warnings.warn("Parameter 'plotunits' should be a string. defaulting to linelum units", RuntimeWarning)
-            setattr(self, 'plotunits', 'linelum')
+        # condition for pulling a specific feed
+        if self.usefeed is not None and not isinstance(self.usefeed, bool) and self.usefeed > 20:
+            self.usefeed = False
 
-        # cosmology to use
-        if default_dir['cosmo'] == 'comap':
-            setattr(self, 'cosmo', FlatLambdaCDM(H0=70*u.km / (u.Mpc*u.s), Om0=0.286, Ob0=0.047))
+        # make sure you're not trying to plot a cubelet if you're not actually making one
+        if not self.cubelet and self.plotcubelet:
+            self.plotcubelet = False
+            warnings.warn("plotcubelet==True when cubelet==False -- set plotcubelet to False", RuntimeWarning)
+
+        if self.resultsformat not in ['csv', 'hdf5']:
+            warnings.warn("Parameter 'resultsformat' should be 'csv' or 'hdf5'. defaulting to csv files", RuntimeWarning)
+            self.resultsformat = 'csv'
+
+        if self.precision not in ['double', 'single']:
+            warnings.warn("Parameter 'precision' should be 'double' or 'single'. defaulting to double", RuntimeWarning)
+            self.precision = 'double'
+
+    """ lazily-built members """
+    @property
+    def gauss_kernel(self):
+        """ kernel object for the beam (built from beamwidth the first time it's needed) """
+        if self._gauss_kernel is None or (self._kernelbeam is not None and self._kernelbeam != self.beamwidth):
+            self._gauss_kernel = Gaussian2DKernel(self.beamwidth / (2*np.sqrt(2*np.log(2))))
+            self._kernelbeam = self.beamwidth
+        return self._gauss_kernel
+
+    @gauss_kernel.setter
+    def gauss_kernel(self, kernel):
+        # explicitly-set kernels stay put even if beamwidth changes
+        self._gauss_kernel = kernel
+        self._kernelbeam = None
+
+    @property
+    def cosmo(self):
+        """ astropy cosmology object (shared between every params object using it) """
+        if self._cosmo is None:
+            self._cosmo = named_cosmology(self.dir.get('cosmo', 'comap'))
+        return self._cosmo
+
+    @cosmo.setter
+    def cosmo(self, cosmo):
+        if isinstance(cosmo, str):
+            self.dir['cosmo'] = cosmo
+            self._cosmo = None
         else:
-            warnings.warn("Don't recognize parameter 'cosmo'. defaulting to COMAP values")
-            setattr(self, 'cosmo', FlatLambdaCDM(H0=70*u.km / (u.Mpc*u.s), Om0=0.286, Ob0=0.047))
+            self._cosmo = cosmo
 
+    @property
+    def rng(self):
+        """ random generator for the cutout rotations, seeded with rotseed """
+        if self._rng is None:
+            self._rng = np.random.default_rng(self.rotseed)
+        return self._rng
 
-        # number of cutouts can be either a list or an int
-        if default_dir['goalnumcutouts'][0] == '[':
-            ncuts = default_dir['goalnumcutouts'][1:-1].split(',')
-            self.goalnumcutouts = [int(val) for val in ncuts]
-        else:
-            try:
-                setattr(self, 'goalnumcutouts', int(default_dir['goalnumcutouts']))
-            except:
-                self.goalnumcutouts = None
+    @rng.setter
+    def rng(self, rng):
+        self._rng = rng
 
-        # kernel object for the beam
-        self.gauss_kernel = Gaussian2DKernel(self.beamwidth / (2*np.sqrt(2*np.log(2))))
+    @property
+    def rng_set(self):
+        """ whether there's a rotation rng already (set by hand, or built from rotseed) """
+        return self._rng is not None
 
-    def make_output_pathnames(self, append=True):
+    def output_pathnames(self, append=True):
         """
-        Uses the input parameters to automatically make a directory to save data
-        with an informational name. If there's already a path name passed, uses that one
+        Uses the input parameters to work out an informational name for the directory to
+        save data in (without making anything). If there's already a path name passed,
+        uses that one
         """
 
         # add extra info to the filename because i will forget it
@@ -237,35 +497,11 @@ class parameters():
         else:
             outputdir = self.savepath
 
-        # if the default one was accidentally saved, get rid of it
-        if self.savepath != 'stack_output'+sinfo and os.path.exists('stack_output'+sinfo):
-            try:
-                os.rmdir('stack_output'+sinfo+'/data')
-                os.rmdir('stack_output'+sinfo+'/plots')
-                os.rmdir('stack_output'+sinfo)
-            except:
-                pass
-
-        elif self.savepath != 'stack_output' and os.path.exists('stack_output'):
-            try:
-                os.rmdir('stack_output/data')
-                os.rmdir('stack_output/plots')
-                os.rmdir('stack_output')
-            except:
-                pass
-
-        # make the new output directory
-        if not os.path.exists(outputdir):
-            os.makedirs(outputdir)
-
         self.savepath = outputdir
         self.plotsavepath = outputdir + '/plots'
         self.datasavepath = outputdir + '/data'
         self.cubesavepath = outputdir + '/plots/cubelet'
-
-        # if saving fields individually, set up for that
-        if self.savefields:
-            fields = ['/field1', '/field2', '/field3']
+        self.resultsfile = self.datasavepath + '/results.h5'
 
         # if bootstrapping, adjust those file names too ********
         try:
@@ -274,31 +510,106 @@ class parameters():
         except:
             pass
 
+    def make_output_dirs(self):
+        """
+        make the directories the output path names point to (if saving anything). safe to
+        call as many times as you like
+        """
+        if not self.savepath or not self.datasavepath:
+            return
+
+        # make the new output directory
+        os.makedirs(self.savepath, exist_ok=True)
+
+        # if saving fields individually, set up for that
+        if self.savefields:
+            fields = ['/field1', '/field2', '/field3']
+        else:
+            fields = ['']
+
         if self.saveplots:
             # make the directories to store the plots and data
-            if self.savefields:
-                # individual ones for each field if doing that
-                for field in fields:
-                    os.makedirs(self.plotsavepath+field, exist_ok=True)
-                    if self.plotcubelet:
-                        os.makedirs(self.cubesavepath+field, exist_ok=True)
-            else:
-                os.makedirs(self.plotsavepath, exist_ok=True)
+            # (individual ones for each field if doing that)
+            for field in fields:
+                os.makedirs(self.plotsavepath+field, exist_ok=True)
                 if self.plotcubelet:
-                    os.makedirs(self.cubesavepath, exist_ok=True)
+                    os.makedirs(self.cubesavepath+field, exist_ok=True)
         if self.savedata:
-            if self.savefields:
-                for field in fields:
-                    os.makedirs(self.datasavepath+field, exist_ok=True)
-            else:
-                os.makedirs(self.datasavepath, exist_ok=True)
-            
+            for field in fields:
+                os.makedirs(self.datasavepath+field, exist_ok=True)
+
+    def make_output_pathnames(self, append=True):
+        """
+        Uses the input parameters to automatically make a directory to save data
+        with an informational name. If there's already a path name passed, uses that one
+        """
+        self.output_pathnames(append=append)
+        self.make_output_dirs()
+
+    def as_dict(self):
+        """
+        dict of every parameter set on this object, with the lazily-built members under
+        their public names if they've been built
+        """
+        outdict = {}
+        for attr in parameters.__slots__:
+            if attr[0] == '_':
+                continue
+            try:
+                outdict[attr] = getattr(self, attr)
+            except AttributeError:
+                continue
+        for attr in ['gauss_kernel', 'cosmo', 'rng']:
+            if getattr(self, '_'+attr) is not None:
+                outdict[attr] = getattr(self, attr)
+        return outdict
+
+    def __getstate__(self):
+        # the state that goes to worker processes: no physical-spacing operator cache,
+        # and nothing that will just be rebuilt from the other parameters
+        state = {}
+        for attr in parameters.__slots__:
+            if attr == 'pscache':
+                continue
+            try:
+                state[attr] = object.__getattribute__(self, attr)
+            except AttributeError:
+                continue
+        if state.get('_kernelbeam') is not None:
+            state['_gauss_kernel'] = None
+        if state.get('_cosmo') is named_cosmology(self.dir.get('cosmo', 'comap')):
+            state['_cosmo'] = None
+        return state
+
+    def __setstate__(self, state):
+        for (attr, val) in state.items():
+            setattr(self, attr, val)
+        for attr in ['_gauss_kernel', '_kernelbeam', '_cosmo', '_rng']:
+            if attr not in state:
+                setattr(self, attr, None)
 
     def copy(self):
         """
-        returns a deep copy of the params object (ie won't link back to the original)
+        returns a copy of the params object that can be changed without affecting the
+        original. the read-only members (beam kernel, cosmology, distance table and
+        physical-spacing operators) are shared rather than copied
         """
-        return copy.deepcopy(self)
+        new = parameters.__new__(parameters)
+        for attr in parameters.__slots__:
+            try:
+                val = object.__getattribute__(self, attr)
+            except AttributeError:
+                continue
+            if attr in param_extras:
+                if attr not in ['pscache', 'cosmotable'] and isinstance(val, (list, dict, np.ndarray)):
+                    val = copy.deepcopy(val)
+            elif isinstance(val, (list, dict)):
+                val = copy.copy(val)
+            elif attr == '_rng' and val is not None:
+                val = copy.deepcopy(val)
+            setattr(new, attr, val)
+
+        return new
 
     def info(self):
         """
@@ -383,7 +694,114 @@ class parameters():
             zprobs = f['prob']
         self.redshift_sensmap = (zbins, zprobs)
 
+    def make_cosmo_cache(self, maplist, zpad=0.05):
+        """
+        build (or widen) the cosmology lookup table in self.cosmotable so it covers the
+        redshift range of every map in maplist (plus zpad on either side). won't do anything
+        if self.cosmocache is switched off
+        """
+        if not getattr(self, 'cosmocache', True):
+            return None
+
+        if not isinstance(maplist, (list, tuple)):
+            maplist = [maplist]
+
+        # redshift extent of all the maps together
+        zlims = []
+        for mapinst in maplist:
+            zlims.append(freq_to_z(self.centfreq, minmax(mapinst.freqbe)))
+        zmin, zmax = np.min(zlims) - zpad, np.max(zlims) + zpad
+
+        # don't rebuild it if the old table already covers everything
+        oldtable = getattr(self, 'cosmotable', None)
+        if oldtable is not None:
+            if oldtable.zmin <= zmin and oldtable.zmax >= zmax:
+                return oldtable
+            zmin, zmax = min(zmin, oldtable.zmin), max(zmax, oldtable.zmax)
+
+        self.cosmotable = cosmo_cache(self.cosmo, zmin, zmax)
+
+        return self.cosmotable
+
+
+class cosmo_cache():
+    """
+    class holding lookup tables of the astropy cosmology distances used while stacking
+    (luminosity distance and proper/comoving kpc per arcmin). these are tabulated once on a
+    fine, even redshift grid and then linearly interpolated, instead of running astropy's
+    numerical integration every time they're needed. methods mirror the astropy ones so
+    this can be dropped in anywhere params.cosmo is used, and redshifts that fall outside
+    the table are passed straight through to astropy
+    """
+
+    def __init__(self, cosmo, zmin, zmax, dz=1e-4):
+        self.cosmo = cosmo
+        self.zmin = zmin
+        self.zmax = zmax
+
+        # even redshift grid (always include both ends)
+        nz = int(np.ceil((zmax - zmin) / dz)) + 1
+        self.zgrid = np.linspace(zmin, zmax, nz)
+        self.dz = self.zgrid[1] - self.zgrid[0]
+
+        # tabulated values, stored unitless in the units below
+        self.dl = cosmo.luminosity_distance(self.zgrid).to(u.Mpc).value
+        self.proper = cosmo.kpc_proper_per_arcmin(self.zgrid).to(u.kpc/u.arcmin).value
+        self.comoving = cosmo.kpc_comoving_per_arcmin(self.zgrid).to(u.kpc/u.arcmin).value
+
+    def _lookup(self, z, table, func, unit):
+        """
+        interpolate table at redshift(s) z, using func (the astropy method) for anything
+        outside the tabulated range. returns a quantity with units of unit
+        """
+        if isinstance(z, u.Quantity):
+            z = z.to(u.dimensionless_unscaled).value
+        z = np.asarray(z, dtype='float64')
+
+        vals = np.interp(z, self.zgrid, table)
+
+        # anything off the end of the table has to be done properly
+        outidx = np.logical_or(z < self.zmin, z > self.zmax)
+        if np.any(outidx):
+            if vals.ndim == 0:
+                vals = func(z).to(unit).value
+            else:
+                vals[outidx] = func(z[outidx]).to(unit).value
+
+        return vals * unit
+
+    def luminosity_distance(self, z):
+        """ luminosity distance (Mpc) at redshift z """
+        return self._lookup(z, self.dl, self.cosmo.luminosity_distance, u.Mpc)
+
+    def kpc_proper_per_arcmin(self, z):
+        """ proper kpc per arcmin at redshift z """
+        return self._lookup(z, self.proper, self.cosmo.kpc_proper_per_arcmin, u.kpc/u.arcmin)
+
+    def kpc_comoving_per_arcmin(self, z):
+        """ comoving kpc per arcmin at redshift z """
+        return self._lookup(z, self.comoving, self.cosmo.kpc_comoving_per_arcmin, u.kpc/u.arcmin)
+
+    def max_relative_error(self, nsamp=None):
+        """
+        check the lookup tables against astropy. evaluates at the midpoints between grid
+        nodes (where linear interpolation is worst) and returns a dict with the maximum
+        fractional error for each of the tabulated quantities
+        """
+        zmid = edgetocent(self.zgrid)
+        if nsamp and nsamp < len(zmid):
+            zmid = zmid[np.linspace(0, len(zmid) - 1, nsamp).astype(int)]
+
+        errdict = {}
+        for name in ['luminosity_distance', 'kpc_proper_per_arcmin', 'kpc_comoving_per_arcmin']:
+            exact = getattr(self.cosmo, name)(zmid)
+            approx = getattr(self, name)(zmid).to(exact.unit)
+            errdict[name] = np.max(np.abs((approx - exact) / exact).value)
+
+        return errdict
 
+    def copy(self):
+        return copy.deepcopy(self)
 
 
 class catalogue():
@@ -888,12 +1306,41 @@ class maps():
                 self.load_sim(inputfile, params)
             else:
                 warnings.warn('Unrecognized input file type', RuntimeWarning)
+            self.set_precision(params)
         else:
             pass
 
     def copy(self):
         return copy.deepcopy(self)
 
+    def set_precision(self, params):
+        """
+        store the map and rms cubes in the precision set by params.precision (float32 for
+        'single', which halves their memory) and the hits as integers. anything computed
+        from them (stacks, weights) is still accumulated in double precision
+        """
+        dtype = storage_dtype(params)
+        for attr in ['map', 'rms']:
+            try:
+                if getattr(self, attr).dtype != dtype:
+                    setattr(self, attr, getattr(self, attr).astype(dtype))
+            except AttributeError:
+                continue
+
+        if dtype == np.float32:
+            try:
+                hit = np.rint(np.nan_to_num(self.hit, nan=0., posinf=0., neginf=0.))
+                inttype = np.int32 if np.max(hit, initial=0) < np.iinfo(np.int32).max else np.int64
+                self.hit = hit.astype(inttype)
+            except AttributeError:
+                pass
+
+        # anything cached off the old arrays is out of date
+        try:
+            del self.apnantables
+        except AttributeError:
+            pass
+
     def load(self, inputfile, params, reshape=True):
 
         """
@@ -1009,6 +1456,9 @@ class maps():
         # move some things to params to keep the info handy
         params.nchans = self.map.shape[0]
         params.chanwidth = np.abs(self.freq[1] - self.freq[0])
+        # tabulate the cosmology over the redshift range of the map
+        if isinstance(params, parameters):
+            params.make_cosmo_cache(self)
 
     def mask_isolated_pix(self, params):
         """
@@ -1092,17 +1542,24 @@ class maps():
         self.unit = 'K'
 
         if reshape:
-            chanpersb = maptemparr.shape[1]
-            self.map = np.reshape(self.map, (4*chanpersb, len(self.physy[:-1]), len(self.physz[:-1])))
-            self.rms = np.reshape(self.rms, (4*chanpersb, len(self.physy[:-1]), len(self.physz[:-1])))
-            self.ra = np.reshape(self.ra, (4*chanpersb, len(self.physy)))
-            self.dec = np.reshape(self.dec, (4*chanpersb, len(self.physz)))
+            nsb, chanpersb = maptemparr.shape[:2]
+            self.map = np.reshape(self.map, (nsb*chanpersb, len(self.physy[:-1]), len(self.physz[:-1])))
+            self.rms = np.reshape(self.rms, (nsb*chanpersb, len(self.physy[:-1]), len(self.physz[:-1])))
+            self.ra = np.reshape(self.ra, (nsb*chanpersb, len(self.physz)))
+            self.dec = np.reshape(self.dec, (nsb*chanpersb, len(self.physy)))
 
         # get the field center by just taking an average of the pixel edges
         self.fieldcent = SkyCoord(np.nanmean(self.ra)*u.deg, np.nanmean(self.dec)*u.deg)
 
         self.setup_coordinates(cosmogrid=True)
 
+        # move some things to params to keep the info handy
+        params.nchans = self.map.shape[0]
+        params.chanwidth = np.abs(self.fstep)
+        # tabulate the cosmology over the redshift range of the map
+        if isinstance(params, parameters):
+            params.make_cosmo_cache(self)
+
 
 
     """UNIT CONVERSIONS"""
@@ -1161,13 +1618,14 @@ class maps():
         self.map = self.map * u.Jy * u.km/u.s
         self.rms = self.rms * u.Jy * u.km/u.s
 
-        nuobs = np.tile(self.freqbc, (self.map.shape[2], self.map.shape[1], 1)).T * u.GHz
+        # observed frequency of each channel (broadcasts across the spatial axes)
+        nuobs = self.freqbc[:,None,None] * u.GHz
 
         # find redshift from nuobs:
         zval = freq_to_z(params.centfreq*u.GHz, nuobs) #*****************
 
         # luminosity distance in Mpc
-        DLs = params.cosmo.luminosity_distance(zval)
+        DLs = get_cosmo(params).luminosity_distance(zval)
 
         # line luminosity
         linelum = const.c**2 / (2*const.k_B) * self.map * DLs**2 / (nuobs**2 * (1+zval)**3)
@@ -1227,6 +1685,9 @@ class maps():
         # move some things to params to keep the info handy
         params.nchans = self.map.shape[0]
         params.chanwidth = np.abs(self.freq[1] - self.freq[0])
+        # tabulate the cosmology over the redshift range of the map
+        if isinstance(params, parameters):
+            params.make_cosmo_cache(self)
 
         # field center 
         self.fieldcent = SkyCoord(self.ra[len(self.ra) // 2]*u.deg, self.dec[len(self.ra) // 2]*u.deg)
@@ -1435,151 +1896,166 @@ class maps():
 
             return outmap
 
-    def cosmic_volume_spacing(self, goalres, params, oversamp=5):
+    def cosmic_volume_spacing(self, goalres, params, outfile=None, nthreads=None, mincoverage=0.5,
+                              kernel_width=1.3, sample_region_width=4):
         """
-        evenly space a maps object in proper cosmic distance
+        evenly space a maps object in proper cosmic distance. meant to be run once as a
+        preprocessing step, so that physical-space stacks are just regular stacks on the
+        regridded cube (load it back in with params.cosmogrid = True)
+        each channel is reconvolved to the worst physical beam in the map and resampled onto
+        pixels goalres across with sparse gaussian operators (see resampling_operator), and
+        the rms is propagated through the same weights
         -------
         inputs:
             self: stacker.maps object
-            goalres: 
-            oversamp: factor by which the map should be oversampled while reprojecting
-        
+            goalres: goal pixel size (Mpc if not passed as a quantity)
+            params: stacker.parameters object
+            outfile: if passed, save the regridded map here in the format load_cosmogrid reads
+            nthreads: number of processes to split the channels over. defaults to
+                params.nthreads if params.parallelize is set, and runs serially otherwise
+            mincoverage: fraction of the kernel weight that has to fall on good pixels for an
+                output pixel to be kept
+            kernel_width, sample_region_width: adaptive resampling window, in output pixels
+                (same conventions as reproject_adaptive)
+        returns a new maps object with per-channel (2D) ra and dec axes
         """
-        
+
+        # goal width
+        if not isinstance(goalres, u.Quantity):
+            goalres = goalres * u.Mpc
+
         # add a bin centers attr for the frequency direction
         # and redshift axis
         self.freqbc = self.fstep / 2 + self.freq
-        self.z = freq_to_z(115.27, self.freqbc)
-        
+        self.z = freq_to_z(params.centfreq, self.freqbc)
+
         # conversion factor for each channel (assuming constant across map)
-        chanscales = params.cosmo.kpc_proper_per_arcmin(self.z)
-        
-        # actual COMAP beam
-        beam_fwhm = 4.5*u.arcmin
-        sigma_x = beam_fwhm / (2 * np.sqrt(2 * np.log(2)))
-        sigma_y = sigma_x
-        omega_B = (2 * np.pi * sigma_x * sigma_y)
-        
-        # beam fwhm in Mpc
-        sigmazmpc = (sigma_x * chanscales).to(u.Mpc)
-        
-        # kernel to put them all on the same size beam
-        sigmamax = sigmazmpc[-1]
-        sigmaconvmpc = np.sqrt(sigmamax**2 - sigmazmpc**2)
-        sigmaconv = (sigmaconvmpc / chanscales).to(u.arcmin)
-        
-        # oversample
-        bigmap = self.upgrade(5, params)
-        
-        # kernel in pixels
-        sigmaconvpix = sigmaconv / ((bigmap.xstep*u.deg).to(u.arcmin))
-        
-        # width of each channel in Mpc
-        chansizes = (chanscales * bigmap.xstep*u.deg).to(u.Mpc)
-        
-        # set up original wcs: empty wcs thing to store it in
-        bigwcsdict = {"CTYPE1": 'RA---CAR', 
-                    "CTYPE2": 'DEC--CAR'}
-        # populate it with the correct values ***THESE ARE WRONG********
-        bigwcs = wcs.WCS(bigwcsdict)
-        centidx = np.array([len(bigmap.x)//2, len(bigmap.y)//2])
-        bigwcs.wcs.crpix = centidx
-        bigwcs.wcs.crval = np.array([bigmap.ra[centidx[0]], bigmap.dec[centidx[1]]])
-        bigwcs.wcs.cdelt = np.array([bigmap.xstep, bigmap.ystep])
-        
-        # goal width
-        if not type(goalres) == u.quantity.Quantity:
-            goalres *= u.Mpc
-            
-        # factor by which to resample
-        resampfacs = (goalres / chansizes).value
-        
-        # new degree scale of each channel
-        newcdelt = np.array([bigmap.xstep*resampfacs, bigmap.ystep*resampfacs])
-        
-        # current width of the map
-        mapwidth = bigmap.map.shape[1] * bigmap.xstep
-        
-        # what is this in the new cdelt pixels in each channel
-        mapsizes = mapwidth / newcdelt
-        mapsize = int(np.round(np.max(mapsizes)))
-        mapcent = mapsize // 2
-        
-        # set up output wcs
-        outwcs = copy.deepcopy(bigwcs)
-        outwcs.wcs.crpix = np.array([mapcent, mapcent])
-        
-        
-        # loop through channels, reconvolve and reproject
-        rprcmaplist = []
-        outwcslist = []
-        for freq in range(len(bigmap.freq)):
-            # reconvolve
-            kernel = Gaussian2DKernel(sigmaconvpix[freq].value)
-            rcchan = convolve(bigmap.map[freq,:,:], kernel, fill_value=np.nan)
-            
-            # adjust output wcs
-            chanwcs = copy.deepcopy(outwcs)
-            chanwcs.wcs.cdelt = np.array([newcdelt[0][freq], newcdelt[1][freq]])
-            outwcslist.append(chanwcs)
-            
-            # reproject
-            rprcchan, _ = reproject_adaptive((rcchan, bigwcs), chanwcs,
-                                            shape_out=(mapsize,mapsize),
-                                            kernel='gaussian', boundary_mode='strict')
-            rprcmaplist.append(rprcchan)
-            
-            if params.verbose:
-                if freq % 10 == 0:
-                    print(freq)
-        rprcmap = np.array(rprcmaplist)
-        
+        pcosmo = get_cosmo(params)
+        chanscales = pcosmo.kpc_proper_per_arcmin(self.z)
+
+        # beam width in Mpc -- everything gets reconvolved to the biggest one
+        beammpc = (params.beamwidth * u.arcmin * chanscales).to(u.Mpc)
+        goalchanbeam = (np.max(beammpc) / chanscales).to(u.arcmin).value
+
+        # new pixel size in each channel (deg)
+        newcdelt = (goalres / chanscales).to(u.deg).value
+
+        # operator parameters for each spatial axis
+        nchan, ny, nx = self.map.shape
+        opargs = []
+        for nin, step in [(nx, self.xstep), (ny, self.ystep)]:
+            step = np.abs(step)
+            # output pixel size and resampling kernel in input pixels
+            ratio = newcdelt / step
+            sigma = resampling_sigma(params.beamwidth, goalchanbeam, (step*u.deg).to(u.arcmin).value, ratio,
+                                     kernel_width)
+            halfwidth = sample_region_width / 2 * np.maximum(ratio, 1.)
+            # enough output pixels to hold the whole map in the channel with the smallest ones
+            nout = int(np.round(np.max(nin / ratio)))
+            # keep the output grid centered on the input one
+            cent = (nin - 1) / 2 - ((nout - 1) / 2 - nout // 2) * ratio
+            opargs.append([(nin, nout, cent[i], ratio[i], sigma[i], halfwidth[i]) for i in range(nchan)])
+        xargs, yargs = opargs
+        xsize, ysize = xargs[0][1], yargs[0][1]
+
         # set up 3d map object with variable pixel scales
-        outmap = bigmap.copy()
-        outmap.map = rprcmap
-        outmap.x = np.arange(mapsize)
-        outmap.y = np.arange(mapsize)
-        
-        outmap.rms = np.ones(np.shape(outmap.map)) # *********
-        
-        raidx = outmap.x - mapcent
-        decidx = outmap.y - mapcent
-        newxstep = []
-        newystep = []
-        newra = []
-        newdec = []
-        for freq in range(len(outmap.freq)):
-            
-            cdelts = outwcslist[freq].wcs.cdelt
-            chanxstep = cdelts[0]
-            chanystep = cdelts[1]
-            
-            chanra = outwcslist[0].wcs.crval[0] + raidx * chanxstep
-            chandec = outwcslist[0].wcs.crval[1] + decidx * chanystep
-            
-            newxstep.append(np.ones(238)*chanxstep)
-            newystep.append(np.ones(238)*chanystep)
-            newra.append(chanra)
-            newdec.append(chandec)
-        
-        newxstep = np.array(newxstep)
-        newystep = np.array(newystep)
-        ra = np.array(newra)
-        dec = np.array(newdec)
-        
-        outmap.xstep = newxstep[:,0]
-        outmap.ystep = newystep[:,0]
-        outmap.ra = ra
-        outmap.dec = dec
-        outmap.rabc = ra - newxstep / 2
-        outmap.decbc = dec - newystep / 2
-        
-        # *** save spacing in mpc also
-        # *** do this in-place
-        
-        
+        outmap = maps(params)
+        outmap.type = 'regridded data'
+        outmap.unit = self.unit
+        outmap.fieldcent = self.fieldcent
+        outmap.map = np.full((nchan, ysize, xsize), np.nan)
+        outmap.rms = np.full((nchan, ysize, xsize), np.nan)
+
+        # stream the channels through the workers one at a time (operators get built in the
+        # worker, so only a single channel and its output are ever in flight per process)
+        if nthreads is None:
+            nthreads = params.nthreads if params.parallelize else 1
+        tasks = ((self.map[i], self.rms[i], xargs[i], yargs[i], mincoverage) for i in range(nchan))
+        starttime = time.time()
+        pool = multiprocessing.Pool(nthreads) if nthreads > 1 else None
+        try:
+            if pool:
+                chaniter = pool.imap(_regrid_channel_star, tasks, chunksize=max(nchan // (8*nthreads), 1))
+            else:
+                chaniter = map(_regrid_channel_star, tasks)
+            if params.verbose:
+                chaniter = tqdm(chaniter, total=nchan, desc='regridding channels')
+
+            for i, (chanmap, chanrms) in enumerate(chaniter):
+                outmap.map[i] = chanmap
+                outmap.rms[i] = chanrms
+                if params.verbose and i % 10 == 0:
+                    chaniter.set_postfix(peakmem='{:.0f} MB'.format(peak_memory()))
+
+            if pool:
+                pool.close()
+                pool.join()
+        finally:
+            # don't leave workers behind if a channel fails
+            if pool:
+                pool.terminate()
+
+        # keep a record of how the regridding went
+        outmap.regridinfo = {'goalres': goalres.to(u.Mpc).value, 'nthreads': nthreads,
+                             'runtime': time.time() - starttime, 'peakmem': peak_memory(),
+                             'workerpeakmem': peak_memory(children=True) if nthreads > 1 else np.nan,
+                             'inputshape': self.map.shape, 'outputshape': outmap.map.shape}
+        if params.verbose:
+            print('regridded {} channels in {:.1f} s on {} process(es), peak memory {:.0f} MB'.format(
+                  nchan, outmap.regridinfo['runtime'], nthreads, outmap.regridinfo['peakmem'])
+                  + (' (largest worker {:.0f} MB)'.format(outmap.regridinfo['workerpeakmem'])
+                     if nthreads > 1 else ''))
+
+        # per-channel pixel edges on the sky
+        raedges, decedges = [], []
+        for i in range(nchan):
+            for axargs, start, step, edgelist in [(xargs[i], self.ra[0], self.xstep, raedges),
+                                                  (yargs[i], self.dec[0], self.ystep, decedges)]:
+                nin, nout, cent, ratio = axargs[:4]
+                edgepos = cent + (np.arange(nout + 1) - 0.5 - nout // 2) * ratio
+                edgelist.append(start + (edgepos + 0.5) * step)
+
+        # physical pixel edges (Mpc): line of sight (comoving distance to each channel edge)
+        # and transverse (offsets from the map center)
+        acosmo = getattr(pcosmo, 'cosmo', pcosmo)
+        outmap.physx = acosmo.comoving_distance(freq_to_z(params.centfreq, self.freqbe)).to(u.Mpc).value
+        outmap.physy = (np.arange(ysize + 1) - ysize / 2) * goalres.to(u.Mpc).value
+        outmap.physz = (np.arange(xsize + 1) - xsize / 2) * goalres.to(u.Mpc).value
+
+        outmap.freq = self.freqbe
+        outmap.ra = np.array(raedges)
+        outmap.dec = np.array(decedges)
+        outmap.setup_coordinates(cosmogrid=True)
+
+        if outfile:
+            outmap.dump_cosmogrid(outfile)
+
         return outmap
 
+    def dump_cosmogrid(self, outfile):
+        """
+        save a regridded (cosmic_volume_spacing) map object to an h5 file in the format
+        load_cosmogrid reads
+        """
+
+        # split channels back up into sidebands if possible
+        nchan = self.map.shape[0]
+        nsb = 4 if nchan % 4 == 0 else 1
+        outshape = (nsb, nchan // nsb) + self.map.shape[1:]
+
+        with h5py.File(outfile, 'w') as f:
+            dset = f.create_dataset('map_coadd', data = self.map.reshape(outshape), dtype='float64')
+            dset = f.create_dataset('sigma_wn_coadd', data = self.rms.reshape(outshape), dtype='float64')
+            dset = f.create_dataset('freq_edges', data = self.freqbe, dtype='float64')
+            dset = f.create_dataset('ra_per_z', data = self.rabe, dtype='float64')
+            dset = f.create_dataset('dec_per_z', data = self.decbe, dtype='float64')
+            dset = f.create_dataset('physical_edges_x', data = self.physx, dtype='float64')
+            dset = f.create_dataset('physical_edges_y', data = self.physy, dtype='float64')
+            dset = f.create_dataset('physical_edges_z', data = self.physz, dtype='float64')
+
+            patchcent = (self.fieldcent.ra.deg, self.fieldcent.dec.deg)
+            dset = f.create_dataset('patch_center', data = patchcent, dtype='float64')
+
         
     def match_wcs(self, goalmap, params):
         """
@@ -1759,6 +2235,365 @@ def dict_saver(indict, outfile, strip_units=True):
             return unitless_dict
 
 
+""" RESULTS STORE """
+def store_file(storefile, mode='a', timeout=60):
+    """
+    open the hdf5 results store, waiting for the lock if another process is writing to it
+    """
+    start = time.time()
+    while True:
+        try:
+            return h5py.File(storefile, mode)
+        except (OSError, BlockingIOError):
+            if mode == 'r' or time.time() - start > timeout:
+                raise
+            time.sleep(0.1)
+
+def _store_value(val):
+    """ strip units off a value (and stringify anything hdf5 can't take) for an attribute """
+    if isinstance(val, u.Quantity):
+        val = val.value
+    if val is None:
+        return 'None'
+    if isinstance(val, (bool, int, float, str, np.number, np.bool_)):
+        return val
+    try:
+        arr = np.asarray(val)
+        if arr.dtype.kind in 'biuf':
+            return arr
+    except Exception:
+        pass
+    return str(val)
+
+def store_params(storefile, params):
+    """
+    write the parameters of a run into the 'params' group of the results store (as
+    attributes, with units stripped and anything non-numeric saved as a string)
+    """
+    with store_file(storefile) as f:
+        grp = f.require_group('params')
+        try:
+            pdict = params.as_dict()
+        except AttributeError:
+            pdict = vars(params)
+        for (key, val) in pdict.items():
+            if key in ['dir', 'pscache', 'cosmotable', 'rng', 'gauss_kernel', 'stackprofile']:
+                continue
+            grp.attrs[key] = _store_value(val)
+
+def store_cubelet(storefile, name, cube, rms, catidx, outdict, compression='gzip'):
+    """
+    save a stacked cubelet (cube and rms arrays, the indices of the catalogue objects in
+    it, and its output values as attributes) under 'stacks/name' in the results store,
+    overwriting anything already there
+    """
+    with store_file(storefile) as f:
+        grp = f.require_group('stacks')
+        if name in grp:
+            del grp[name]
+        grp = grp.create_group(name)
+
+        grp.create_dataset('cube', data=cube, chunks=True, compression=compression)
+        grp.create_dataset('rms', data=rms, chunks=True, compression=compression)
+        grp.create_dataset('catidx', data=np.array(catidx).flatten(), compression=compression)
+        for (key, val) in outdict.items():
+            grp.attrs[key] = _store_value(val)
+
+def store_append(storefile, dsetname, vals, chunklen=256, compression='gzip'):
+    """
+    append vals along the first axis of the dataset dsetname in the results store (e.g.
+    one cubelet per bootstrap realization). the dataset is created resizable, chunked
+    and compressed the first time it's appended to. returns the new length
+    """
+    with store_file(storefile) as f:
+        return _store_extend(f, dsetname, vals, chunklen=chunklen, compression=compression)
+
+def _store_extend(f, dsetname, vals, chunklen=256, compression='gzip'):
+    """ append vals to the dataset dsetname in the open results store f (see store_append) """
+    vals = np.asarray(vals)
+    if vals.dtype.kind == 'U':
+        vals = vals.astype('S')
+    if dsetname not in f:
+        f.create_dataset(dsetname, shape=(0,) + vals.shape[1:], maxshape=(None,) + vals.shape[1:],
+                         dtype=vals.dtype, chunks=(chunklen,) + vals.shape[1:],
+                         compression=compression)
+    dset = f[dsetname]
+    n = dset.shape[0]
+    dset.resize(n + vals.shape[0], axis=0)
+    dset[n:] = vals
+
+    return dset.shape[0]
+
+def store_append_rows(storefile, groupname, rows):
+    """
+    append per-realization scalars to the table groupname in the results store. rows is a
+    dict of column name: value (or a list of those, for more than one row); every column
+    is its own appendable dataset in the group. all the columns are resized and written
+    with the file open once, so they can't end up different lengths
+    """
+    if isinstance(rows, dict):
+        rows = [rows]
+    columns = {key: [_store_value(row[key]) for row in rows] for key in rows[0].keys()}
+    with store_file(storefile) as f:
+        for (key, vals) in columns.items():
+            _store_extend(f, groupname + '/' + key, vals)
+
+def store_write_rows(storefile, groupname, columns):
+    """
+    write a whole table (dict of column name: array) to groupname in the results store,
+    replacing whatever was there. the columns stay appendable with store_append_rows
+    """
+    with store_file(storefile) as f:
+        if groupname in f:
+            del f[groupname]
+        for (key, vals) in columns.items():
+            _store_extend(f, groupname + '/' + key, vals)
+
+def store_read_rows(storefile, groupname):
+    """ read a table written by store_append_rows back as a dict of column arrays """
+    with store_file(storefile, 'r') as f:
+        return {key: dset[()] for (key, dset) in f[groupname].items()}
+
+def split_store_path(path):
+    """
+    split a path like 'results.h5/name' (or .hdf5) into the results store file and the
+    name of the stack in it ('combined' if there isn't one). (None, None) if the path
+    isn't in a results store
+    """
+    head, name = path.rstrip('/'), ''
+    while head:
+        if head.endswith(('.h5', '.hdf5')):
+            return head, name.strip('/') or 'combined'
+        head, tail = os.path.split(head)
+        if not tail:
+            break
+        name = tail + '/' + name
+    return None, None
+
+def store_names(storefile, groupname='stacks'):
+    """ names of the stacks (or tables, etc) in a group of the results store """
+    try:
+        with store_file(storefile, 'r') as f:
+            return list(f[groupname].keys())
+    except (OSError, KeyError):
+        return []
+
+
+""" PROFILING """
+# the ways a catalogue object can be thrown out before it gets stacked, in the order
+# cutout_prefilter and single_cutout check them
+rejection_reasons = ['outofband', 'offmap', 'nancentre', 'aperturenan', 'channelnan',
+                     'filter', 'physicalspacing']
+
+class _stage_timer():
+    """ context manager adding the time spent inside it to one stage of a stack_profile """
+    __slots__ = ('profile', 'name', 'start')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.add(self.name, time.perf_counter() - self.start)
+        return False
+
+class _null_timer():
+    """ context manager that does nothing """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_timer_instance = _null_timer()
+
+class stack_profile():
+    """
+    wall time and call counts for each stage of a stack run (load, cull, locate, extract,
+    filters, physicalspacing, units, merge, plot, save), plus the cutout funnel: how many
+    catalogue objects went in, how many were stacked, and how many were thrown out for
+    each of rejection_reasons
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.funnel = {}
+        self.rejected = {}
+
+    def __bool__(self):
+        return True
+
+    def stage(self, name):
+        """ time a block of code: 'with profile.stage(name):' """
+        return _stage_timer(self, name)
+
+    def tick(self):
+        """ start a lap timer (see lap) """
+        return time.perf_counter()
+
+    def lap(self, name, since):
+        """
+        add the time since the last tick/lap to stage name and restart the timer, for
+        timing consecutive stages of one function without re-indenting it
+        """
+        now = time.perf_counter()
+        self.add(name, now - since)
+        return now
+
+    def add(self, name, seconds, calls=1):
+        try:
+            entry = self.stages[name]
+            entry[0] += seconds
+            entry[1] += calls
+        except KeyError:
+            self.stages[name] = [seconds, calls]
+
+    def count(self, name, n=1):
+        self.funnel[name] = self.funnel.get(name, 0) + int(n)
+
+    def reject(self, reason, n=1):
+        self.rejected[reason] = self.rejected.get(reason, 0) + int(n)
+
+    def merge(self, other):
+        """ add in the timings and counts from another stack_profile (or its summary) """
+        if not other:
+            return
+        if not isinstance(other, dict):
+            other = other.summary()
+        for (name, entry) in other['stages'].items():
+            self.add(name, entry['seconds'], entry['calls'])
+        for (name, n) in other['funnel'].items():
+            self.count(name, n)
+        for (reason, n) in other['rejected'].items():
+            self.reject(reason, n)
+
+    def summary(self):
+        """ plain-dict version of the profile (this is what gets attached to cubelets) """
+        return {'stages': {name: {'seconds': entry[0], 'calls': entry[1]}
+                           for (name, entry) in self.stages.items()},
+                'funnel': dict(self.funnel),
+                'rejected': dict(self.rejected)}
+
+    def report(self):
+        profile_report(self.summary())
+
+class _null_stack_profile():
+    """ stand-in for stack_profile when profiling is switched off: everything is a no-op """
+    __slots__ = ()
+
+    def __bool__(self):
+        return False
+
+    def stage(self, name):
+        return _null_timer_instance
+
+    def tick(self):
+        return 0.
+
+    def lap(self, name, since):
+        return 0.
+
+    def add(self, name, seconds, calls=1):
+        return
+
+    def count(self, name, n=1):
+        return
+
+    def reject(self, reason, n=1):
+        return
+
+    def merge(self, other):
+        return
+
+    def summary(self):
+        return None
+
+    def report(self):
+        return
+
+null_profile = _null_stack_profile()
+
+def new_profile(params):
+    """
+    a fresh stack_profile (or null_profile if params.profile is off) that isn't attached to
+    the run -- each field stack gets one, and merges it into get_profile(params) when done
+    """
+    if not getattr(params, 'profile', False):
+        return null_profile
+    return stack_profile()
+
+def get_profile(params, new=False):
+    """
+    the stack_profile collecting timings for this run (kept in params.stackprofile), or
+    null_profile if params.profile is off. new=True starts a fresh one
+    """
+    if not getattr(params, 'profile', False):
+        return null_profile
+
+    prof = getattr(params, 'stackprofile', None)
+    if new or prof is None:
+        prof = new_profile(params)
+        params.stackprofile = prof
+    return prof
+
+def profile_rows(summary):
+    """ flatten a profile summary into columns (kind, name, seconds, count) for saving """
+    rows = {'kind': [], 'name': [], 'seconds': [], 'count': []}
+    for (kind, name, seconds, count) in (
+            [('stage', name, entry['seconds'], entry['calls']) for (name, entry) in summary['stages'].items()]
+            + [('funnel', name, 0., n) for (name, n) in summary['funnel'].items()]
+            + [('rejected', name, 0., n) for (name, n) in summary['rejected'].items()]):
+        rows['kind'].append(kind)
+        rows['name'].append(name)
+        rows['seconds'].append(seconds)
+        rows['count'].append(count)
+    return rows
+
+def profile_report(summary):
+    """ print a profile summary as a table """
+    if not summary:
+        print('No profile recorded (set params.profile = True)')
+        return
+
+    total = np.sum([entry['seconds'] for entry in summary['stages'].values()])
+    print("Stack profile")
+    print("-------------")
+    for (name, entry) in sorted(summary['stages'].items(), key=lambda item: -item[1]['seconds']):
+        print("\t {:<16s} {:10.3f} s {:8d} calls {:6.1f}%".format(name, entry['seconds'], entry['calls'],
+                                                                100 * entry['seconds'] / max(total, 1e-30)))
+    print("-------------")
+    for (name, n) in summary['funnel'].items():
+        print("\t {:<16s} {:8d}".format(name, n))
+    for reason in rejection_reasons + [r for r in summary['rejected'] if r not in rejection_reasons]:
+        if reason in summary['rejected']:
+            print("\t rejected: {:<16s} {:8d}".format(reason, summary['rejected'][reason]))
+    print("-------------")
+
+def save_profile(summary, params, fieldstr=''):
+    """
+    save a profile summary with the rest of the stack outputs: a 'profile/name' table in
+    the results store, or stack_profile.csv next to output_values.csv
+    """
+    if not summary:
+        return
+
+    rows = profile_rows(summary)
+    if getattr(params, 'resultsformat', 'csv') == 'hdf5':
+        store_write_rows(params.resultsfile, 'profile/' + (fieldstr.strip('/') or 'combined'), rows)
+        return
+
+    with open(params.datasavepath + fieldstr + '/stack_profile.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(list(rows.keys()))
+        writer.writerows(zip(*rows.values()))
+
+
 """ MATH """
 def minmax(vals, axis=None):
     """
@@ -1776,13 +2611,27 @@ def edgetocent(arr):
     step = arr[1] - arr[0]
     return arr[:-1] + step/2
 
+def storage_dtype(params):
+    """ dtype maps and cutouts are stored in (float32 if params.precision is 'single') """
+    if getattr(params, 'precision', 'double') == 'single':
+        return np.float32
+    return np.float64
+
+def as_double(vals):
+    """ float32 arrays upcast to float64 (so sums over them are accumulated in double) """
+    if getattr(vals, 'dtype', None) == np.float32:
+        return vals.astype(np.float64)
+    return vals
+
 def weightmean(vals, rmss, axis=None, weights=None):
     """
     average of vals, weighted by rmss, over the passed axes
     default is over a a fully flattened array if no axes are passed
     will be default weight by inverse variance only, but if 'weights' are passed then 
     will also weight by whatever that is
+    (always accumulated in double precision, even for single-precision inputs)
     """
+    vals, rmss = as_double(vals), as_double(rmss)
     if np.any(weights):
         weights = weights / rmss**2 # *** probably going to have to worry about the shape of the weights array
     else:
@@ -1798,6 +2647,43 @@ def weightmean(vals, rmss, axis=None, weights=None):
 
     return meanval, meanrms
 
+def aperture_box_values(cube, cuberms, freqwidth, ywidth, xwidth, method='weightmean'):
+    """
+    aperture values and rmss (the same numbers cubelet.get_offset_aperture gives) for every
+    freqwidth x ywidth x xwidth aperture in cube at once. element [f, y, x] of the outputs is
+    the aperture whose lowest-index corner is voxel (f, y, x), so the outputs have shape
+    (nf - freqwidth + 1, ny - ywidth + 1, nx - xwidth + 1)
+    'weightmean' is the inverse-variance mean of each channel scaled to the aperture area,
+    'summed' is the straight sum. nans are dropped like nansum does
+    """
+    swv = np.lib.stride_tricks.sliding_window_view
+    cube, cuberms = as_double(cube), as_double(cuberms)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if method == 'summed':
+            spec = swv(np.nan_to_num(cube, nan=0., posinf=np.inf, neginf=-np.inf),
+                       (ywidth, xwidth), axis=(1, 2)).sum(axis=(-2, -1))
+            dspec2 = swv(np.nan_to_num(cuberms**2, nan=0., posinf=np.inf),
+                         (ywidth, xwidth), axis=(1, 2)).sum(axis=(-2, -1))
+        elif method == 'weightmean':
+            weights = 1 / cuberms**2
+            valweights = cube * weights
+            wsum = swv(np.where(np.isnan(weights), 0., weights),
+                       (ywidth, xwidth), axis=(1, 2)).sum(axis=(-2, -1))
+            vwsum = swv(np.where(np.isnan(valweights), 0., valweights),
+                        (ywidth, xwidth), axis=(1, 2)).sum(axis=(-2, -1))
+            # correct for adjusted solid angle
+            spec = vwsum / wsum * xwidth * ywidth
+            dspec2 = (np.sqrt(1 / wsum) * xwidth * ywidth)**2
+        else:
+            raise ValueError("aperture_box_values: don't know method '{}'".format(method))
+
+        # then over the aperture channels
+        val = swv(np.where(np.isnan(spec), 0., spec), freqwidth, axis=0).sum(axis=-1)
+        dval = np.sqrt(swv(np.where(np.isnan(dspec2), 0., dspec2), freqwidth, axis=0).sum(axis=-1))
+
+    return val, dval
+
 def globalweightmean(vals, rmss, axis=None):
     """
     average of vals, weighted by rmss, over the passed axes
@@ -1831,6 +2717,107 @@ def gauss(x, a, b, c):
     """
     return a*np.exp(-(x-b)**2/2/c**2)
 
+""" RESAMPLING """
+def resampling_sigma(beamfwhm, goalfwhm, inpix, ratio, kernel_width=1.3):
+    """
+    std, in input pixels, of the gaussian resampling kernel (for resampling_operator) that
+    takes a map with a beam of FWHM beamfwhm to one with goalfwhm (both in the units of
+    inpix, the input pixel size) on output pixels ratio times the size of the input ones.
+    the reconvolution is added in quadrature to the adaptive resampling window --
+    reproject_adaptive's gaussian window measures out at a sigma of kernel_width / 4
+    output pixels (checked against the spectral-cube version of physical_spacing with
+    benchmark.physical_spacing_check), and is never narrower than an input pixel
+    """
+    fwhmtostd = 1 / (2 * np.sqrt(2 * np.log(2)))
+    convsigma = np.sqrt(np.maximum(goalfwhm**2 - beamfwhm**2, 0.)) * fwhmtostd / inpix
+    windowsigma = kernel_width / 4 * np.maximum(ratio, 1.)
+    return np.sqrt(convsigma**2 + windowsigma**2)
+
+def resampling_operator(nin, nout, cent, ratio, sigma, halfwidth, nsig=4):
+    """
+    one-dimensional sparse resampling operator (used for physical spacing and cosmogrid
+    regridding). output pixel j sits at input coordinate cent + (j - nout//2) * ratio; the
+    weights are the gaussian (width sigma, in input pixels) integrated over each input pixel,
+    so it does the beam reconvolution and the adaptive resampling in one go
+    returns the weight matrix, its support (for nan propagation), and a mask of output
+    pixels whose sample region (+/- halfwidth) stays inside the input ('strict' boundary)
+    """
+    outpos = cent + (np.arange(nout) - nout // 2) * ratio
+
+    # every output pixel touches the same number of input pixels (+/- nsig sigma)
+    reach = nsig * sigma + 0.5
+    lo = np.floor(outpos - reach).astype(int)
+    cols = lo[:, None] + np.arange(int(np.ceil(2 * reach)) + 2)
+    rows = np.broadcast_to(np.arange(nout)[:, None], cols.shape)
+    cdf = ndtr((np.concatenate((cols, cols[:, -1:] + 1), axis=1) - 0.5 - outpos[:, None]) / sigma)
+    vals = np.diff(cdf, axis=1)
+
+    # drop anything that falls off the input
+    keep = (cols >= 0) & (cols < nin)
+    rows, cols, vals = rows[keep], cols[keep], vals[keep]
+    weights = sparse.csr_matrix((vals, (rows, cols)), shape=(nout, nin))
+    support = sparse.csr_matrix((np.ones(len(vals)), (rows, cols)), shape=(nout, nin))
+
+    inbounds = (outpos - halfwidth >= -0.5) & (outpos + halfwidth <= nin - 0.5)
+
+    return weights, support, inbounds
+
+
+def regrid_channel(chanmap, chanrms, xop, yop, mincoverage=0.5):
+    """
+    regrid a single (dec, ra) channel with the sparse operators xop and yop (each the
+    output of resampling_operator). masked pixels get no weight, the rms is propagated
+    through the squared weights, and output pixels with less than mincoverage of their
+    kernel weight on good data (or off the edge of the input) are nan
+    """
+    (xw, _, xin), (yw, _, yin) = xop, yop
+
+    good = np.isfinite(chanmap) & np.isfinite(chanrms)
+    vals = np.where(good, chanmap, 0.)
+    var = np.where(good, chanrms, 0.) ** 2
+
+    # (yop @ chan @ xop.T), done as two sparse products
+    num = yw @ (xw @ vals.T).T
+    cover = yw @ (xw @ good.T.astype(float)).T
+    outvar = yw.power(2) @ (xw.power(2) @ var.T).T
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        outmap = num / cover
+        outrms = np.sqrt(outvar) / cover
+
+    bad = (cover < mincoverage) | ~yin[:, None] | ~xin[None, :]
+    outmap[bad] = np.nan
+    outrms[bad] = np.nan
+
+    return outmap, outrms
+
+
+def peak_memory(children=False):
+    """
+    peak resident memory (MB) of this process, or (if children) of the largest finished
+    child process -- the two are separate peaks, so report them separately rather than
+    adding them. returns nan on platforms without the resource module
+    """
+    try:
+        import resource
+    except ImportError:
+        return np.nan
+
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # linux reports in kB, mac in bytes
+    if sys.platform == 'darwin':
+        return peak / 1024**2
+    return peak / 1024
+
+
+def _regrid_channel_star(args):
+    """ unpack arguments for regrid_channel (so it can go through a multiprocessing pool) """
+    chanmap, chanrms, xargs, yargs, mincoverage = args
+    return regrid_channel(chanmap, chanrms, resampling_operator(*xargs), resampling_operator(*yargs),
+                          mincoverage=mincoverage)
+
+
 """ UNIT CONVERSIONS """
 def rayleigh_jeans(tb, nu, omega):
     """
@@ -1867,7 +2854,7 @@ def simlum_to_stacklum(simlum, stackout, params):
     """
     # first Lsun to Ico
     convfac = 4.0204e-2 # Jy/sr per Lsol/Mpc/Mpc/GHz
-    DLs = params.cosmo.luminosity_distance(stackout.z_mean) # luminosity distances
+    DLs = get_cosmo(params).luminosity_distance(stackout.z_mean) # luminosity distances
     Ico     = convfac * simlum/4/np.pi/(DLs.value)**2/(1+stackout.z_mean)**2/params.chanwidth
 
     # channel widths as velocities
@@ -1942,6 +2929,23 @@ def offset_frequencies(catinst, meanoff, scatter, rng):
     catinst.z = new_z
 
 
+""" COSMOLOGY """
+def get_cosmo(params):
+    """
+    returns the cosmology to use for distance calculations: the lookup table in
+    params.cosmotable if one has been built (see parameters.make_cosmo_cache), otherwise
+    the astropy cosmology in params.cosmo, otherwise the standard COMAP one
+    """
+    cosmotable = getattr(params, 'cosmotable', None)
+    if cosmotable is not None:
+        return cosmotable
+
+    try:
+        return params.cosmo
+    except AttributeError:
+        return FlatLambdaCDM(H0=70*u.km / (u.Mpc*u.s), Om0=0.286, Ob0=0.047)
+
+
 """ DOPPLER CONVERSIONS """
 def freq_to_z(nuem, nuobs):
     """
@@ -1973,23 +2977,29 @@ def field_setup(mapfile, catfile, params, trim_cat=True, sim_cat=False, lcat_cut
     wrapper function to set up for a single-field stack run
     *** tidy this up again -- put simulation parameters into params**
     """
+    prof = get_profile(params)
+
     # load in the map
-    mapinst = maps(params, inputfile=mapfile, cosmogrid=params.cosmogrid)
+    with prof.stage('load'):
+        mapinst = maps(params, inputfile=mapfile, cosmogrid=params.cosmogrid)
 
     # load in the catalogue
+    tick = prof.tick()
     if not sim_cat:
         catinst = catalogue(catfile)
+        tick = prof.lap('load', tick)
         # clip the catalogue to the field
         catinst.cull_to_map(mapinst, params, maxsep=2*u.deg)
     else:
         catinst = catalogue(catfile, load_all=True)
+        tick = prof.lap('load', tick)
         catinst.observation_cull(params, lcat_cutoff, goal_nobj, weight=weight)
 
     # adjust the beam to match the actual size of the spaxels
     params.pixbeamwidth = params.beamwidth / (np.nanmean(mapinst.ystep)*u.deg).to(u.arcmin).value # *** cosmogrid fixing
     params.gauss_kernel = Gaussian2DKernel(params.pixbeamwidth / (2*np.sqrt(2*np.log(2))))
 
-    # additional trimming ***DOES NOT WORK IF COSMOGRID TRUE YET
+    # additional trimming
     if trim_cat:
         print('trimming catalog')
         # trim the catalogs down to match the actual signal in the maps
@@ -2003,8 +3013,13 @@ def field_setup(mapfile, catfile, params, trim_cat=True, sim_cat=False, lcat_cut
         if decmaxidx >= mapinst.y[-1]:
             decmaxidx = -1
 
-        ramin, ramax = mapinst.ra[[raminidx, ramaxidx]]
-        decmin, decmax = mapinst.dec[[decminidx, decmaxidx]]
+        if len(mapinst.ra.shape) == 2:
+            # regridded maps have per-channel axes -- keep anything inside the widest channel
+            ramin, ramax = np.nanmin(mapinst.ra[:, raminidx]), np.nanmax(mapinst.ra[:, ramaxidx])
+            decmin, decmax = np.nanmin(mapinst.dec[:, decminidx]), np.nanmax(mapinst.dec[:, decmaxidx])
+        else:
+            ramin, ramax = mapinst.ra[[raminidx, ramaxidx]]
+            decmin, decmax = mapinst.dec[[decminidx, decmaxidx]]
 
         catidxra = np.logical_and(catinst.ra() > ramin, catinst.ra() < ramax)
         catidxdec = np.logical_and(catinst.dec() > decmin, catinst.dec() < decmax)
@@ -2012,6 +3027,8 @@ def field_setup(mapfile, catfile, params, trim_cat=True, sim_cat=False, lcat_cut
         
         catinst.subset(catidx)
 
+    prof.lap('cull', tick)
+
     return mapinst, catinst
 
 def setup(mapfiles, cataloguefile, params, trim_cat=True):
@@ -2020,6 +3037,9 @@ def setup(mapfiles, cataloguefile, params, trim_cat=True):
     accepts either a list of per-field catalogue files or one big one
     if there's only one map file, use field_setup
     """
+    # (a fresh profile for each run, if profiling)
+    get_profile(params, new=True)
+
     maplist = []
     catlist = []
     for i in range(len(mapfiles)):
@@ -2031,9 +3051,15 @@ def setup(mapfiles, cataloguefile, params, trim_cat=True):
         catlist.append(catinst)
 
     # adjust the stored beam model to be in pixels
-    params.beamwidth = params.beamwidth / (maplist[0].xstep*u.deg).to(u.arcmin).value
+    params.beamwidth = params.beamwidth / (np.nanmean(maplist[0].xstep)*u.deg).to(u.arcmin).value
     params.gauss_kernel = Gaussian2DKernel(params.beamwidth / (2*np.sqrt(2*np.log(2))))
 
+    # parameters objects don't touch the disk until the run actually starts
+    try:
+        params.make_output_dirs()
+    except AttributeError:
+        pass
+
     return maplist, catlist
 
 